@@ -3,11 +3,17 @@ Function to load the correct path based on the current session (from 1 to 15), d
 
 ATTENTION: You need to have run the SPEAR directory creation file and updated dir_cwd to create your own SPEAR
 
+The directory names are declared once in `layout`/`layout_misc`, the directory creation uses the same spec.
+
 Valid options are:
 Misc (do not use dataset_n or session_n)
     "noise"
     "hoa"
     "ATF"
+    "queue"
+    "precondition"
+    "events"
+    "noisepool"
 Main:
     "array"
     "DOA"
@@ -17,6 +23,7 @@ Extra
     "Tascar"
     "VAD"
     "PosOri"
+    "preview"
 
 """
 
@@ -26,60 +33,53 @@ from pathlib import PurePath
 
 temp = str(Path(os.path.realpath(__file__)).parents[4]) +'/Documents'
 
+###### Layout of the SPEAR directory (also used by fct_directoryCreation to build the tree)
+### option: (top directory, directory name, depth below the session, datasets where it exists)
+layout = {
+    'array':       ('Main',  'Microphone_Array_Audio', 'session', [1, 2, 3, 4]),
+    'DOA':         ('Main',  'DOA_sources',            'session', [1, 2, 3, 4]),
+    'orientation': ('Main',  'Array_Orientation',      'session', [1, 2, 3, 4]),
+    'reference':   ('Extra', 'Reference_Audio',        'minute',  [1, 2, 3, 4]),
+    'Tascar':      ('Extra', 'TASCAR',                 'minute',  [2, 3, 4]),
+    'VAD':         ('Extra', 'VAD',                    'session', [1, 2, 3, 4]),
+    'PosOri':      ('Extra', 'Reference_PosOri',       'minute',  [1, 2, 3, 4]),
+    'preview':     ('Extra', 'Preview_Audio',          'minute',  [2, 3, 4]),
+    }
+### option: (directory name, created with the SPEAR tree)
+layout_misc = {
+    'noise': ('AmbientNoise',             True),
+    'hoa':   ('HOA_weights',              True),
+    'ATF':   ('Array_Transfer_Functions', True),
+    'queue': ('JobQueue',                 False),
+    'precondition': ('Preconditioned',    True),
+    'events': ('RunEvents',               False),
+    'noisepool': ('NoisePool',            False),
+    }
+
+
+### Release and set of a session
+def SessionSet(session_n):
+    if session_n < 10:
+        return 'InitialRelease', 'Train'
+    elif session_n < 13:
+        return 'InitialRelease', 'Dev'
+    elif session_n < 16:
+        return 'FinalRelease', 'Eval'
+
+
 def PathFinder(dataset_n, session_n, option, path_spear=temp):
 
     ### Only Path to modify to run on any machine
     dir_cwd = PurePath(path_spear,'SPEAR')
 
+    if option in layout_misc:
+        return PurePath(dir_cwd, 'Miscellaneous', layout_misc[option][0])
+
     dir_dataset = f'Dataset_{dataset_n}'
     dir_session = f'Session_{session_n}'
+    dir_main, dir_active = layout[option][0:2]
+    dir_release, dir_set = SessionSet(session_n)
 
-    if option in ['array', 'DOA', 'orientation']:
-        dir_main = 'Main'
-
-        if option == 'array':
-            dir_active = 'Microphone_Array_Audio'
-        elif option == 'DOA':
-            dir_active = 'DOA_sources'
-        elif option == 'orientation':
-            dir_active = 'Array_Orientation'
-
-    elif option in ['reference', 'Tascar', 'VAD', 'PosOri']:
-        dir_main = 'Extra'
-
-        if option == 'reference':
-            dir_active = 'Reference_Audio'
-        elif option == 'Tascar':
-            dir_active = 'TASCAR'
-        elif option == 'VAD':
-            dir_active = 'VAD'
-        elif option == 'PosOri':
-            dir_active = 'Reference_PosOri'
-
-
-    if session_n < 10:
-        dir_release = 'InitialRelease'
-        dir_set = 'Train'
-    elif session_n < 13:
-        dir_release = 'InitialRelease'
-        dir_set  = 'Dev'
-    elif session_n < 16:
-        dir_release = 'FinalRelease'
-        dir_set  = 'Eval'
-   
-
-    if option in ['noise', 'hoa', 'ATF']:
-        dir_main = 'Miscellaneous'
-        if option=='noise':
-            dir_active = 'AmbientNoise'
-        elif option=='hoa':
-            dir_active = 'HOA_weights'
-        elif option=='ATF':
-            dir_active = 'Array_Transfer_Functions'
-
-        Path_full = PurePath(dir_cwd, dir_main, dir_active)
-
-    else:
-        Path_full = PurePath(dir_cwd, dir_main, dir_set, dir_dataset, dir_active, dir_session)
+    Path_full = PurePath(dir_cwd, dir_main, dir_set, dir_dataset, dir_active, dir_session)
 
     return Path_full
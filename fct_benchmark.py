@@ -0,0 +1,405 @@
+"""
+SPEAR Challenge
+
+Reproducible benchmark of the pipeline on a synthetic SPEAR tree, without the SPEAR download nor a TASCAR install.
+Input: size of the synthetic tree (datasets, sessions, minutes, talkers, noise files, duration) and run options.
+Output: a JSON file with wall time, CPU time, peak RSS, /dev/shm high-water mark and files/s for each stage.
+
+The synthetic tree follows the layout of fct_PathFinder: TASCAR minutes with pos/ori csv and talker audio,
+session_modif.csv for datasets 3/4, AmbientNoise sets and a fmatconvol configuration (order hoa_order to
+the 6 channels of the array). Stand-in executables are written in <dir>/bin and put first in the PATH:
+    tascar_renderfile: checks the scene exists in the tascar file and writes (order+1)^2 channels of noise
+                       (order of the HOA receiver of the file) or one channel per mic of a micarray receiver,
+                       in blocks (also into a fifo, cf fct_streaming)
+    fmatconvol:        writes the first nout channels of the HOA file, zero padded (nout read from the configuration)
+They have the output shapes and sizes of the real tools but not their cost: the benchmark measures the
+orchestration, the I/O and the in-process parts (numpy convolution, post processing, mixtures).
+
+Each stage runs in its own process so that its peak RSS (itself and its children, cf getrusage) and CPU
+time are not mixed with the other stages. /dev/shm is sampled by a thread of the parent.
+
+Stages (in this order, any subset):
+    precondition: SPEAR_precondition (cf fct_precondition)
+    catalog:      SPEAR_catalogScan (cf fct_catalog)
+    scene_gen:    SPEAR_tascarSceneGenBatch (cf fct_scheduler)
+    run:          SPEAR_tascarSceneRunParallel (cf fct_scheduler)
+    mixture:      SPEAR_mixture (cf fct_mixture)
+
+- bench_tree: Build the synthetic SPEAR tree.
+- bench_stubs: Write the stand-in tascar_renderfile and fmatconvol.
+- bench_stage: Run a stage in its own process and measure it.
+- SPEAR_benchmark: Build the tree, run the stages and write the results.
+- SPEAR_benchmarkCompare: Compare two result files stage by stage.
+
+Command line:
+    python fct_benchmark.py --dir /tmp/spear_bench --sessions 1 2 --minutes 3 --duration 10 --workers 4 --out bench.json
+    python fct_benchmark.py --compare bench_old.json bench.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import stat
+import shutil
+import socket
+import resource
+import argparse
+import platform
+import threading
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+import soundfile as sf
+from pathlib import PurePath
+from fct_PathFinder import PathFinder
+from fct_tascarScene import hoa_order, fs_out, ls_level_plus, source_lvl
+
+
+###### Global Parameters
+n_mics = 6 # channels of the array
+filter_length = 256 # samples of the synthetic HOA -> array filters
+dir_shm = '/dev/shm'
+shm_period = 0.02 # seconds between two samples of /dev/shm
+stages_all = ['precondition', 'catalog', 'scene_gen', 'run', 'mixture']
+slower_tolerance = 0.1 # relative increase of the wall time reported as a regression
+
+
+### Trajectory csv of a talker (time, x, y, z) and orientation (time, rz, ry, rx), 10 rows per second
+def _trajectory(rng, duration, center):
+    t = np.arange(0, duration, 0.1)
+    pos = center + np.cumsum(rng.normal(0, 0.01, (len(t), 3)), axis=0)
+    ori = np.cumsum(rng.normal(0, 1, (len(t), 3)), axis=0)
+    return np.column_stack([t, pos]), np.column_stack([t, ori])
+
+
+### Build the synthetic SPEAR tree
+def bench_tree(path_root, datasets=[2], sessions=[1], minutes=3, talkers=3, noise_files=6, duration=60, fs_audio=48000, seed=0):
+    rng = np.random.default_rng(seed)
+    n_frames = int(duration*fs_audio)
+
+    for dataset_n in datasets:
+        for session_n in sessions:
+            path_session = PathFinder(dataset_n, session_n, 'Tascar', path_spear=path_root)
+            rows = []
+            for minute_n in range(1, minutes+1):
+                minute = f'{minute_n:02d}'
+                path_minute = PurePath(path_session, minute)
+                os.makedirs(path_minute, exist_ok=True)
+                os.makedirs(PurePath(PathFinder(dataset_n, session_n, 'reference', path_spear=path_root), minute), exist_ok=True)
+                ### ID2 wears the array, the others talk
+                for idd in [2] + list(range(3, 3+talkers)):
+                    pos, ori = _trajectory(rng, duration, np.array([rng.uniform(-1, 1), rng.uniform(-1, 1), 1.2]))
+                    np.savetxt(PurePath(path_minute, f'pos_ID{idd}.csv'), pos, delimiter=',', fmt='%.4f')
+                    np.savetxt(PurePath(path_minute, f'ori_ID{idd}.csv'), ori, delimiter=',', fmt='%.4f')
+                    if idd != 2:
+                        audio = 0.1*rng.standard_normal(n_frames).astype(np.float32)
+                        sf.write(str(PurePath(path_minute, f'audio_ID{idd}.wav')), audio, fs_audio, subtype='PCM_16')
+                ### Room of the minute (datasets 3/4, cf fct_sceneParams)
+                n_ls = int(rng.integers(4, 11))
+                room = np.round(rng.uniform([5, 5, 2.5], [9, 9, 4]), 2)
+                center = np.array([0.5, -0.9, round(room[2]/2, 2)])
+                ### Loudspeakers in world coordinates (cf param_lookup), 0.5m from the walls of the room centered on center
+                ls = rng.uniform(center[0:2] - (room[0:2]/2-0.5), center[0:2] + (room[0:2]/2-0.5), (n_ls, 2))
+                rows.append([minute_n, 0, *room, *center, 0.6, 0.3,
+                             str([float(source_lvl+ls_level_plus)]*n_ls),
+                             str(np.round(ls[:, 0], 2).tolist()),
+                             str(np.round(ls[:, 1], 2).tolist()),
+                             str(np.round(rng.uniform(0.5, 2, n_ls), 2).tolist())])
+            if dataset_n > 2:
+                columns = ['minute', 't_scattering', 'room_x', 'room_y', 'room_z', 'center_x', 'center_y', 'center_z',
+                           'absorption', 'damping', 'ls_levels', 'ls_x_all', 'ls_y_all', 'ls_z_all']
+                pd.DataFrame(rows, columns=columns).to_csv(PurePath(path_session, 'session_modif.csv'), index=False)
+
+    ### Ambient noise of all the sets
+    for set_n in ['Train', 'Dev', 'Eval']:
+        path_set = PurePath(PathFinder(0, 0, 'noise', path_spear=path_root), set_n)
+        os.makedirs(path_set, exist_ok=True)
+        for n in range(noise_files):
+            sf.write(str(PurePath(path_set, f'noise_{n}.wav')), 0.1*rng.standard_normal(n_frames).astype(np.float32), fs_audio, subtype='PCM_16')
+
+    ### fmatconvol configuration: one filter per (HOA channel, microphone), one weight file per microphone
+    path_hoa = PathFinder(0, 0, 'hoa', path_spear=path_root)
+    os.makedirs(path_hoa, exist_ok=True)
+    n_hoa = (hoa_order+1)**2
+    lines = [f'/convolver/new {n_hoa} {n_mics} {filter_length}']
+    for mic in range(n_mics):
+        weights = rng.standard_normal((filter_length, n_hoa)) * np.exp(-np.arange(filter_length)/32)[:, None] / n_hoa
+        sf.write(str(PurePath(path_hoa, f'weights_mic{mic+1}.wav')), weights.astype(np.float32), fs_out, subtype='FLOAT')
+        lines += [f'/impulse/read {inp+1} {mic+1} 1 0 0 {filter_length} {inp+1} weights_mic{mic+1}.wav' for inp in range(n_hoa)]
+    with open(PurePath(path_hoa, f'fmat_hoa{hoa_order}.conf'), 'w') as fout:
+        fout.write('\n'.join(lines) + '\n')
+
+    return path_root
+
+
+stub_tascar = '''#!{python}
+import re
+import sys
+import numpy as np
+import soundfile as sf
+args = sys.argv[1:]
+scene, file_out, fs = args[args.index('--scene')+1], args[args.index('-o')+1], int(args[args.index('-r')+1])
+with open(args[-1]) as fin:
+    text = fin.read()
+if 'name="%s"' % scene not in text:
+    sys.exit('scene %s not found in %s' % (scene, args[-1]))
+orders = re.findall(r'order="(\d+)" type="hoa3d_enc"', text)
+channels = (int(orders[0])+1)**2 if orders else {channels}
+if 'type="micarray"' in text:
+    channels = text.count('<mic position=')
+rngs = [np.random.default_rng(c) for c in range(channels)] # the channels of a lower order are the first ones of a higher order
+with sf.SoundFile(file_out, 'w', samplerate=fs, channels=channels, subtype='FLOAT') as fout:
+    for start in range(0, int({duration}*fs), fs):
+        n = min(fs, int({duration}*fs)-start)
+        fout.write(0.01*np.stack([rng.standard_normal(n, dtype=np.float32) for rng in rngs], axis=1))
+'''
+
+stub_fmatconvol = '''#!{python}
+import sys
+import numpy as np
+import soundfile as sf
+path_conf, file_in, file_out = sys.argv[1:4]
+nout = next(int(line.split()[2]) for line in open(path_conf) if line.split() and line.split()[0].endswith('/new'))
+with sf.SoundFile(file_in) as fin, sf.SoundFile(file_out, 'w', samplerate=fin.samplerate, channels=nout, subtype='FLOAT') as fout:
+    for block in fin.blocks(blocksize=2**15, dtype='float32', always_2d=True):
+        out = np.zeros((len(block), nout), dtype=np.float32)
+        out[:, :min(nout, block.shape[1])] = block[:, :nout]
+        fout.write(out)
+'''
+
+
+### Write the stand-in tascar_renderfile and fmatconvol in dir_bin
+def bench_stubs(dir_bin, duration=60):
+    os.makedirs(dir_bin, exist_ok=True)
+    for name, text in [('tascar_renderfile', stub_tascar), ('fmatconvol', stub_fmatconvol)]:
+        path_stub = os.path.join(dir_bin, name)
+        with open(path_stub, 'w') as fout:
+            fout.write(text.format(python=sys.executable, channels=(hoa_order+1)**2, duration=duration))
+        os.chmod(path_stub, os.stat(path_stub).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return dir_bin
+
+
+### Function of a stage
+def _stageFunction(stage, path_spear, config):
+    datasets, sessions, n_workers = config['datasets'], config['sessions'], config['workers']
+    if stage == 'precondition':
+        from fct_precondition import SPEAR_precondition
+        return lambda: SPEAR_precondition(datasets, sessions, path_spear, n_workers=n_workers)
+    if stage == 'catalog':
+        from fct_catalog import SPEAR_catalogScan
+        return lambda: SPEAR_catalogScan(path_spear, datasets=datasets, sessions=sessions)
+    if stage == 'scene_gen':
+        from fct_scheduler import SPEAR_tascarSceneGenBatch
+        return lambda: SPEAR_tascarSceneGenBatch(datasets, sessions, path_spear, n_workers=n_workers, seed=config['seed'],
+                                                 catalog=config['catalog'], precondition=config['precondition'])
+    if stage == 'run':
+        from fct_scheduler import SPEAR_tascarSceneRunParallel
+        return lambda: SPEAR_tascarSceneRunParallel(datasets, sessions, path_spear, n_workers=n_workers, convolver=config['convolver'],
+                                                    superposition=config['superposition'], catalog=config['catalog'],
+                                                    output_format=config['output_format'])
+    if stage == 'mixture':
+        from fct_mixture import SPEAR_mixture
+        ### The catalog was scanned before the run stage, it does not know the new outputs
+        return lambda: SPEAR_mixture(datasets, sessions, path_spear, config['snrs'], n_workers=n_workers,
+                                     file_format=config['output_format'])
+    raise ValueError(f'Unknown stage {stage}, valid stages are {stages_all}')
+
+
+### Process of a stage: run it and send back its resource usage (and the one of its children)
+def _stageProcess(stage, path_spear, config, conn):
+    try:
+        _stageFunction(stage, path_spear, config)()
+        error = None
+    except Exception as e:
+        error = repr(e)
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    conn.send({'error': error,
+               'cpu_s': usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime,
+               'peak_rss_mb': max(usage_self.ru_maxrss, usage_children.ru_maxrss)/1024, # kB on Linux
+               })
+    conn.close()
+
+
+### Files of the tree written since t_start_ns (count and bytes)
+def _filesWritten(path_spear, t_start_ns):
+    n_files, n_bytes = 0, 0
+    for root, dirs, files in os.walk(PurePath(path_spear, 'SPEAR')):
+        for name in files:
+            st = os.stat(os.path.join(root, name))
+            if st.st_mtime_ns >= t_start_ns:
+                n_files += 1
+                n_bytes += st.st_size
+    return n_files, n_bytes
+
+
+### Run a stage in its own process and measure it
+def bench_stage(stage, path_spear, config):
+    ctx = multiprocessing.get_context('fork')
+    conn_parent, conn_child = ctx.Pipe(duplex=False)
+
+    ### /dev/shm high-water mark, sampled while the stage runs
+    shm = {'base': None, 'peak': 0}
+    stop = threading.Event()
+    def _sampleShm():
+        while not stop.wait(shm_period):
+            used = shutil.disk_usage(dir_shm).used
+            shm['peak'] = max(shm['peak'], used - shm['base'])
+    if os.path.isdir(dir_shm):
+        shm['base'] = shutil.disk_usage(dir_shm).used
+        thread = threading.Thread(target=_sampleShm, daemon=True)
+        thread.start()
+
+    t_start_ns = time.time_ns() - 1_000_000 # margin for the filesystem timestamp granularity
+    t0 = time.perf_counter()
+    process = ctx.Process(target=_stageProcess, args=(stage, path_spear, config, conn_child))
+    process.start()
+    conn_child.close()
+    usage = conn_parent.recv() if conn_parent.poll(None) else {}
+    process.join()
+    wall = time.perf_counter() - t0
+    stop.set()
+
+    n_files, n_bytes = _filesWritten(path_spear, t_start_ns)
+    result = {'wall_s': wall,
+              'cpu_s': usage.get('cpu_s'),
+              'peak_rss_mb': usage.get('peak_rss_mb'),
+              'shm_peak_mb': shm['peak']/2**20 if shm['base'] is not None else None,
+              'files': n_files,
+              'files_per_s': n_files/wall,
+              'mb_written': n_bytes/2**20,
+              'error': usage.get('error', f'stage process exited with {process.exitcode}'),
+              }
+    print(f'{stage:>12}: {wall:8.2f} s wall {result["cpu_s"] or 0:8.2f} s cpu {result["peak_rss_mb"] or 0:8.1f} MB rss '
+          f'{result["shm_peak_mb"] or 0:8.1f} MB shm {n_files:6d} files ({result["files_per_s"]:.1f}/s)'
+          + (f' FAILED {result["error"]}' if result['error'] else ''))
+    return result
+
+
+### Version of the code (git commit if available)
+def _version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+### Build the tree, run the stages and write the results
+def SPEAR_benchmark(path_bench,
+                    datasets=[2],
+                    sessions=[1],
+                    minutes=3,
+                    talkers=3,
+                    noise_files=6,
+                    duration=60,
+                    fs_audio=48000,
+                    stages=['scene_gen', 'run', 'mixture'],
+                    workers=None,
+                    convolver='fmatconvol',
+                    superposition=False,
+                    catalog=False,
+                    precondition=False,
+                    output_format='wav',
+                    snrs=[0, 5],
+                    seed=0,
+                    file_out=None,
+                    keep=False,
+                    ):
+
+    config = {'datasets': list(datasets), 'sessions': list(sessions), 'minutes': minutes, 'talkers': talkers,
+              'noise_files': noise_files, 'duration': duration, 'fs_audio': fs_audio, 'stages': list(stages),
+              'workers': workers or os.cpu_count(), 'convolver': convolver, 'superposition': superposition,
+              'catalog': catalog, 'precondition': precondition, 'output_format': output_format, 'snrs': list(snrs), 'seed': seed, 'hoa_order': hoa_order}
+    if catalog and 'catalog' not in stages:
+        raise ValueError('catalog=True needs the catalog stage')
+
+    if os.path.exists(PurePath(path_bench, 'SPEAR')):
+        shutil.rmtree(PurePath(path_bench, 'SPEAR'))
+    t0 = time.perf_counter()
+    bench_tree(path_bench, datasets, sessions, minutes, talkers, noise_files, duration, fs_audio, seed)
+    dir_bin = bench_stubs(os.path.join(path_bench, 'bin'), duration)
+    print(f'Synthetic SPEAR tree built in {time.perf_counter()-t0:.1f} s in {path_bench}')
+
+    path_env = os.environ.get('PATH', '')
+    os.environ['PATH'] = dir_bin + os.pathsep + path_env
+    results = {}
+    try:
+        for stage in [s for s in stages_all if s in stages]:
+            results[stage] = bench_stage(stage, path_bench, config)
+    finally:
+        os.environ['PATH'] = path_env
+        if not keep:
+            shutil.rmtree(PurePath(path_bench, 'SPEAR'))
+
+    report = {'version': _version(),
+              'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'host': socket.gethostname(),
+              'cpus': os.cpu_count(),
+              'python': platform.python_version(),
+              'config': config,
+              'stages': results,
+              }
+    if file_out is not None:
+        with open(file_out, 'w') as fout:
+            json.dump(report, fout, indent=1)
+        print(f'Results written in {file_out}')
+    return report
+
+
+### Compare two result files stage by stage (wall time, files/s, peak RSS)
+def SPEAR_benchmarkCompare(file_ref, file_new):
+    with open(file_ref) as fin:
+        ref = json.load(fin)
+    with open(file_new) as fin:
+        new = json.load(fin)
+    if ref['config'] != new['config']:
+        print('Warning: the two benchmarks were run with different configurations')
+
+    regressions = []
+    print(f'{"stage":>12} {"wall ref":>10} {"wall new":>10} {"ratio":>7} {"rss ref":>9} {"rss new":>9}   ({ref["version"]} -> {new["version"]})')
+    for stage in [s for s in stages_all if s in ref['stages'] and s in new['stages']]:
+        r, n = ref['stages'][stage], new['stages'][stage]
+        ratio = n['wall_s']/r['wall_s']
+        flag = ' SLOWER' if ratio > 1+slower_tolerance else ''
+        if flag:
+            regressions.append(stage)
+        print(f'{stage:>12} {r["wall_s"]:10.2f} {n["wall_s"]:10.2f} {ratio:7.2f} {r["peak_rss_mb"] or 0:9.1f} {n["peak_rss_mb"] or 0:9.1f}{flag}')
+    return regressions
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark of the SPEAR pipeline on a synthetic tree with stand-in renderers.')
+    parser.add_argument('--dir', default='/tmp/spear_bench', help='folder of the synthetic SPEAR tree')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2])
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1])
+    parser.add_argument('--minutes', type=int, default=3)
+    parser.add_argument('--talkers', type=int, default=3, help='talkers besides the array wearer (at most 5)')
+    parser.add_argument('--noise', type=int, default=6, help='noise files per set')
+    parser.add_argument('--duration', type=float, default=60, help='seconds of audio per minute')
+    parser.add_argument('--fs_audio', type=int, default=48000, help='sampling rate of the talker audio and noise')
+    parser.add_argument('--stages', nargs='+', default=['scene_gen', 'run', 'mixture'], choices=stages_all)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--convolver', default='fmatconvol', choices=['fmatconvol', 'numpy', 'stream'])
+    parser.add_argument('--superposition', action='store_true')
+    parser.add_argument('--catalog', action='store_true')
+    parser.add_argument('--precondition', action='store_true')
+    parser.add_argument('--format', default='wav', choices=['wav', 'flac'], help='container of the outputs (cf fct_outputFormat)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='JSON file of the results')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic tree')
+    parser.add_argument('--compare', nargs=2, metavar=('REF', 'NEW'), help='compare two result files instead of running')
+    args = parser.parse_args()
+
+    if args.compare:
+        SPEAR_benchmarkCompare(*args.compare)
+    else:
+        SPEAR_benchmark(args.dir, datasets=args.datasets, sessions=args.sessions, minutes=args.minutes, talkers=args.talkers,
+                        noise_files=args.noise, duration=args.duration, fs_audio=args.fs_audio, stages=args.stages,
+                        workers=args.workers, convolver=args.convolver, superposition=args.superposition,
+                        catalog=args.catalog, precondition=args.precondition, output_format=args.format, seed=args.seed, file_out=args.out, keep=args.keep)
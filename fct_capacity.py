@@ -0,0 +1,249 @@
+"""
+SPEAR Challenge
+
+Capacity planner: dry run of the scene generation and of the tascar runs.
+Input: datasets, sessions, spear path, run options (workers, convolver, superposition, HOA order, output format)
+       and optionally the events of previous runs (cf fct_instrumentation) for the timings.
+Output: the job graph with the jobs already done, and the predicted CPU-hours, wall time, peak /dev/shm
+        and output bytes of what is left to run (nothing is rendered nor written).
+
+The job graph is the one of the runs (tascar_jobList through SPEAR_jobExpand): minutes of the TASCAR tree,
+talker IDs from the pos*.csv files, and the expansion of sounds_all/sources_all/ID_scenes_all, with the
+sum jobs and their dependencies in superposition mode. A job is done when its array file exists, or
+with render_cache=True when its cache entry is valid (cf fct_renderCache).
+
+Timings: median wall and CPU time (worker + external tools) of each stage of each kind of job
+(full_All, full_Ls, full_ID, ref_ID) in the events, the median of the stage over all kinds when a kind
+has no events. Without events the times are not predicted (None), the sizes still are.
+Wall time: the jobs left are list-scheduled on n_workers in the order and with the dependencies of
+SPEAR_tascarSceneRunParallel. The peak /dev/shm is the largest number of HOA temp files of this
+schedule at the same time (none with convolver='stream'), capped by the free tmpfs (the rest is staged
+on disk, reported apart).
+Output bytes: (frames x channels x bytes per sample) of the array and reference files; for flac this
+is the 24 bit upper bound.
+
+- plan_calibrate: Median wall and CPU time per (kind of job, stage) from the events of previous runs.
+- plan_jobs: Job graph of datasets/sessions with the jobs already done.
+- plan_schedule: List scheduling of the jobs on n_workers (wall time and peak number of HOA files).
+- SPEAR_runPlan: Dry run of the tascar runs (cf dry_run of SPEAR_tascarSceneRun and SPEAR_tascarSceneRunParallel).
+- SPEAR_genPlan: Dry run of the scene generation (cf dry_run of SPEAR_tascarSceneGen).
+
+Command line:
+    python fct_capacity.py --path_spear /SPEAR-dir --datasets 2 3 4 --workers 32 --events /SPEAR-dir/SPEAR/Miscellaneous/RunEvents
+
+"""
+
+import os
+import re
+import json
+import heapq
+import shutil
+import argparse
+import numpy as np
+from pathlib import PurePath
+from fct_PathFinder import PathFinder
+from fct_convolution import conv_parseConf
+from fct_tascarScene import tascar_jobKey, tascar_fmatconvConf, tascar_renderSettings, tascar_minutes, hoa_order, fs_out
+from fct_scheduler import SPEAR_jobExpand, hoa_tmpSize, dir_shm, shm_margin
+from fct_renderCache import cache_key, cache_isValid
+from fct_instrumentation import instr_load
+
+
+###### Global Parameters
+ref_channels = 2
+bytes_sample = {'wav': 4, 'flac': 3} # PCM_32, FLAC 24 bit (upper bound)
+stages_job = {'fmatconvol': ['render', 'convolve', 'postprocess'],
+              'numpy':      ['render', 'convolve', 'postprocess'],
+              'stream':     ['stream', 'postprocess'],
+              'sum':        ['sum']}
+
+
+### Kind of a job: full_All, full_Ls, full_ID, ref_ID
+def plan_kind(sound, source):
+    return f'{sound}_{source}'
+
+
+### Median wall and CPU time per (kind of job, stage) from the events of previous runs
+def plan_calibrate(dir_events):
+    samples = {}
+    for e in instr_load(dir_events):
+        if e['stage'] == 'job' or e['error'] is not None or e.get('exit_status') not in (None, 0):
+            continue
+        sound, source = e['job'].split('_')[3:5]
+        key = (plan_kind(sound, re.sub(r'\d+$', '', source)), e['stage'])
+        samples.setdefault(key, []).append((e['wall_s'], e['cpu_s'] + e['cpu_children_s']))
+
+    timings = {key: {'wall_s': float(np.median([s[0] for s in v])), 'cpu_s': float(np.median([s[1] for s in v])), 'n': len(v)}
+               for key, v in samples.items()}
+    for stage in {stage for _, stage in samples}:
+        v = [s for (_, st), ss in samples.items() if st == stage for s in ss]
+        timings[('*', stage)] = {'wall_s': float(np.median([s[0] for s in v])), 'cpu_s': float(np.median([s[1] for s in v])), 'n': len(v)}
+    return timings
+
+
+### Predicted (wall, cpu) seconds of a job, None without timings of its stages
+def _jobTime(job, convolver, timings):
+    stages = stages_job['sum'] if job.get('sum_of') else stages_job[convolver]
+    wall = cpu = 0
+    for stage in stages:
+        t = timings.get((plan_kind(job['sound'], job['source']), stage), timings.get(('*', stage)))
+        if t is None:
+            return None, None
+        wall, cpu = wall + t['wall_s'], cpu + t['cpu_s']
+    return wall, cpu
+
+
+### Job graph of datasets/sessions, each job with its 'done' flag
+def plan_jobs(datasets, sessions, path_spear, superposition=False, catalog=False, render_cache=False, convolver='fmatconvol',
+              output_format='wav', hoa_order=hoa_order, path_fmatconv=None):
+    jobs = SPEAR_jobExpand(datasets, sessions, path_spear, superposition=superposition, catalog=catalog)
+    settings = tascar_renderSettings(convolver, output_format, hoa_order)
+    todo = set()
+    for job in jobs:
+        array_name = f'array_{job["sound"]}_{job["source"]}{job["idd"]}'
+        if render_cache:
+            ### A sum job runs again when one of its inputs does
+            if job.get('sum_of') and todo.intersection(job.get('after', [])):
+                done = False
+            else:
+                done = cache_isValid(job['path_out'], array_name, cache_key(job, path_fmatconv, settings))
+        else:
+            done = os.path.exists(PurePath(job['path_out'], f'{array_name}.{output_format}'))
+        job['done'] = done
+        if not done:
+            todo.add(tascar_jobKey(job))
+    return jobs
+
+
+### List scheduling of the jobs on n_workers, in order and with their dependencies (cf SPEAR_tascarSceneRunParallel)
+### Returns the wall time and the largest number of jobs holding a HOA temp file at the same time
+def plan_schedule(jobs, walls, n_workers, hoa_file=True):
+    pending = {tascar_jobKey(job) for job in jobs}
+    todo = list(range(len(jobs)))
+    running = [] # heap of (end, n)
+    now, hoa_now, hoa_peak = 0.0, 0, 0
+    while todo or running:
+        while len(running) < n_workers:
+            ready = next((i for i, n in enumerate(todo) if not pending.intersection(jobs[n].get('after', []))), None)
+            if ready is None:
+                break
+            n = todo.pop(ready)
+            heapq.heappush(running, (now + walls[n], n))
+            if hoa_file and not jobs[n].get('sum_of'):
+                hoa_now += 1
+                hoa_peak = max(hoa_peak, hoa_now)
+        now, n = heapq.heappop(running)
+        pending.discard(tascar_jobKey(jobs[n]))
+        if hoa_file and not jobs[n].get('sum_of'):
+            hoa_now -= 1
+    return now, hoa_peak
+
+
+### Dry run of the tascar runs: job graph and predicted resources of the jobs left
+def SPEAR_runPlan(datasets, sessions, path_spear, n_workers=1, convolver='fmatconvol', superposition=False, render_cache=False,
+                  catalog=False, output_format='wav', hoa_order=hoa_order, events=None, fmatconv=True):
+
+    path_fmatconv = tascar_fmatconvConf(path_spear, hoa_order)
+    jobs = plan_jobs(datasets, sessions, path_spear, superposition=superposition, catalog=catalog, render_cache=render_cache,
+                     convolver=convolver, output_format=output_format, hoa_order=hoa_order,
+                     path_fmatconv=path_fmatconv if fmatconv else None)
+    if not fmatconv:
+        jobs = [job for job in jobs if not job.get('sum_of')]
+    jobs_todo = [job for job in jobs if not job['done']]
+    ### Dependencies on jobs already done are met
+    keys_todo = {tascar_jobKey(job) for job in jobs_todo}
+    jobs_todo = [dict(job, after=[k for k in job.get('after', []) if k in keys_todo]) for job in jobs_todo]
+
+    ### Job graph per kind
+    kinds = {}
+    for job in jobs:
+        kind = 'sum' if job.get('sum_of') else plan_kind(job['sound'], job['source'])
+        entry = kinds.setdefault(kind, {'jobs': 0, 'done': 0})
+        entry['jobs'] += 1
+        entry['done'] += job['done']
+
+    ### Output bytes (array files, plus the reference of the ref jobs)
+    n_mics = conv_parseConf(str(path_fmatconv))['nout']
+    frames = fs_out*60
+    size_job = lambda job: frames*bytes_sample[output_format]*(n_mics + (ref_channels if job['sound'] == 'ref' else 0))
+    output_bytes = sum(size_job(job) for job in jobs_todo)
+
+    ### Timings from the events of previous runs
+    timings = plan_calibrate(events) if events is not None and os.path.isdir(events) else {}
+    times = [_jobTime(job, convolver, timings) for job in jobs_todo]
+    calibrated = all(wall is not None for wall, _ in times)
+    hoa_file = convolver != 'stream' and fmatconv
+    if calibrated:
+        wall_s, hoa_peak = plan_schedule(jobs_todo, [wall for wall, _ in times], n_workers, hoa_file)
+        cpu_h = sum(cpu for _, cpu in times)/3600
+    else:
+        ### Without timings, every job is given the same duration for the peak of HOA files
+        wall_s, cpu_h = None, None
+        _, hoa_peak = plan_schedule(jobs_todo, [1.0]*len(jobs_todo), n_workers, hoa_file)
+
+    ### /dev/shm: HOA files in tmpfs up to its free space, the others staged on disk
+    shm_free = int(shutil.disk_usage(dir_shm).free*(1-shm_margin)) if os.path.isdir(dir_shm) else 0
+    hoa_bytes = hoa_tmpSize(hoa_order)
+    shm_peak = min(hoa_peak, shm_free//hoa_bytes)*hoa_bytes
+    disk_hoa_peak = hoa_peak*hoa_bytes - shm_peak
+
+    plan = {'jobs': len(jobs), 'jobs_done': len(jobs)-len(jobs_todo), 'jobs_todo': len(jobs_todo), 'kinds': kinds,
+            'n_workers': n_workers, 'convolver': convolver, 'hoa_order': hoa_order, 'output_format': output_format,
+            'calibrated': calibrated, 'cpu_hours': cpu_h, 'wall_hours': wall_s/3600 if wall_s is not None else None,
+            'shm_peak_gb': shm_peak/1e9, 'shm_free_gb': shm_free/1e9, 'disk_hoa_peak_gb': disk_hoa_peak/1e9,
+            'output_gb': output_bytes/1e9,
+            'timings': {f'{kind}/{stage}': t for (kind, stage), t in sorted(timings.items())}}
+
+    print(f'{plan["jobs"]} jobs, {plan["jobs_done"]} already done, {plan["jobs_todo"]} to run on {n_workers} workers')
+    for kind, entry in sorted(kinds.items()):
+        print(f'    {kind:>8}: {entry["jobs"]:>6} jobs, {entry["done"]:>6} done')
+    print(f'Output: {plan["output_gb"]:.2f} GB ({output_format}), /dev/shm peak: {plan["shm_peak_gb"]:.2f} GB of {plan["shm_free_gb"]:.2f} GB'
+          + (f', HOA staged on disk: {plan["disk_hoa_peak_gb"]:.2f} GB' if disk_hoa_peak else ''))
+    if calibrated:
+        print(f'CPU: {cpu_h:.1f} h, wall time: {plan["wall_hours"]:.2f} h')
+    else:
+        print('CPU and wall time not predicted: no events with the timings of all the stages (cf fct_instrumentation)')
+    return plan
+
+
+### Dry run of the scene generation: minutes to generate and the ones already generated
+def SPEAR_genPlan(datasets, sessions, path_spear, catalog=False):
+    plan = {'minutes': 0, 'generated': 0, 'sessions': {}}
+    for dataset_n in datasets:
+        if dataset_n == 1:
+            continue
+        for session_n in sessions:
+            path_session = PathFinder(dataset_n, session_n, 'Tascar', path_spear=path_spear)
+            minutes = tascar_minutes(dataset_n, session_n, path_spear, catalog=catalog)
+            generated = sum(os.path.exists(PurePath(path_session, minute, 'Tascar_scenes.tsc')) for minute in minutes)
+            plan['sessions'][f'D{dataset_n}_S{session_n}'] = {'minutes': len(minutes), 'generated': generated}
+            plan['minutes'] += len(minutes)
+            plan['generated'] += generated
+    print(f'{plan["minutes"]} minutes to generate ({plan["generated"]} already have a scene file, written again)')
+    return plan
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Dry run of the SPEAR tascar runs: jobs left and predicted resources.')
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--convolver', default='fmatconvol', choices=['fmatconvol', 'numpy', 'stream'])
+    parser.add_argument('--superposition', action='store_true')
+    parser.add_argument('--render_cache', action='store_true')
+    parser.add_argument('--catalog', action='store_true', help='list the jobs from the catalog (cf fct_catalog)')
+    parser.add_argument('--format', default='wav', choices=['wav', 'flac'])
+    parser.add_argument('--order', type=int, default=hoa_order, help='HOA order of the renders')
+    parser.add_argument('--events', default=None, help='folder of the events of previous runs (timings)')
+    parser.add_argument('--json', default=None, help='also write the plan in this file')
+    args = parser.parse_args()
+
+    plan = SPEAR_runPlan(args.datasets, args.sessions, args.path_spear, n_workers=args.workers, convolver=args.convolver,
+                         superposition=args.superposition, render_cache=args.render_cache, catalog=args.catalog,
+                         output_format=args.format, hoa_order=args.order, events=args.events)
+    if args.json is not None:
+        with open(args.json, 'w') as fout:
+            json.dump(plan, fout, indent=1)
@@ -0,0 +1,256 @@
+"""
+SPEAR Challenge
+
+Indexed catalog of the SPEAR tree (SQLite database SPEAR/SPEAR_catalog.sqlite).
+Input: spear path (and optionally datasets/sessions to scan).
+Output: the catalog, queried by the scene generation, the runs and the other tools instead of the filesystem.
+
+The directories to scan come from the layout of fct_PathFinder:
+    TASCAR minutes:    pos_ID*.csv, ori_ID*.csv, audio_ID*.wav, Tascar_scenes*.tsc
+    Reference minutes: array_*.wav, ref_*.wav (and the mixtures), or .flac (cf fct_outputFormat)
+    AmbientNoise sets: noise .wav files
+Each file is recorded with its size and modification time, and the .wav files with their number of
+frames, sampling rate, channels and duration (read from the header).
+
+The rescan is incremental: a directory is listed again only when its modification time changed
+(adding, removing or renaming a file, e.g. the atomic writes of the runs, changes it), and the header
+of a file is read again only when its size or modification time changed. Files rewritten in place
+(same name, no rename) keep their old size until a full=True scan, which lists everything.
+
+The catalog is written by a single scan at a time (SQLite locks are not reliable on NFS) and opened
+read-only by the workers, once per process.
+
+- SPEAR_catalogScan: Build or update the catalog.
+- catalog_connect: Read-only connection to the catalog (one per process).
+- catalog_minutes: Minutes of a dataset/session.
+- catalog_talkers: IDs of the position files of a minute.
+- catalog_noiseFiles: Noise files of a set.
+- catalog_outputs: Array and reference outputs of a minute, with their size and duration.
+- SPEAR_catalogSummary: Number of minutes, files and hours of audio per dataset.
+
+Command line:
+    python fct_catalog.py scan    --path_spear /SPEAR-dir [--full]
+    python fct_catalog.py summary --path_spear /SPEAR-dir
+
+"""
+
+import os
+import sqlite3
+import argparse
+import soundfile as sf
+from pathlib import PurePath
+from fct_PathFinder import PathFinder, layout
+
+
+###### Global Parameters
+name_catalog = 'SPEAR_catalog.sqlite'
+sessions_all = range(1, 16)
+trees = ['Tascar', 'reference'] # minute folders of the catalog
+audio_outputs = ('.wav', '.flac') # containers of the array, reference and mixture files
+_connections = {}
+
+schema = """
+CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, mtime_ns INTEGER);
+CREATE TABLE IF NOT EXISTS minutes (dataset INTEGER, session INTEGER, minute TEXT, tree TEXT, path TEXT,
+                                    PRIMARY KEY (dataset, session, minute, tree));
+CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, dir TEXT, name TEXT, kind TEXT,
+                                  dataset INTEGER, session INTEGER, minute TEXT, talker INTEGER,
+                                  size INTEGER, mtime_ns INTEGER,
+                                  frames INTEGER, samplerate INTEGER, channels INTEGER, duration REAL);
+CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+CREATE INDEX IF NOT EXISTS files_minute ON files (dataset, session, minute, kind);
+"""
+
+
+### Path of the catalog
+def catalog_path(path_spear):
+    return PurePath(path_spear, 'SPEAR', name_catalog)
+
+
+### Kind of a file (and talker ID for the per-talker files), from its name
+def catalog_kind(name, tree):
+    stem, ext = os.path.splitext(name)
+    if tree == 'noise':
+        return ('noise', None) if ext == '.wav' else ('other', None)
+    if stem.startswith('pos') and ext == '.csv':
+        return 'pos', int(stem[-1])
+    if stem.startswith('ori') and ext == '.csv':
+        return 'ori', int(stem[-1])
+    if stem.startswith('audio') and ext == '.wav':
+        return 'audio', int(stem[-1])
+    if stem.startswith('Tascar_scenes') and ext == '.tsc':
+        return 'scene', None
+    if stem.startswith('array_') and ext in audio_outputs:
+        return 'array', None
+    if stem.startswith('ref_') and ext in audio_outputs:
+        return 'ref', None
+    if stem.startswith('mix_') and ext in audio_outputs:
+        return 'mix', None
+    return 'other', None
+
+
+### Update the files of a directory (listed again only if its modification time changed)
+### Returns the subdirectories, None if the directory did not change, and the number of files (re)read
+def _scanDir(db, path_dir, tree, dataset_n=None, session_n=None, minute=None, full=False):
+    path_dir = str(path_dir)
+    try:
+        mtime_dir = os.stat(path_dir).st_mtime_ns
+    except FileNotFoundError:
+        db.execute('DELETE FROM files WHERE dir=?', (path_dir,))
+        db.execute('DELETE FROM dirs WHERE path=?', (path_dir,))
+        return [], 0
+
+    row = db.execute('SELECT mtime_ns FROM dirs WHERE path=?', (path_dir,)).fetchone()
+    if row is not None and row[0] == mtime_dir and not full:
+        return None, 0
+
+    known = {name: (size, mtime) for name, size, mtime in
+             db.execute('SELECT name, size, mtime_ns FROM files WHERE dir=?', (path_dir,))}
+    subdirs, names, n_read = [], set(), 0
+    with os.scandir(path_dir) as entries:
+        for entry in entries:
+            if entry.name[0] == '.':
+                continue
+            if entry.is_dir():
+                subdirs.append(entry.name)
+                continue
+            names.add(entry.name)
+            stat = entry.stat()
+            if known.get(entry.name) == (stat.st_size, stat.st_mtime_ns) and not full:
+                continue
+            kind, talker = catalog_kind(entry.name, tree)
+            frames = samplerate = channels = duration = None
+            if entry.name.endswith(('.wav', '.flac')):
+                try:
+                    info = sf.info(entry.path)
+                    frames, samplerate, channels, duration = info.frames, info.samplerate, info.channels, info.duration
+                except RuntimeError:
+                    pass # file being written, the header is read at the next scan
+            db.execute('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                       (entry.path, path_dir, entry.name, kind, dataset_n, session_n, minute, talker,
+                        stat.st_size, stat.st_mtime_ns, frames, samplerate, channels, duration))
+            n_read += 1
+
+    for name in set(known) - names:
+        db.execute('DELETE FROM files WHERE dir=? AND name=?', (path_dir, name))
+    db.execute('INSERT OR REPLACE INTO dirs VALUES (?,?)', (path_dir, mtime_dir))
+    return sorted(subdirs), n_read
+
+
+### Build or update the catalog
+def SPEAR_catalogScan(path_spear, datasets=None, sessions=None, full=False):
+    if sessions is None:
+        sessions = sessions_all
+
+    db = sqlite3.connect(str(catalog_path(path_spear)))
+    db.executescript(schema)
+    n_dirs, n_read = 0, 0
+    with db:
+        for tree in trees:
+            for dataset_n in layout[tree][3]:
+                if datasets is not None and dataset_n not in datasets:
+                    continue
+                for session_n in sessions:
+                    path_session = PathFinder(dataset_n, session_n, tree, path_spear=path_spear)
+                    minutes, n = _scanDir(db, path_session, tree, dataset_n, session_n, full=full)
+                    n_dirs, n_read = n_dirs+1, n_read+n
+                    if minutes is None:
+                        minutes = [m for (m,) in db.execute('SELECT minute FROM minutes WHERE dataset=? AND session=? AND tree=?',
+                                                            (dataset_n, session_n, tree))]
+                    else:
+                        ### Minutes removed since the last scan: forget their files
+                        for (path_old,) in db.execute('SELECT path FROM minutes WHERE dataset=? AND session=? AND tree=?',
+                                                      (dataset_n, session_n, tree)).fetchall():
+                            if PurePath(path_old).name not in minutes:
+                                _scanDir(db, path_old, tree)
+                        db.execute('DELETE FROM minutes WHERE dataset=? AND session=? AND tree=?', (dataset_n, session_n, tree))
+                        for minute in minutes:
+                            db.execute('INSERT INTO minutes VALUES (?,?,?,?,?)',
+                                       (dataset_n, session_n, minute, tree, str(PurePath(path_session, minute))))
+                    for minute in minutes:
+                        _, n = _scanDir(db, PurePath(path_session, minute), tree, dataset_n, session_n, minute, full=full)
+                        n_dirs, n_read = n_dirs+1, n_read+n
+
+        path_noise = PathFinder(0, 0, 'noise', path_spear=path_spear)
+        if os.path.isdir(path_noise):
+            for set_n in sorted(os.listdir(path_noise)):
+                if set_n[0] != '.' and os.path.isdir(PurePath(path_noise, set_n)):
+                    _, n = _scanDir(db, PurePath(path_noise, set_n), 'noise', full=full)
+                    n_dirs, n_read = n_dirs+1, n_read+n
+    db.close()
+
+    print(f'Catalog {catalog_path(path_spear)}: {n_dirs} directories checked, {n_read} files (re)read')
+    return n_read
+
+
+### Read-only connection to the catalog, one per process (connections cannot be shared after a fork)
+def catalog_connect(path_spear):
+    key = (os.getpid(), str(path_spear))
+    if key not in _connections:
+        path_db = catalog_path(path_spear)
+        if not os.path.exists(path_db):
+            raise FileNotFoundError(f'No catalog {path_db}, run SPEAR_catalogScan first.')
+        _connections[key] = sqlite3.connect(f'file:{path_db}?mode=ro', uri=True)
+    return _connections[key]
+
+
+### Minutes of a dataset/session (tree: 'Tascar' or 'reference')
+def catalog_minutes(dataset_n, session_n, path_spear, tree='Tascar'):
+    rows = catalog_connect(path_spear).execute('SELECT minute FROM minutes WHERE dataset=? AND session=? AND tree=? ORDER BY minute',
+                                               (dataset_n, session_n, tree))
+    return [minute for (minute,) in rows]
+
+
+### IDs of the position files of a minute (same as globbing pos*.csv)
+def catalog_talkers(dataset_n, session_n, minute, path_spear):
+    rows = catalog_connect(path_spear).execute("SELECT talker FROM files WHERE dataset=? AND session=? AND minute=? AND kind='pos' ORDER BY talker",
+                                               (dataset_n, session_n, minute))
+    return [talker for (talker,) in rows]
+
+
+### Noise files of a set ('Train', 'Dev' or 'Eval'), sorted
+def catalog_noiseFiles(set_n, path_spear):
+    path_set = str(PurePath(PathFinder(0, 0, 'noise', path_spear=path_spear), set_n))
+    rows = catalog_connect(path_spear).execute("SELECT path FROM files WHERE dir=? AND kind='noise' ORDER BY path", (path_set,))
+    return [PurePath(path) for (path,) in rows]
+
+
+### Array and reference outputs of a minute: {name: {'size', 'frames', 'duration'}}
+def catalog_outputs(dataset_n, session_n, minute, path_spear):
+    rows = catalog_connect(path_spear).execute("SELECT name, size, frames, duration FROM files WHERE dataset=? AND session=? AND minute=?"
+                                               " AND kind IN ('array', 'ref', 'mix')", (dataset_n, session_n, minute))
+    return {name: {'size': size, 'frames': frames, 'duration': duration} for name, size, frames, duration in rows}
+
+
+### Number of minutes, files and hours of audio per dataset
+def SPEAR_catalogSummary(path_spear):
+    db = catalog_connect(path_spear)
+    summary = {}
+    for dataset_n, tree, n_minutes in db.execute('SELECT dataset, tree, COUNT(*) FROM minutes GROUP BY dataset, tree'):
+        summary.setdefault(dataset_n, {})[f'minutes_{tree}'] = n_minutes
+    for dataset_n, kind, n_files, size, duration in db.execute('SELECT dataset, kind, COUNT(*), SUM(size), SUM(duration) FROM files'
+                                                               ' WHERE dataset IS NOT NULL GROUP BY dataset, kind'):
+        summary.setdefault(dataset_n, {})[kind] = {'files': n_files, 'GB': (size or 0)/1e9, 'hours': (duration or 0)/3600}
+
+    for dataset_n, count in sorted(summary.items()):
+        print(f'Dataset {dataset_n}: ' + ', '.join(f'{k} {v}' for k, v in count.items() if k.startswith('minutes')))
+        for kind, v in sorted((k, v) for k, v in count.items() if not k.startswith('minutes')):
+            print(f'    {kind:>6}: {v["files"]:>7} files {v["GB"]:9.2f} GB {v["hours"]:9.2f} h')
+    return summary
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Indexed catalog of the SPEAR tree.')
+    parser.add_argument('command', choices=['scan', 'summary'])
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=None)
+    parser.add_argument('--sessions', type=int, nargs='+', default=None)
+    parser.add_argument('--full', action='store_true', help='list all the directories and read all the headers again')
+    args = parser.parse_args()
+
+    if args.command == 'scan':
+        SPEAR_catalogScan(args.path_spear, datasets=args.datasets, sessions=args.sessions, full=args.full)
+    else:
+        SPEAR_catalogSummary(args.path_spear)
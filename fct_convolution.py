@@ -0,0 +1,296 @@
+"""
+SPEAR Challenge
+
+In-process HOA -> array convolution, replacing the fmatconvol subprocess.
+Input: the fmatconvol configuration (fmat*.conf) and HOA weight files of the SPEAR Miscellaneous folder.
+Output: the array .wav file, written in a single pass (already cut to 60s and in PCM_32).
+
+The engine is a uniformly-partitioned overlap-save convolution: the filters are cut in partitions of
+`partition` samples, and for each block of input all the ninp -> nout filters are applied at once as
+batched matrix products in the frequency domain (several blocks are processed per FFT call).
+
+Configuration commands understood (same files as fmatconvol/jconvolver, # for comments):
+    /cd <dir>                                               folder of the weight files
+    /<...>/new <ninp> <nout> <maxlen> [partition]           size of the matrix
+    /<...>/load <file>                                      multichannel file with all ninp*nout filters,
+                                                            channel inp*nout + out (0-based)
+    /impulse/read <inp> <out> <gain> <delay> <offset> <length> <chan> <file>   single filter, 1-based
+
+- conv_parseConf: Parse the commands of the fmatconvol configuration.
+- conv_confFiles: Weight files used by the configuration.
+- conv_readConf: Parse the fmatconvol configuration into a (length, ninp, nout) filter matrix.
+- conv_engine: Create the convolution engine (frequency domain partitions of the filters).
+- conv_reset: Empty the delay line of the engine before a new file.
+- conv_loadEngine: Engine of a configuration file (filter spectra computed once per process, own delay line).
+- conv_process: Convolve a block of input samples, keeping the engine state between calls.
+- SPEAR_hoaToArray: Convolve a HOA file into the array file in a single read/write pass.
+- SPEAR_hoaToArrays: Same for several arrays (configurations) at once, the HOA file is read once.
+- SPEAR_convolutionBenchmark: Compare with fmatconvol (numerical equivalence) and measure throughput.
+
+"""
+
+import os
+import time
+import shutil
+import tempfile
+from functools import lru_cache
+import numpy as np
+import soundfile as sf
+from pathlib import PurePath
+
+
+###### Global Parameters
+partition_default = 1024
+blocks_per_fft = 16 # number of partitions processed at once per batched FFT call
+fs_out = 48000
+
+
+### Parse the commands of the fmatconvol configuration
+def conv_parseConf(path_conf):
+
+    dir_conf = os.path.dirname(os.path.realpath(path_conf))
+    conf = {'ninp': None, 'nout': None, 'maxlen': None, 'partition': partition_default, 'loads': [], 'impulses': []}
+
+    with open(path_conf) as fin:
+        for line in fin:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            cmd, *args = line.split()
+            if cmd == '/cd':
+                dir_conf = os.path.join(dir_conf, ' '.join(args))
+            elif cmd.endswith('/new'):
+                conf['ninp'], conf['nout'], conf['maxlen'] = int(args[0]), int(args[1]), int(args[2])
+                if len(args) > 3:
+                    conf['partition'] = int(args[3])
+            elif cmd == '/impulse/read':
+                inp, out, gain, delay, offset, length, chan = args[:7]
+                conf['impulses'].append((int(inp)-1, int(out)-1, float(gain), int(delay), int(offset), int(length), int(chan)-1,
+                                         os.path.join(dir_conf, ' '.join(args[7:]))))
+            elif cmd.endswith('/load'):
+                conf['loads'].append(os.path.join(dir_conf, ' '.join(args)))
+
+    if conf['ninp'] is None:
+        raise ValueError(f'No /new command (inputs, outputs, length) in {path_conf}')
+
+    return conf
+
+
+### Weight files used by the fmatconvol configuration
+def conv_confFiles(path_conf):
+    conf = conv_parseConf(str(path_conf))
+    return sorted(set(conf['loads'] + [imp[-1] for imp in conf['impulses']]))
+
+
+### Parse the fmatconvol configuration into a (length, ninp, nout) filter matrix
+def conv_readConf(path_conf):
+
+    conf = conv_parseConf(path_conf)
+    ninp, nout, maxlen, partition = conf['ninp'], conf['nout'], conf['maxlen'], conf['partition']
+    loads, impulses = conf['loads'], conf['impulses']
+    fs = None
+
+    filters = np.zeros((maxlen, ninp, nout), dtype=np.float32)
+
+    for file_load in loads:
+        h, fs = sf.read(file_load, dtype='float32', always_2d=True)
+        if h.shape[1] != ninp*nout:
+            raise ValueError(f'{file_load} has {h.shape[1]} channels, {ninp}x{nout} expected')
+        length = min(maxlen, h.shape[0])
+        filters[:length] += h[:length].reshape(length, ninp, nout)
+
+    for inp, out, gain, delay, offset, length, chan, file_imp in impulses:
+        with sf.SoundFile(file_imp) as f:
+            fs = f.samplerate
+            f.seek(offset)
+            h = f.read(length if length > 0 else -1, dtype='float32', always_2d=True)[:, chan]
+        length = max(0, min(len(h), maxlen-delay))
+        filters[delay:delay+length, inp, out] += gain*h[:length]
+
+    return filters, partition, fs
+
+
+### Create the convolution engine: frequency domain partitions of the filters and empty delay line
+### fs: sampling rate of the filters, checked against the input files (None: not checked)
+def conv_engine(filters, partition=partition_default, fs=None):
+
+    length, ninp, nout = filters.shape
+    n_part = -(-length // partition)
+    h = np.zeros((n_part*partition, ninp, nout), dtype=np.float32)
+    h[:length] = filters
+    h = h.reshape(n_part, partition, ninp, nout)
+
+    # Each partition is zero padded to 2*partition (overlap-save)
+    H = np.fft.rfft(h, n=2*partition, axis=1).astype(np.complex64) # (n_part, partition+1, ninp, nout)
+
+    H.flags.writeable = False # shared by the engines of the same configuration (cf conv_loadEngine)
+
+    engine = {'H':         H,
+              'partition': partition,
+              'ninp':      ninp,
+              'nout':      nout,
+              'fs':        fs,
+              }
+    conv_reset(engine)
+    return engine
+
+
+### Empty the delay line of the engine (start of a new file)
+def conv_reset(engine):
+    P, ninp = engine['partition'], engine['ninp']
+    engine['x_prev'] = np.zeros((P, ninp), dtype=np.float32)
+    engine['X_hist'] = np.zeros((engine['H'].shape[0]-1, P+1, ninp), dtype=np.complex64) # spectra of the last input blocks
+    engine['rest']   = np.zeros((0, ninp), dtype=np.float32) # samples waiting for a full partition
+
+
+### Filter spectra of a configuration file (read-only), built once per process
+@lru_cache(maxsize=4)
+def _confEngine(path_conf):
+    filters, partition, fs_filt = conv_readConf(path_conf)
+    return conv_engine(filters, partition, fs=fs_filt)
+
+
+### Engine of a configuration file: the cached filter spectra with its own, empty delay line
+### (a stream never shares its state with another stream of the same configuration)
+def conv_loadEngine(path_conf):
+    engine = dict(_confEngine(path_conf))
+    conv_reset(engine)
+    return engine
+
+
+### Convolve a block of samples (any length), output has the same number of samples once flushed
+def conv_process(engine, x, flush=False):
+
+    P = engine['partition']
+    H = engine['H']
+    n_part = H.shape[0]
+
+    x = np.concatenate([engine['rest'], np.asarray(x, dtype=np.float32)])
+    n_blocks = len(x) // P
+    if flush and len(x) % P:
+        n_blocks += 1
+        x = np.concatenate([x, np.zeros((n_blocks*P-len(x), engine['ninp']), dtype=np.float32)])
+    engine['rest'] = x[n_blocks*P:]
+    if n_blocks == 0:
+        return np.zeros((0, engine['nout']), dtype=np.float32)
+
+    y = np.empty((n_blocks*P, engine['nout']), dtype=np.float32)
+    for b0 in range(0, n_blocks, blocks_per_fft):
+        nb = min(blocks_per_fft, n_blocks-b0)
+        cur = x[b0*P:(b0+nb)*P]
+
+        ### Overlapping 2P frames of the input, all transformed in one call
+        frames = np.concatenate([engine['x_prev'], cur]).reshape(nb+1, P, engine['ninp'])
+        frames = np.concatenate([frames[:-1], frames[1:]], axis=1) # (nb, 2P, ninp)
+        X = np.fft.rfft(frames, axis=1).astype(np.complex64)
+        engine['x_prev'] = cur[-P:]
+
+        ### Frequency domain delay line: X_all[j] is the spectrum of block j - (n_part-1)
+        X_all = np.concatenate([engine['X_hist'], X])
+        Y = np.zeros((nb, P+1, engine['nout']), dtype=np.complex64)
+        for k in range(n_part):
+            start = n_part-1-k
+            Y += np.einsum('bfi,fio->bfo', X_all[start:start+nb], H[k], optimize=True)
+        if n_part > 1:
+            engine['X_hist'] = X_all[-(n_part-1):]
+
+        y[b0*P:(b0+nb)*P] = np.fft.irfft(Y, axis=1)[:, P:].reshape(nb*P, engine['nout'])
+
+    return y
+
+
+### Convolve a HOA file into the array file in a single read/write pass
+def SPEAR_hoaToArray(path_conf, HOA_file, array_file, n_frames=fs_out*60, block_size=2**15, engine=None, subtype='PCM_32'):
+    engines = None if engine is None else [engine]
+    return SPEAR_hoaToArrays([path_conf], HOA_file, [array_file], n_frames=n_frames, block_size=block_size, engines=engines, subtype=subtype)[0]
+
+
+### Convolve a HOA file into the files of several arrays (one configuration each) in a single read of the HOA
+def SPEAR_hoaToArrays(path_confs, HOA_file, array_files, n_frames=fs_out*60, block_size=2**15, engines=None, subtype='PCM_32'):
+
+    if engines is None:
+        engines = [conv_loadEngine(str(path_conf)) for path_conf in path_confs]
+    engines = [dict(engine) for engine in engines] # own delay line per output, even for the same engine given twice
+    for engine in engines:
+        conv_reset(engine)
+
+    with sf.SoundFile(str(HOA_file)) as fin:
+        for engine in engines:
+            if fin.channels != engine['ninp']:
+                raise ValueError(f'{HOA_file} has {fin.channels} channels, the filters expect {engine["ninp"]}')
+            if engine.get('fs') is not None and fin.samplerate != engine['fs']:
+                raise ValueError(f'{HOA_file} is at {fin.samplerate} Hz, the filters at {engine["fs"]} Hz')
+        n_out = fin.frames if n_frames is None else min(fin.frames, n_frames)
+        fouts = [sf.SoundFile(str(array_file), 'w', samplerate=fin.samplerate, channels=engine['nout'], subtype=subtype)
+                 for engine, array_file in zip(engines, array_files)]
+        try:
+            n_done = [0]*len(engines) # frames written per array (whole partitions of its own engine)
+            for block in fin.blocks(blocksize=block_size, dtype='float32', always_2d=True, frames=n_out):
+                for n, (engine, fout) in enumerate(zip(engines, fouts)):
+                    y = conv_process(engine, block)
+                    fout.write(y)
+                    n_done[n] += len(y)
+            for n, (engine, fout) in enumerate(zip(engines, fouts)):
+                y = conv_process(engine, np.zeros((0, engine['ninp']), dtype=np.float32), flush=True)
+                fout.write(y[:n_out-n_done[n]])
+        finally:
+            for fout in fouts:
+                fout.close()
+
+    return array_files
+
+
+### Compare with fmatconvol (numerical equivalence) and measure throughput
+def SPEAR_convolutionBenchmark(path_conf, HOA_file=None, duration=10, dir_tmp=None):
+
+    filters, partition, fs_filt = conv_readConf(path_conf)
+    fs = fs_filt or fs_out
+    results = {'ninp': filters.shape[1], 'nout': filters.shape[2], 'filter_length': filters.shape[0], 'partition': partition}
+
+    dir_bench = tempfile.mkdtemp(prefix='conv_bench_', dir=dir_tmp)
+    try:
+        ### Test signal (white noise) if no real HOA file is given
+        if HOA_file is None:
+            HOA_file = PurePath(dir_bench, 'hoa.wav')
+            rng = np.random.default_rng(0)
+            sf.write(HOA_file, 0.05*rng.standard_normal((int(duration*fs), filters.shape[1])).astype(np.float32), fs, subtype='FLOAT')
+        duration = sf.info(str(HOA_file)).duration
+
+        array_numpy = PurePath(dir_bench, 'array_numpy.wav')
+        t0 = time.perf_counter()
+        SPEAR_hoaToArray(path_conf, HOA_file, array_numpy, n_frames=None, engine=conv_engine(filters, partition), subtype='FLOAT')
+        results['numpy_s'] = time.perf_counter()-t0
+        results['numpy_realtime'] = duration/results['numpy_s']
+
+        if shutil.which('fmatconvol') is not None:
+            array_fmat = PurePath(dir_bench, 'array_fmatconvol.wav')
+            t0 = time.perf_counter()
+            os.system(f'fmatconvol {path_conf} {HOA_file} {array_fmat}')
+            results['fmatconvol_s'] = time.perf_counter()-t0
+            results['fmatconvol_realtime'] = duration/results['fmatconvol_s']
+
+            y_numpy, _ = sf.read(str(array_numpy), dtype='float64')
+            y_fmat, _ = sf.read(str(array_fmat), dtype='float64')
+            n = min(len(y_numpy), len(y_fmat))
+            err = y_numpy[:n]-y_fmat[:n]
+            results['max_abs_error'] = float(np.max(np.abs(err)))
+            results['error_db'] = float(10*np.log10(np.sum(err**2)/max(np.sum(y_fmat[:n]**2), 1e-30)+1e-30))
+        else:
+            print('fmatconvol not found, only the throughput of the numpy engine is measured')
+    finally:
+        shutil.rmtree(dir_bench)
+
+    for key, val in results.items():
+        print(f'{key}: {val}')
+    return results
+
+
+
+if __name__ == '__main__':
+
+    from fct_tascarScene import tascar_fmatconvConf
+
+    ### Provide path to the SPEAR directory
+    path_spear = '/SPEAR-dir'
+
+    SPEAR_convolutionBenchmark(tascar_fmatconvConf(path_spear), duration=10)
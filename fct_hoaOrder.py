@@ -0,0 +1,193 @@
+"""
+SPEAR Challenge
+
+HOA order of the renders: configurations of lower orders and accuracy/throughput evaluation.
+Input: spear path (HOA_weights folder with the full order fmatconvol configuration), datasets/sessions and orders.
+Output: fmat_hoa{order}.conf configurations, and a report of the render time, HOA temp size and array error per order.
+
+The runs take hoa_order (cf SPEAR_tascarSceneRun, fct_scheduler, fct_jobQueue): the HOA receiver of the
+scene is rendered at this order ((order+1)^2 channels, cf tascar_sceneOrder) and convolved with the
+configuration having (order+1)^2 inputs (cf tascar_fmatconvConf).
+
+The HOA channels are in ACN order, so the channels of order n are the first (n+1)^2 channels of the
+order 15 render. The configuration of order n keeps the filters of these inputs (truncation of the
+order 15 ATF weights, without any re-weighting), in new weight files for the configurations loading
+a single multichannel file. Each written configuration is read back (conv_readConf, the layout used by
+the numpy convolution) and must give the filters of the full order truncated to its inputs.
+
+The evaluation renders the Scene_full_sourceAll of sampled minutes at each order in a temporary
+folder and reports, against the highest order of the list (15 by default):
+    render_s, convolve_s: mean wall time of the stages (cf fct_instrumentation)
+    hoa_tmp_mb:           size of the HOA temp file of a job (cf hoa_tmpSize of fct_scheduler)
+    error_db:             energy of the array difference relative to the reference order (cf fct_superposition)
+
+- hoa_confOrder: HOA order of a fmatconvol configuration (from its number of inputs).
+- SPEAR_hoaConfs: Write the configurations of lower orders from the full order one.
+- SPEAR_hoaOrderEval: Render sampled minutes at several orders and compare them with the highest one.
+
+Command line:
+    python fct_hoaOrder.py --path_spear /SPEAR-dir --datasets 2 --sessions 1 --orders 2 4 6 8 15 --minutes 3 --json hoa_orders.json
+
+"""
+
+import os
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import numpy as np
+import soundfile as sf
+from pathlib import Path
+from pathlib import PurePath
+from fct_PathFinder import PathFinder
+from fct_convolution import conv_parseConf, conv_readConf
+from fct_tascarScene import tascar_runJob, tascar_fmatconvConf, hoa_order
+from fct_scheduler import SPEAR_jobExpand, hoa_tmpSize
+from fct_superposition import superposition_residual
+from fct_instrumentation import instr_load
+
+
+###### Global Parameters
+orders_default = [2, 4, 6, 8, hoa_order]
+error_max_db = -20 # error accepted to choose the cheapest order
+
+
+### HOA order of a fmatconvol configuration (None if its number of inputs is not a square)
+def hoa_confOrder(path_conf):
+    ninp = conv_parseConf(str(path_conf))['ninp']
+    order = int(round(np.sqrt(ninp))) - 1
+    return order if (order+1)**2 == ninp else None
+
+
+### Write the configurations of lower orders from the full order one (fmat_hoa{order}.conf in HOA_weights)
+def SPEAR_hoaConfs(path_spear, orders, order_full=hoa_order):
+    path_hoa = PathFinder(0, 0, 'hoa', path_spear=path_spear)
+    path_full = tascar_fmatconvConf(path_spear, order_full)
+    conf = conv_parseConf(str(path_full))
+    filters_full = None
+
+    confs = {}
+    for order in orders:
+        if order > order_full:
+            raise ValueError(f'Order {order} cannot be derived from order {order_full}')
+        try:
+            confs[order] = tascar_fmatconvConf(path_spear, order)
+            continue
+        except FileNotFoundError:
+            pass
+
+        ninp, nout = (order+1)**2, conf['nout']
+        lines = [f'/convolver/new {ninp} {nout} {conf["maxlen"]} {conf["partition"]}']
+        for file_load in conf['loads']:
+            ### Filters of the ninp first inputs: the first ninp*nout channels (input major, cf conv_readConf)
+            h, fs = sf.read(file_load, dtype='float32', always_2d=True)
+            file_order = PurePath(path_hoa, f'{Path(file_load).stem}_hoa{order}.wav')
+            sf.write(str(file_order), h[:, :ninp*nout], fs, subtype='FLOAT')
+            lines.append(f'/convolver/load {file_order.name}')
+        for inp, out, gain, delay, offset, length, chan, file_imp in conf['impulses']:
+            if inp < ninp:
+                lines.append(f'/impulse/read {inp+1} {out+1} {gain:g} {delay} {offset} {length} {chan+1} '
+                             f'{os.path.relpath(file_imp, path_hoa)}')
+
+        confs[order] = PurePath(path_hoa, f'fmat_hoa{order}.conf')
+        with open(confs[order], 'w') as fout:
+            fout.write('\n'.join(lines) + '\n')
+
+        ### Round trip: the filters of the new configuration are those of the first ninp inputs of the full order
+        if filters_full is None:
+            filters_full = conv_readConf(str(path_full))[0]
+        if not np.array_equal(conv_readConf(str(confs[order]))[0], filters_full[:, :ninp, :]):
+            os.remove(confs[order])
+            raise ValueError(f'The configuration of order {order} derived from {path_full} does not match its first {ninp} inputs')
+        print(f'Written {confs[order]} ({ninp} inputs)')
+    return confs
+
+
+### Mean wall time of a stage in the events of a folder
+def _stageWall(dir_events, stage):
+    walls = [e['wall_s'] for e in instr_load(dir_events) if e['stage'] == stage and e['error'] is None]
+    return float(np.mean(walls)) if walls else None
+
+
+### Render sampled minutes at several orders and compare them with the highest one
+def SPEAR_hoaOrderEval(datasets, sessions, path_spear, orders=orders_default, n_minutes=3, seed=0, convolver='numpy'):
+
+    orders = sorted(set(orders))
+    order_ref = orders[-1]
+    confs = SPEAR_hoaConfs(path_spear, orders, order_full=max(order_ref, hoa_order))
+
+    jobs = [job for job in SPEAR_jobExpand(datasets, sessions, path_spear)
+            if job['sound']=='full' and job['source']=='All']
+    jobs = random.Random(seed).sample(jobs, min(n_minutes, len(jobs)))
+    print(f'{len(jobs)} minutes rendered at orders {orders}')
+
+    dir_eval = tempfile.mkdtemp(prefix='hoa_orders_')
+    results = {order: {'render_s': [], 'convolve_s': [], 'error_db': []} for order in orders}
+    try:
+        for n_job, job in enumerate(jobs):
+            files = {}
+            for order in orders:
+                dir_job = os.path.join(dir_eval, f'{n_job}_hoa{order}')
+                dir_events = os.path.join(dir_job, 'events')
+                os.makedirs(dir_job)
+                files[order] = tascar_runJob(dict(job, path_out=dir_job), confs[order], convolver=convolver,
+                                             events=dir_events, hoa_order=order)
+                for stage in ('render', 'convolve'):
+                    wall = _stageWall(dir_events, stage)
+                    if wall is not None:
+                        results[order][f'{stage}_s'].append(wall)
+            for order in orders:
+                error_db, _ = superposition_residual(files[order], files[order_ref])
+                results[order]['error_db'].append(error_db)
+    finally:
+        shutil.rmtree(dir_eval)
+
+    ### Mean over the minutes, worst error
+    report = {'order_ref': order_ref, 'convolver': convolver, 'minutes': len(jobs), 'orders': {}}
+    print(f'\n{"order":>5} {"channels":>8} {"render s":>9} {"conv s":>8} {"HOA MB":>8} {"error dB":>9} {"worst dB":>9}')
+    for order in orders:
+        r = results[order]
+        entry = {'channels':   (order+1)**2,
+                 'render_s':   float(np.mean(r['render_s'])) if r['render_s'] else None,
+                 'convolve_s': float(np.mean(r['convolve_s'])) if r['convolve_s'] else None,
+                 'hoa_tmp_mb': hoa_tmpSize(order)/1e6,
+                 'error_db':   float(np.mean(r['error_db'])) if r['error_db'] else None,
+                 'error_worst_db': float(np.max(r['error_db'])) if r['error_db'] else None,
+                 }
+        report['orders'][order] = entry
+        fmt = lambda v, f: format(v, f) if v is not None else '-'
+        print(f'{order:>5} {entry["channels"]:>8} {fmt(entry["render_s"], "9.2f")} {fmt(entry["convolve_s"], "8.2f")} '
+              f'{entry["hoa_tmp_mb"]:8.1f} {fmt(entry["error_db"], "9.1f")} {fmt(entry["error_worst_db"], "9.1f")}')
+
+    ### Cheapest order whose worst error is acceptable
+    ok = [order for order in orders if order == order_ref or
+          (report['orders'][order]['error_worst_db'] is not None and report['orders'][order]['error_worst_db'] <= error_max_db)]
+    report['cheapest_order'] = ok[0] if ok else order_ref
+    print(f'\nCheapest order with a worst error <= {error_max_db} dB: {report["cheapest_order"]}')
+    return report
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Render sampled minutes at several HOA orders and compare them with the highest one.')
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2])
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1])
+    parser.add_argument('--orders', type=int, nargs='+', default=orders_default)
+    parser.add_argument('--minutes', type=int, default=3, help='number of sampled minutes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--convolver', default='numpy', choices=['fmatconvol', 'numpy'])
+    parser.add_argument('--confs_only', action='store_true', help='only write the configurations of the orders')
+    parser.add_argument('--json', default=None, help='also write the report in this file')
+    args = parser.parse_args()
+
+    if args.confs_only:
+        SPEAR_hoaConfs(args.path_spear, args.orders)
+    else:
+        report = SPEAR_hoaOrderEval(args.datasets, args.sessions, args.path_spear, orders=args.orders, n_minutes=args.minutes,
+                                    seed=args.seed, convolver=args.convolver)
+        if args.json is not None:
+            with open(args.json, 'w') as fout:
+                json.dump(report, fout, indent=1)
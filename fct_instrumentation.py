@@ -0,0 +1,205 @@
+"""
+SPEAR Challenge
+
+Structured instrumentation of the Tascar jobs: one JSON event per stage of every job.
+Input: a folder for the events (events=... of tascar_runJob, SPEAR_tascarSceneRun and the schedulers).
+Output: events_<host>_<pid>.jsonl files (one line per event) and a report aggregating them.
+
+Stages of a job (cf tascar_runJob): render (tascar_renderfile), convolve (fmatconvol or numpy),
+stream (render + convolution through a fifo), postprocess (60s check and reference extraction),
+sum (linear superposition), and job for the whole job (status done, skipped or failed).
+
+Each event carries:
+    job, dataset, session, minute, stage, host, pid, start, end (unix time), wall_s
+    cpu_s, cpu_children_s: CPU time of the worker and of the processes it waited for during the stage
+    max_rss_mb:            peak RSS of the external tool (wait4) or of the worker process for in-process stages
+                           (Linux counts the RSS of the worker at the fork in the one of the tool: upper bound)
+    bytes_read, bytes_written: bytes read/written by the worker and the processes it waited for
+                               (rchar/wchar of /proc/self/io, Linux only)
+    exit_status: exit code of the external tool, error: exception of a failed stage
+
+Each worker process appends to its own file, so no locking is needed, also on a shared filesystem.
+When events is None nothing is measured nor written.
+
+- instr_stage: Context manager measuring a stage and writing its event.
+- instr_system: Run a shell command (instead of os.system) and record its exit status and resource usage (wait4).
+- instr_load: Load all the events of a folder.
+- SPEAR_eventsReport: Percentiles per stage and slowest minutes per session.
+
+Command line:
+    python fct_instrumentation.py --events /SPEAR-dir/SPEAR/Miscellaneous/RunEvents --top 5
+
+"""
+
+import os
+import json
+import time
+import socket
+import resource
+import argparse
+import subprocess
+import numpy as np
+from pathlib import Path
+from pathlib import PurePath
+from contextlib import contextmanager
+
+
+###### Global Parameters
+percentiles = [50, 90, 99]
+_files = {}
+
+
+### I/O counters of the process (Linux only)
+def _procIo():
+    try:
+        with open('/proc/self/io') as fin:
+            counters = dict(line.split(': ') for line in fin.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+### File of the events of this process
+def _eventFile(dir_events):
+    key = (os.getpid(), str(dir_events))
+    if key not in _files:
+        os.makedirs(dir_events, exist_ok=True)
+        _files[key] = open(PurePath(dir_events, f'events_{socket.gethostname()}_{os.getpid()}.jsonl'), 'a', buffering=1)
+    return _files[key]
+
+
+### Name of a job in the events
+def instr_jobName(job):
+    return f'D{job["dataset_n"]}_S{job["session_n"]}_M{job["minute"]}_{job["sound"]}_{job["source"]}{job["idd"]}'
+
+
+### Context manager measuring a stage of a job; the yielded event can be completed by the stage (exit status, bytes)
+@contextmanager
+def instr_stage(events, job, stage):
+    event = {}
+    if events is None:
+        yield event
+        return
+
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    io_read, io_written = _procIo()
+    start = time.time()
+    t0 = time.perf_counter()
+    try:
+        yield event
+    except BaseException as e:
+        event['error'] = repr(e)
+        raise
+    finally:
+        wall = time.perf_counter() - t0
+        usage_self_end = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+        io_read_end, io_written_end = _procIo()
+        record = {'job':     instr_jobName(job),
+                  'dataset': job['dataset_n'],
+                  'session': job['session_n'],
+                  'minute':  job['minute'],
+                  'stage':   stage,
+                  'host':    socket.gethostname(),
+                  'pid':     os.getpid(),
+                  'start':   start,
+                  'end':     start + wall,
+                  'wall_s':  wall,
+                  'cpu_s':   (usage_self_end.ru_utime - usage_self.ru_utime) + (usage_self_end.ru_stime - usage_self.ru_stime),
+                  'cpu_children_s': (usage_children_end.ru_utime - usage_children.ru_utime)
+                                    + (usage_children_end.ru_stime - usage_children.ru_stime),
+                  'max_rss_mb': usage_self_end.ru_maxrss/1024, # kB on Linux
+                  'bytes_read': io_read_end - io_read,
+                  'bytes_written': io_written_end - io_written,
+                  'exit_status': None,
+                  'error': None,
+                  }
+        ### Measures of the external tool (instr_system) and values given by the stage
+        record.update(event)
+        _eventFile(events).write(json.dumps(record) + '\n')
+
+
+### Run a shell command (instead of os.system) and record its exit status and resource usage in the event
+def instr_system(cmd, event=None):
+    proc = subprocess.Popen(cmd, shell=True)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if event is not None:
+        event['exit_status'] = proc.returncode
+        event['max_rss_mb'] = usage.ru_maxrss/1024 # the tool and the processes it waited for
+    return proc.returncode
+
+
+### Load all the events of a folder
+def instr_load(dir_events):
+    events = []
+    for path_file in sorted(Path(dir_events).glob('events_*.jsonl')):
+        with open(path_file) as fin:
+            for line in fin:
+                line = line.strip()
+                if line:
+                    try:
+                        events.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        pass # line of a process killed while writing
+    return events
+
+
+### Percentiles per stage and slowest minutes per session
+def SPEAR_eventsReport(dir_events, top=5):
+    events = instr_load(dir_events)
+    print(f'{len(events)} events in {dir_events}')
+
+    ### Per stage (failed and skipped jobs are counted apart)
+    report = {'stages': {}, 'slowest_minutes': {}}
+    stages = sorted({e['stage'] for e in events})
+    header = ' '.join(f'{"p"+str(p):>8}' for p in percentiles)
+    print(f'\n{"stage":>12} {"n":>6} {"failed":>6} {header} {"max":>8} {"cpu":>8} {"child cpu":>9} {"rss MB":>8} {"GB r/w":>13}')
+    for stage in stages:
+        ev = [e for e in events if e['stage'] == stage and e.get('status') != 'skipped']
+        ok = [e for e in ev if e['error'] is None and e.get('exit_status') in (None, 0)]
+        if not ok:
+            continue
+        wall = np.array([e['wall_s'] for e in ok])
+        entry = {'n': len(ok), 'failed': len(ev)-len(ok),
+                 **{f'p{p}_s': float(np.percentile(wall, p)) for p in percentiles},
+                 'max_s': float(wall.max()),
+                 'cpu_s': float(np.mean([e['cpu_s'] for e in ok])),
+                 'cpu_children_s': float(np.mean([e['cpu_children_s'] for e in ok])),
+                 'max_rss_mb': float(max(e['max_rss_mb'] for e in ok)),
+                 'gb_read': sum(e['bytes_read'] for e in ok)/1e9,
+                 'gb_written': sum(e['bytes_written'] for e in ok)/1e9,
+                 }
+        report['stages'][stage] = entry
+        values = ' '.join(f'{entry[f"p{p}_s"]:8.2f}' for p in percentiles)
+        print(f'{stage:>12} {entry["n"]:>6} {entry["failed"]:>6} {values} {entry["max_s"]:8.2f} {entry["cpu_s"]:8.2f} '
+              f'{entry["cpu_children_s"]:9.2f} {entry["max_rss_mb"]:8.1f} {entry["gb_read"]:6.2f}/{entry["gb_written"]:<6.2f}')
+
+    ### Slowest minutes of each session (wall time of all the jobs of the minute)
+    minutes = {}
+    for e in events:
+        if e['stage'] == 'job' and e.get('status') != 'skipped':
+            key = (e['dataset'], e['session'], e['minute'])
+            minutes[key] = minutes.get(key, 0) + e['wall_s']
+    for (dataset_n, session_n) in sorted({key[0:2] for key in minutes}):
+        session = sorted(((wall, key[2]) for key, wall in minutes.items() if key[0:2] == (dataset_n, session_n)), reverse=True)
+        report['slowest_minutes'][f'D{dataset_n}_S{session_n}'] = [{'minute': minute, 'wall_s': wall} for wall, minute in session[:top]]
+        print(f'\nD{dataset_n} S{session_n} slowest minutes: ' + ', '.join(f'M{minute} {wall:.1f}s' for wall, minute in session[:top]))
+
+    return report
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Report of the per-stage events of the SPEAR tascar runs.')
+    parser.add_argument('--events', required=True, help='folder of the events_*.jsonl files')
+    parser.add_argument('--top', type=int, default=5, help='number of slowest minutes per session')
+    parser.add_argument('--json', default=None, help='also write the report in this file')
+    args = parser.parse_args()
+
+    report = SPEAR_eventsReport(args.events, top=args.top)
+    if args.json is not None:
+        with open(args.json, 'w') as fout:
+            json.dump(report, fout, indent=1)
@@ -0,0 +1,308 @@
+"""
+SPEAR Challenge
+
+Job queue on the shared SPEAR filesystem, to run SPEAR_tascarSceneRun jobs from many nodes.
+Input: datasets, sessions and spear path (shared, e.g. NFS).
+Output: same files as SPEAR_tascarSceneRun, the queue state in Miscellaneous/JobQueue.
+
+Layout of the queue (one small file per job):
+    jobs/<job_id>.json      job description (tascar_jobList), written by init
+    leases/<job_id>.lease   lease of the node running the job, created with O_EXCL
+    done/<job_id>.json      finished job
+    failed/<job_id>.json    failed job (error and number of attempts)
+
+A worker claims a job by creating its lease file exclusively, and refreshes the modification time
+of the lease (heartbeat) while the job runs. A lease not refreshed for lease_ttl seconds belongs
+to a dead node: any worker reclaims it by renaming it away and claims the job again. Between the
+check of its age and the rename, another node may already have reclaimed it and written a fresh lease:
+the renamed file is compared with the expired one (inode, modification time, owner), and a different
+file is put back (hard link, never over an existing lease) without claiming the job.
+lease_ttl must be large compared to the clock differences between nodes.
+A lease is removed at the end of the job only if it still holds the owner written by the claim (the
+lease of a job taking longer than lease_ttl may have been reclaimed by another node meanwhile).
+The job descriptions never change: each worker reads them once, and only lists done/, failed/ and
+leases/ between two jobs (jobs added to the queue later are taken by the next workers started).
+Jobs with dependencies (linear superposition) are only claimed once their dependencies are done.
+
+- SPEAR_queueInit: Add the jobs of datasets/sessions to the queue.
+- queue_claim: Claim a job (new lease, or reclaim of an expired one).
+- queue_release: Remove a lease, if it is still ours.
+- SPEAR_queueWorker: Take and run jobs until the queue is empty.
+- SPEAR_queueStatus: Completion per dataset/session.
+
+Command line:
+    python fct_jobQueue.py init   --path_spear /SPEAR-dir --datasets 2 3 --sessions 1 2 3
+    python fct_jobQueue.py work   --path_spear /SPEAR-dir --workers 16
+    python fct_jobQueue.py status --path_spear /SPEAR-dir
+
+"""
+
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+from pathlib import Path
+from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor
+from fct_PathFinder import PathFinder
+from fct_tascarScene import tascar_jobKey, tascar_runJob, tascar_fmatconvConf, tascar_arrayConfs, hoa_order
+from fct_scheduler import SPEAR_jobExpand
+
+
+###### Global Parameters
+lease_ttl = 600 # seconds without heartbeat before a lease is considered dead
+heartbeat = 30 # seconds between two refreshes of a lease
+max_attempts = 3 # a job failing more often is not tried again
+poll_wait = 10 # seconds to wait when all the remaining jobs are leased or waiting for dependencies
+dirs_queue = ['jobs', 'leases', 'done', 'failed']
+_owners = {} # owner written in the leases claimed by the process (path: owner)
+
+
+### Identifier of a job (file name in the queue)
+def queue_jobId(job):
+    return f'D{job["dataset_n"]}_S{job["session_n"]}_M{job["minute"]}_{job["sound"]}_{job["source"]}{job["idd"]}'
+
+
+### Write a small json file atomically
+def _writeJson(path_file, content):
+    path_tmp = f'{path_file}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(path_tmp, 'w') as fout:
+        json.dump(content, fout, indent=1)
+    os.replace(path_tmp, path_file)
+
+
+def _readJson(path_file):
+    with open(path_file) as fin:
+        return json.load(fin)
+
+
+### Add the jobs of datasets/sessions to the queue (jobs already in the queue are kept)
+def SPEAR_queueInit(datasets, sessions, path_spear, superposition=False, catalog=False):
+    path_queue = PathFinder(0, 0, 'queue', path_spear=path_spear)
+    for name in dirs_queue:
+        os.makedirs(PurePath(path_queue, name), exist_ok=True)
+
+    jobs = SPEAR_jobExpand(datasets, sessions, path_spear, superposition=superposition, catalog=catalog)
+    ids = {tascar_jobKey(job): queue_jobId(job) for job in jobs}
+    n_new = 0
+    for job in jobs:
+        path_job = PurePath(path_queue, 'jobs', f'{queue_jobId(job)}.json')
+        if os.path.exists(path_job):
+            continue
+        job = dict(job)
+        job['after'] = [ids[key] for key in job.get('after', [])]
+        _writeJson(path_job, job)
+        n_new += 1
+
+    print(f'{n_new} jobs added to the queue ({len(jobs)-n_new} already there)')
+    return n_new
+
+
+### Inode, modification time and owner of a lease
+def _leaseState(path_lease):
+    stat = os.stat(path_lease)
+    with open(path_lease) as fin:
+        return stat.st_ino, stat.st_mtime_ns, fin.read()
+
+
+### Claim a job: create the lease exclusively, or reclaim it if it expired (returns the lease, None if not claimed)
+def queue_claim(path_queue, job_id):
+    path_lease = PurePath(path_queue, 'leases', f'{job_id}.lease')
+    owner = {'host': socket.gethostname(), 'pid': os.getpid(), 'start': time.time()}
+
+    for attempt in range(2):
+        try:
+            fd = os.open(path_lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            ### Existing lease: reclaim it only if the heartbeat stopped
+            try:
+                expired = _leaseState(path_lease)
+            except FileNotFoundError:
+                continue
+            if time.time() - expired[1]/1e9 < lease_ttl or attempt > 0:
+                return None
+            path_stale = f'{path_lease}.stale.{socket.gethostname()}.{os.getpid()}'
+            try:
+                os.rename(path_lease, path_stale)
+            except FileNotFoundError:
+                return None # another node reclaimed it first
+            if _leaseState(path_stale) != expired:
+                ### Fresh lease of a node which reclaimed it first (or heartbeat of a live owner): put it back
+                try:
+                    os.link(path_stale, path_lease)
+                except FileExistsError:
+                    print(f'Lease of {job_id} changed during its reclaim, the job may run twice')
+                os.remove(path_stale)
+                return None
+            os.remove(path_stale)
+            print(f'Reclaimed expired lease of {job_id}')
+            continue
+        with os.fdopen(fd, 'w') as fout:
+            json.dump(owner, fout)
+        _owners[path_lease] = owner
+        return path_lease
+
+    return None
+
+
+### Remove a lease, if it is still ours (not reclaimed by another node after expiry, nor already removed)
+def queue_release(path_lease):
+    owner = _owners.pop(path_lease, None)
+    try:
+        if _readJson(path_lease) != owner:
+            print(f'Lease {PurePath(path_lease).stem} was reclaimed by another node, kept')
+            return False
+        os.remove(path_lease)
+    except (FileNotFoundError, ValueError):
+        return False
+    return True
+
+
+### Refresh the lease while the job runs
+def _heartbeat(path_lease, stop):
+    while not stop.wait(heartbeat):
+        try:
+            os.utime(path_lease)
+        except FileNotFoundError:
+            return
+
+
+### Job descriptions of the queue (job_id: job), read once per worker
+def _jobsRead(path_queue):
+    return {path_job.stem: _readJson(path_job) for path_job in sorted(Path(path_queue, 'jobs').glob('*.json'))}
+
+
+### Jobs that can be claimed now (not done, not failed too often, dependencies done, not leased)
+def _jobsReady(path_queue, jobs):
+    done = {p.stem for p in Path(path_queue, 'done').glob('*.json')}
+    failed = {p.stem: _readJson(p)['attempts'] for p in Path(path_queue, 'failed').glob('*.json')}
+    leased = {p.stem for p in Path(path_queue, 'leases').glob('*.lease')}
+    ready, waiting = [], 0
+    for job_id, job in jobs.items():
+        if job_id in done or failed.get(job_id, 0) >= max_attempts:
+            continue
+        if any(failed.get(dep, 0) >= max_attempts for dep in job.get('after', [])):
+            continue # a dependency will never be done
+        if any(dep not in done for dep in job.get('after', [])) or job_id in leased:
+            waiting += 1
+            continue
+        ready.append((job_id, job))
+    return ready, waiting, leased
+
+
+### Take and run jobs until the queue is empty (one worker process)
+def _queueWorker(path_spear, options):
+    path_queue = PathFinder(0, 0, 'queue', path_spear=path_spear)
+    path_fmatconv = tascar_fmatconvConf(path_spear, options['hoa_order'])
+    jobs = _jobsRead(path_queue)
+    n_run = 0
+
+    while True:
+        ready, waiting, leased = _jobsReady(path_queue, jobs)
+        if not ready:
+            if waiting == 0:
+                return n_run
+            ### Everything left is running elsewhere or waiting: wait, expired leases will be reclaimed
+            expired = [job_id for job_id in leased if queue_claim(path_queue, job_id) is not None]
+            for job_id in expired:
+                queue_release(PurePath(path_queue, 'leases', f'{job_id}.lease'))
+            if not expired:
+                time.sleep(poll_wait)
+            continue
+
+        for job_id, job in ready:
+            path_lease = queue_claim(path_queue, job_id)
+            if path_lease is None:
+                continue
+
+            stop = threading.Event()
+            thread = threading.Thread(target=_heartbeat, args=(path_lease, stop), daemon=True)
+            thread.start()
+            try:
+                ### The job may have been finished by the previous owner of an expired lease
+                if not os.path.exists(PurePath(path_queue, 'done', f'{job_id}.json')):
+                    tascar_runJob(job, path_fmatconv, **options)
+                    _writeJson(PurePath(path_queue, 'done', f'{job_id}.json'), {'host': socket.gethostname(), 'end': time.time()})
+                    n_run += 1
+            except Exception as e:
+                path_failed = PurePath(path_queue, 'failed', f'{job_id}.json')
+                attempts = _readJson(path_failed)['attempts']+1 if os.path.exists(path_failed) else 1
+                _writeJson(path_failed, {'host': socket.gethostname(), 'error': repr(e), 'attempts': attempts})
+                print(f'Failed {job_id} (attempt {attempts}): {e!r}')
+            finally:
+                stop.set()
+                thread.join()
+                queue_release(path_lease)
+            break # list the queue again, other nodes have been working too
+
+
+### Take and run jobs until the queue is empty, with n_workers processes on this node
+def SPEAR_queueWorker(path_spear, n_workers=1, fmatconv=True, convolver='fmatconvol', render_cache=False, events=None, output_format='wav', hoa_order=hoa_order,
+                      noise_pool=False, arrays=None):
+    options = {'fmatconv': fmatconv, 'convolver': convolver, 'render_cache': render_cache, 'events': events, 'output_format': output_format,
+               'hoa_order': hoa_order, 'noise_pool': noise_pool,
+               'arrays': tascar_arrayConfs(path_spear, arrays, hoa_order) if arrays else None}
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(_queueWorker, path_spear, options) for n in range(n_workers)]
+        n_run = sum(future.result() for future in futures)
+    print(f'{n_run} jobs run on {socket.gethostname()}')
+    return n_run
+
+
+### Completion per dataset/session
+def SPEAR_queueStatus(path_spear):
+    path_queue = PathFinder(0, 0, 'queue', path_spear=path_spear)
+    done = {p.stem for p in Path(path_queue, 'done').glob('*.json')}
+    leased = {p.stem for p in Path(path_queue, 'leases').glob('*.lease')}
+    failed = {p.stem for p in Path(path_queue, 'failed').glob('*.json')} - done
+
+    status = {}
+    for path_job in Path(path_queue, 'jobs').glob('*.json'):
+        job_id = path_job.stem
+        dataset, session = job_id.split('_')[0:2]
+        count = status.setdefault((dataset, session), {'total': 0, 'done': 0, 'running': 0, 'failed': 0})
+        count['total'] += 1
+        if job_id in done:
+            count['done'] += 1
+        elif job_id in leased:
+            count['running'] += 1
+        elif job_id in failed:
+            count['failed'] += 1
+
+    print(f'{"dataset":>8} {"session":>8} {"done":>12} {"running":>8} {"failed":>8}')
+    for (dataset, session), count in sorted(status.items(), key=lambda x: (int(x[0][0][1:]), int(x[0][1][1:]))):
+        print(f'{dataset:>8} {session:>8} {count["done"]:>5}/{count["total"]:<5} ({100*count["done"]/count["total"]:3.0f}%)'
+              f' {count["running"]:>8} {count["failed"]:>8}')
+    return status
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Shared filesystem job queue for the SPEAR tascar runs.')
+    parser.add_argument('command', choices=['init', 'work', 'status'])
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--superposition', action='store_true')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--convolver', default='fmatconvol', choices=['fmatconvol', 'numpy', 'stream'])
+    parser.add_argument('--render_cache', action='store_true')
+    parser.add_argument('--catalog', action='store_true', help='list the jobs from the catalog (cf fct_catalog)')
+    parser.add_argument('--order', type=int, default=hoa_order, help='HOA order of the renders (cf fct_hoaOrder)')
+    parser.add_argument('--format', default='wav', choices=['wav', 'flac'], help='container of the array and reference outputs')
+    parser.add_argument('--noise_pool', action='store_true', help='render each distinct loudspeaker scene once (cf fct_noisePool)')
+    parser.add_argument('--arrays', nargs='+', default=None, help='other arrays (Array_Transfer_Functions/<name>) convolved from the same renders')
+    parser.add_argument('--events', action='store_true', help='write the per-stage events in Miscellaneous/RunEvents (cf fct_instrumentation)')
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        SPEAR_queueInit(args.datasets, args.sessions, args.path_spear, superposition=args.superposition, catalog=args.catalog)
+    elif args.command == 'work':
+        events = PathFinder(0, 0, 'events', path_spear=args.path_spear) if args.events else None
+        SPEAR_queueWorker(args.path_spear, n_workers=args.workers, convolver=args.convolver, render_cache=args.render_cache, events=events, output_format=args.format,
+                          hoa_order=args.order, noise_pool=args.noise_pool, arrays=args.arrays)
+    else:
+        SPEAR_queueStatus(args.path_spear)
@@ -0,0 +1,170 @@
+"""
+SPEAR Challenge
+
+Post processing mixture of the simulated components (the audio mixture is not rendered by Tascar).
+Input: dataset, session, spear path and the requested SNRs (and optionally output level).
+Output: one mixture .wav file per minute and per SNR, next to the components in the reference folder.
+
+The components of a minute are read from PathFinder(dataset_n, session_n, 'reference')/minute:
+    target: array_full_All.wav (all talkers) or array_full_ID{n}.wav
+    noise:  array_full_Ls.wav (loudspeakers)
+The mixture is target + g*noise with g set from the powers of the components to obtain the SNR.
+
+Two streaming passes per minute, whatever the number of SNRs:
+    1. powers of target and noise and their cross term (so that the output level is exact),
+    2. one read of target and noise, all the SNR variants computed at once as a (n_snr, block, channels) array.
+
+- mixture_stats: Powers of target and noise and cross term, block by block.
+- mixture_gains: Noise gain and overall gain for each SNR (and output level).
+- SPEAR_mixtureMinute: Write all the mixtures of a minute.
+- SPEAR_mixture: Write the mixtures of all minutes of datasets/sessions (process pool over minutes).
+                 catalog=True finds the minutes and their components in the catalog (cf fct_catalog).
+                 file_format='flac' reads the .flac components and writes .flac mixtures (cf fct_outputFormat).
+
+Command line:
+    python fct_mixture.py --path_spear /SPEAR-dir --datasets 2 --sessions 1 2 3 --snr -5 0 5 10 --level -26
+
+"""
+
+import os
+import argparse
+import numpy as np
+import soundfile as sf
+from pathlib import Path
+from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor
+from fct_PathFinder import PathFinder
+from fct_catalog import catalog_minutes, catalog_outputs
+from fct_postProcessing import output_format, tmp_name
+
+
+###### Global Parameters
+fs_out = 48000
+block_size = 2**16
+
+
+### Name of the mixture file
+def mixture_name(target, snr, level=None, file_format='wav'):
+    name = f'mix_{target}_snr{snr:+g}dB'
+    if level is not None:
+        name += f'_lvl{level:+g}dB'
+    return name + '.' + file_format
+
+
+### Powers of target and noise and cross term, block by block
+def mixture_stats(file_target, file_noise, n_frames=fs_out*60):
+    p_s, p_n, c_sn, n_tot = 0, 0, 0, 0
+    with sf.SoundFile(str(file_target)) as fs_, sf.SoundFile(str(file_noise)) as fn:
+        n = min(fs_.frames, fn.frames, n_frames)
+        for start in range(0, n, block_size):
+            m = min(block_size, n-start)
+            s = fs_.read(m, dtype='float64', always_2d=True)
+            v = fn.read(m, dtype='float64', always_2d=True)
+            p_s += np.sum(s*s)
+            p_n += np.sum(v*v)
+            c_sn += np.sum(s*v)
+            n_tot += s.size
+    return p_s/n_tot, p_n/n_tot, c_sn/n_tot
+
+
+### Noise gain and overall gain for each SNR (level in dB rms re full scale, None to keep the target level)
+def mixture_gains(p_s, p_n, c_sn, snrs, level=None):
+    snrs = np.asarray(snrs, dtype=float)
+    g_noise = np.sqrt(p_s / (np.maximum(p_n, 1e-30) * 10**(snrs/10)))
+    if level is None:
+        g_out = np.ones_like(g_noise)
+    else:
+        p_mix = p_s + g_noise**2*p_n + 2*g_noise*c_sn
+        g_out = 10**(level/20) / np.sqrt(np.maximum(p_mix, 1e-30))
+    return g_noise, g_out
+
+
+### Write all the mixtures of a minute
+def SPEAR_mixtureMinute(path_minute, snrs, target='All', level=None, path_out=None, subtype='PCM_32', n_frames=fs_out*60, file_format='wav'):
+
+    if path_out is None:
+        path_out = path_minute
+    file_target = PurePath(path_minute, f'array_full_{target}.{file_format}')
+    file_noise  = PurePath(path_minute, f'array_full_Ls.{file_format}')
+
+    ### Pass 1: powers
+    p_s, p_n, c_sn = mixture_stats(file_target, file_noise, n_frames=n_frames)
+    g_noise, g_out = mixture_gains(p_s, p_n, c_sn, snrs, level=level)
+    a_target = g_out[:, None, None]
+    a_noise  = (g_out*g_noise)[:, None, None]
+
+    ### Pass 2: all SNR variants from a single read, in temporary files renamed once complete (no truncated mixtures)
+    files_out = [PurePath(path_out, mixture_name(target, snr, level, file_format)) for snr in snrs]
+    files_tmp = [tmp_name(f) for f in files_out]
+    fmt, subtype = ('WAV', subtype) if file_format == 'wav' else output_format(files_out[0])
+    fouts = []
+    try:
+        with sf.SoundFile(str(file_target)) as fs_, sf.SoundFile(str(file_noise)) as fn:
+            n = min(fs_.frames, fn.frames, n_frames)
+            fouts = [sf.SoundFile(f, 'w', samplerate=fs_.samplerate, channels=fs_.channels, subtype=subtype, format=fmt) for f in files_tmp]
+            for start in range(0, n, block_size):
+                m = min(block_size, n-start)
+                s = fs_.read(m, dtype='float32', always_2d=True)
+                v = fn.read(m, dtype='float32', always_2d=True)
+                mix = a_target*s[None] + a_noise*v[None] # (n_snr, m, channels)
+                for fout, x in zip(fouts, mix):
+                    fout.write(x)
+        for fout, file_tmp, file_out in zip(fouts, files_tmp, files_out):
+            fout.close()
+            os.replace(file_tmp, file_out)
+    finally:
+        for fout, file_tmp in zip(fouts, files_tmp):
+            fout.close()
+            if os.path.exists(file_tmp):
+                os.remove(file_tmp)
+
+    return files_out
+
+
+### Minutes of a session that have the components of the mixture
+def mixture_minutes(dataset_n, session_n, path_spear, target='All', catalog=False, file_format='wav'):
+    path_ref = Path(PathFinder(dataset_n, session_n, 'reference', path_spear=path_spear))
+    if catalog:
+        names = {f'array_full_{target}.{file_format}', f'array_full_Ls.{file_format}'}
+        return [path_ref / minute for minute in catalog_minutes(dataset_n, session_n, path_spear, tree='reference')
+                if names <= catalog_outputs(dataset_n, session_n, minute, path_spear).keys()]
+    if not path_ref.is_dir():
+        return []
+    minutes = sorted(p for p in path_ref.iterdir() if p.is_dir() and p.name[0]!='.')
+    return [p for p in minutes if (p / f'array_full_{target}.{file_format}').exists() and (p / f'array_full_Ls.{file_format}').exists()]
+
+
+### Write the mixtures of all minutes of datasets/sessions
+def SPEAR_mixture(datasets, sessions, path_spear, snrs, target='All', level=None, n_workers=None, catalog=False, file_format='wav'):
+
+    path_minutes = []
+    for dataset_n in datasets:
+        for session_n in sessions:
+            path_minutes += mixture_minutes(dataset_n, session_n, path_spear, target=target, catalog=catalog, file_format=file_format)
+    print(f'{len(path_minutes)} minutes x {len(snrs)} SNRs to mix')
+
+    files_out = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(SPEAR_mixtureMinute, p, snrs, target, level, file_format=file_format) for p in path_minutes]
+        for future in futures:
+            files_out += future.result()
+
+    return files_out
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Mix the SPEAR simulated components at the requested SNRs.')
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--snr', type=float, nargs='+', required=True, help='SNRs in dB')
+    parser.add_argument('--target', default='All', help='All or ID{n}')
+    parser.add_argument('--level', type=float, default=None, help='output rms level in dB re full scale')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--catalog', action='store_true', help='list the minutes from the catalog (cf fct_catalog)')
+    parser.add_argument('--format', default='wav', choices=['wav', 'flac'], help='container of the components and mixtures')
+    args = parser.parse_args()
+
+    SPEAR_mixture(args.datasets, args.sessions, args.path_spear, args.snr, target=args.target, level=args.level, n_workers=args.workers, catalog=args.catalog, file_format=args.format)
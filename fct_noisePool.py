@@ -0,0 +1,148 @@
+"""
+SPEAR Challenge
+
+Pool of noise renders (Scene_full_sourceLs) shared by the minutes with the same acoustics.
+Input: the scene generation (noise_pool=<n>) and the runs (noise_pool=True).
+Output: one array render per pool entry in the NoisePool folder of Miscellaneous, linked into the minutes.
+
+The loudspeaker scene does not depend on the talkers, only on the room, reverb, table, loudspeaker
+layout and levels, the noise files and the receiver. Its receiver is however the array wearer (ID2),
+moving differently in every minute, so that every minute needs its own render.
+With noise_pool=<n> at generation, the loudspeaker scene gets instead:
+    - a static receiver at the pose of the wearer in the minute, on a grid (median position on pool_grid,
+      circular mean of the yaw on pool_yaw, no pitch nor roll): the head movements are ignored for the noise,
+    - noise files drawn by a generator seeded from the acoustics (parameters of the room and loudspeakers,
+      noise set, precondition), the receiver pose and an index drawn among n by the minute generator.
+Minutes with the same acoustics and wearer pose then have one of n identical loudspeaker scenes.
+
+With noise_pool=True at run time, the Ls job is keyed like the render cache (cf cache_key of fct_renderCache:
+scene XML, content of the referenced files, fmatconvol configuration and render settings). The first
+minute of a key renders and stores its array file in the pool, the next ones get a hard link (a copy
+across filesystems) instead of a tascar + fmatconvol job. A lock per key makes the minutes of a key
+wait for its render instead of rendering it again. Scenes generated without noise_pool have a moving
+receiver, hence a key per minute: they are rendered as before.
+
+- pool_receiverPose: Static receiver pose of the noise scene of a minute.
+- pool_rng: Generator of the noise files of a pool entry.
+- pool_lock: Lock of a pool entry.
+- pool_fetch: Link the render of a key into an output file.
+- pool_store: Store an output file as the render of a key.
+- SPEAR_noisePoolReport: Minutes per pool entry and renders saved.
+
+Command line:
+    python fct_noisePool.py --path_spear /SPEAR-dir --datasets 2 --sessions 1 2 3
+
+"""
+
+import os
+import json
+import fcntl
+import random
+import shutil
+import hashlib
+import argparse
+import numpy as np
+from pathlib import PurePath
+from contextlib import contextmanager
+from fct_PathFinder import SessionSet
+
+
+###### Global Parameters
+pool_grid = 0.25 # m, receiver position grid
+pool_yaw = 15    # degrees, receiver yaw grid
+
+
+### Static receiver pose (x, y, z, rz, ry, rx) of the noise scene of a minute, from pos_ID2.csv and ori_ID2.csv
+def pool_receiverPose(path_tascar_minute, idd=2):
+    pos = np.loadtxt(PurePath(path_tascar_minute, f'pos_ID{idd}.csv'), delimiter=',', ndmin=2)[:, 1:4]
+    ori = np.loadtxt(PurePath(path_tascar_minute, f'ori_ID{idd}.csv'), delimiter=',', ndmin=2)
+    position = np.round(np.median(pos, axis=0)/pool_grid)*pool_grid
+    yaw = np.degrees(np.arctan2(np.mean(np.sin(np.radians(ori[:, 1]))), np.mean(np.cos(np.radians(ori[:, 1])))))
+    yaw = (np.round(yaw/pool_yaw)*pool_yaw + 180) % 360 - 180
+    return tuple(round(float(v), 2) for v in position) + (round(float(yaw), 2), 0.0, 0.0)
+
+
+### Generator of the noise files of a pool entry (acoustics, receiver pose and index among the pool)
+def pool_rng(params, session_n, pose, index, precondition=False):
+    config = {'params': params, 'set': SessionSet(session_n)[1], 'pose': pose, 'precondition': precondition}
+    h = hashlib.sha256(json.dumps(config, sort_keys=True).encode()).hexdigest()
+    return random.Random(f'{h}-{index}')
+
+
+### Lock of a pool entry (the minutes of a key wait for its render)
+@contextmanager
+def pool_lock(dir_pool, key):
+    os.makedirs(dir_pool, exist_ok=True)
+    with open(PurePath(dir_pool, f'.{key}.lock'), 'w') as flock:
+        fcntl.flock(flock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(flock, fcntl.LOCK_UN)
+
+
+### Hard link (copy across filesystems) of a file, written atomically
+def _link(file_in, file_out):
+    file_tmp = PurePath(os.path.dirname(file_out), f'.tmp_pool_{os.path.basename(file_out)}_{os.getpid()}')
+    try:
+        os.link(file_in, file_tmp)
+    except OSError:
+        shutil.copyfile(file_in, file_tmp)
+    os.replace(file_tmp, file_out)
+
+
+### Link the render of a key into an output file (False if the key is not in the pool)
+def pool_fetch(dir_pool, key, array_file):
+    file_pool = PurePath(dir_pool, f'{key}{PurePath(array_file).suffix}')
+    if not os.path.exists(file_pool):
+        return False
+    _link(file_pool, array_file)
+    return True
+
+
+### Store an output file as the render of a key
+def pool_store(dir_pool, key, array_file):
+    _link(array_file, PurePath(dir_pool, f'{key}{PurePath(array_file).suffix}'))
+
+
+### Minutes per pool entry and renders saved (keys of the Ls jobs of datasets/sessions)
+def SPEAR_noisePoolReport(datasets, sessions, path_spear, convolver='fmatconvol', output_format='wav', hoa_order=None):
+    from fct_tascarScene import tascar_jobList, tascar_fmatconvConf, tascar_renderSettings, hoa_order as hoa_order_default
+    from fct_renderCache import cache_key
+
+    hoa_order = hoa_order_default if hoa_order is None else hoa_order
+    path_fmatconv = tascar_fmatconvConf(path_spear, hoa_order)
+    settings = tascar_renderSettings(convolver, output_format, hoa_order)
+    keys = {}
+    for dataset_n in datasets:
+        if dataset_n == 1:
+            continue
+        for session_n in sessions:
+            for job in tascar_jobList(dataset_n, session_n, path_spear):
+                if job['sound'] == 'full' and job['source'] == 'Ls':
+                    key = cache_key(job, path_fmatconv, settings)
+                    keys.setdefault(key, []).append(f'D{dataset_n}_S{session_n}_M{job["minute"]}')
+
+    n_minutes = sum(len(minutes) for minutes in keys.values())
+    report = {'minutes': n_minutes, 'renders': len(keys), 'renders_saved': n_minutes - len(keys),
+              'entries': {key[0:16]: minutes for key, minutes in sorted(keys.items(), key=lambda kv: -len(kv[1]))}}
+    print(f'{n_minutes} noise scenes, {len(keys)} distinct renders ({report["renders_saved"]} tascar + convolution jobs saved)')
+    for key, minutes in list(report['entries'].items())[0:10]:
+        print(f'    {key}: {len(minutes)} minutes')
+    return report
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Minutes sharing the same noise render (pool entries) in the generated scenes.')
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--json', default=None, help='also write the report in this file')
+    args = parser.parse_args()
+
+    report = SPEAR_noisePoolReport(args.datasets, args.sessions, args.path_spear)
+    if args.json is not None:
+        with open(args.json, 'w') as fout:
+            json.dump(report, fout, indent=1)
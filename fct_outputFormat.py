@@ -0,0 +1,230 @@
+"""
+SPEAR Challenge
+
+Compressed, chunked containers for the array and reference outputs.
+Input: datasets, sessions and spear path (reference folders holding array_*.wav and ref_*.wav).
+Output: the same outputs as .flac files, or one HDF5 file per session, and a report against the .wav files.
+
+The outputs are 32 bit .wav files: uncompressed and read as a whole or by seeking in raw samples.
+Two containers are supported:
+    flac: one .flac file per output, in 24 bit (the highest resolution of FLAC, up to 8 channels).
+          The conversion from the 32 bit .wav files is lossy: the 8 least significant bits are dropped
+          (error below 2**-23 of full scale), so removing the .wav files needs accept_24bit=True.
+          The FLAC frames are the time chunks and the seek table gives random access, soundfile reads them.
+          The runs can write it directly (output_format='flac' of tascar_runJob and the schedulers,
+          file_format='flac' of fct_mixture), the catalog and fct_reader handle both containers.
+    hdf5: one outputs_D{d}_S{s}.h5 file per session in its reference folder, one dataset /{minute}/{name}
+          per output, int32 samples in chunks of chunk_s seconds, compressed with shuffle + gzip (lossless).
+          Needs h5py (optional dependency, only imported for this container).
+          fct_reader and the catalog do not read this container: read it with h5_read, and keep the .wav
+          files (no remove) for the loaders of fct_reader.
+
+- output_files: Array and reference .wav outputs of datasets/sessions, per session.
+- SPEAR_convertOutputs: Convert the .wav outputs to flac or hdf5 (process pool), optionally removing the .wav files.
+- h5_read: Read a window of an output from a session HDF5 file.
+- SPEAR_outputFormatReport: Compression ratio, read latency of random windows and max error against the .wav files.
+
+Command line:
+    python fct_outputFormat.py convert --path_spear /SPEAR-dir --datasets 2 --sessions 1 --format flac
+    python fct_outputFormat.py report --path_spear /SPEAR-dir --datasets 2 --sessions 1 --format flac --json report.json
+
+"""
+
+import os
+import json
+import time
+import argparse
+import importlib.util
+import numpy as np
+import soundfile as sf
+from pathlib import Path
+from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor
+from fct_PathFinder import PathFinder
+from fct_postProcessing import SPEAR_postProcess
+
+
+###### Global Parameters
+formats = ['flac', 'hdf5']
+chunk_s = 1 # seconds per HDF5 chunk
+gzip_level = 4
+int32_scale = 2**31
+window_s = 1 # seconds read at random positions by the report
+n_windows = 50
+
+
+### HDF5 file of a session
+def h5_file(dataset_n, session_n, path_spear):
+    return PurePath(PathFinder(dataset_n, session_n, 'reference', path_spear=path_spear), f'outputs_D{dataset_n}_S{session_n}.h5')
+
+
+### Array and reference .wav outputs of datasets/sessions: {(dataset_n, session_n): [files]}
+def output_files(datasets, sessions, path_spear):
+    outputs = {}
+    for dataset_n in datasets:
+        for session_n in sessions:
+            path_ref = Path(PathFinder(dataset_n, session_n, 'reference', path_spear=path_spear))
+            files = sorted(f for f in path_ref.glob('*/*.wav') if f.name[0]!='.' and f.parent.name[0]!='.'
+                           and f.name.startswith(('array_', 'ref_')))
+            if files:
+                outputs[(dataset_n, session_n)] = files
+    return outputs
+
+
+### Worker: .wav outputs to .flac (single read pass, cf fct_postProcessing)
+def _toFlac(files, remove):
+    for file_wav in files:
+        file_flac = file_wav.with_suffix('.flac')
+        if not os.path.exists(file_flac):
+            SPEAR_postProcess(file_wav, [{'file': file_flac}], n_frames=None)
+        if remove:
+            os.remove(file_wav)
+    return len(files)
+
+
+### Worker: .wav outputs of a session to its HDF5 file (one writer per file)
+def _toHdf5(files, path_h5, remove):
+    import h5py # optional dependency
+    with h5py.File(path_h5, 'a') as h5:
+        for file_wav in files:
+            name = f'{file_wav.parent.name}/{file_wav.stem}'
+            if name in h5:
+                continue
+            with sf.SoundFile(str(file_wav)) as fin:
+                chunk = min(int(chunk_s*fin.samplerate), fin.frames)
+                dset = h5.create_dataset(name + '.tmp', shape=(fin.frames, fin.channels), dtype='int32',
+                                         chunks=(max(chunk, 1), fin.channels), compression='gzip',
+                                         compression_opts=gzip_level, shuffle=True)
+                dset.attrs['samplerate'] = fin.samplerate
+                dset.attrs['scale'] = int32_scale
+                for start in range(0, fin.frames, max(chunk, 1)):
+                    dset[start:start+chunk] = fin.read(chunk, dtype='int32', always_2d=True)
+            h5.move(name + '.tmp', name) # a dataset is complete once it has its name
+        h5.flush()
+    if remove:
+        for file_wav in files:
+            os.remove(file_wav)
+    return len(files)
+
+
+### Convert the .wav outputs of datasets/sessions to flac or hdf5
+### (the flac files are 24 bit: the 32 bit .wav files are only removed with accept_24bit)
+def SPEAR_convertOutputs(datasets, sessions, path_spear, file_format='flac', remove=False, n_workers=None, accept_24bit=False):
+    if file_format not in formats:
+        raise ValueError(f'Unknown format {file_format}, valid formats are {formats}')
+    if file_format == 'flac' and remove and not accept_24bit:
+        raise ValueError('The flac files are 24 bit, removing the 32 bit .wav files loses their 8 least significant bits: '
+                         'set accept_24bit=True (--accept_24bit) to remove them anyway')
+    if file_format == 'hdf5' and importlib.util.find_spec('h5py') is None:
+        raise ImportError('The hdf5 container needs h5py (pip install h5py)')
+
+    outputs = output_files(datasets, sessions, path_spear)
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        if file_format == 'flac':
+            futures = [pool.submit(_toFlac, [f], remove) for files in outputs.values() for f in files]
+        else:
+            futures = [pool.submit(_toHdf5, files, str(h5_file(dataset_n, session_n, path_spear)), remove)
+                       for (dataset_n, session_n), files in outputs.items()]
+        n_files = sum(future.result() for future in futures)
+    print(f'{n_files} outputs of {len(outputs)} sessions converted to {file_format}')
+    return n_files
+
+
+### Read a window of an output from a session HDF5 file, as float64 like soundfile
+def h5_read(h5, minute, name, start=0, frames=None):
+    dset = h5[f'{minute}/{name}']
+    stop = dset.shape[0] if frames is None else min(start+frames, dset.shape[0])
+    return dset[start:stop].astype(np.float64) / dset.attrs['scale']
+
+
+### Read latency of n random windows of a file with a reader
+def _latency(read, n_total, fs, rng):
+    n = min(int(window_s*fs), n_total)
+    latencies = []
+    for start in rng.integers(0, max(n_total-n, 0)+1, n_windows):
+        t0 = time.perf_counter()
+        read(int(start), n)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+
+### Compression ratio, read latency of random windows and max error against the .wav files
+def SPEAR_outputFormatReport(datasets, sessions, path_spear, file_format='flac', seed=0):
+    rng = np.random.default_rng(seed)
+    report = {'format': file_format, 'window_s': window_s, 'files': 0,
+              'bytes_wav': 0, 'bytes_compressed': 0, 'max_error': 0.0}
+    lat_wav, lat_comp = [], []
+
+    for (dataset_n, session_n), files in output_files(datasets, sessions, path_spear).items():
+        h5 = None
+        if file_format == 'hdf5':
+            import h5py # optional dependency
+            path_h5 = h5_file(dataset_n, session_n, path_spear)
+            if not os.path.exists(path_h5):
+                continue
+            h5 = h5py.File(path_h5, 'r')
+            report['bytes_compressed'] += os.path.getsize(path_h5)
+        try:
+            for file_wav in files:
+                minute, name = file_wav.parent.name, file_wav.stem
+                if h5 is None:
+                    file_flac = file_wav.with_suffix('.flac')
+                    if not os.path.exists(file_flac):
+                        continue
+                    report['bytes_compressed'] += os.path.getsize(file_flac)
+                    read_comp = lambda start, n: sf.read(str(file_flac), frames=n, start=start, always_2d=True)[0]
+                elif f'{minute}/{name}' in h5:
+                    read_comp = lambda start, n: h5_read(h5, minute, name, start, n)
+                else:
+                    continue
+                read_wav = lambda start, n: sf.read(str(file_wav), frames=n, start=start, always_2d=True)[0]
+
+                info = sf.info(str(file_wav))
+                report['files'] += 1
+                report['bytes_wav'] += os.path.getsize(file_wav)
+                lat_wav += _latency(read_wav, info.frames, info.samplerate, rng)
+                lat_comp += _latency(read_comp, info.frames, info.samplerate, rng)
+                error = np.abs(read_wav(0, info.frames) - read_comp(0, info.frames)).max() if info.frames else 0
+                report['max_error'] = max(report['max_error'], float(error))
+        finally:
+            if h5 is not None:
+                h5.close()
+
+    if report['files'] == 0:
+        print(f'No output converted to {file_format}')
+        return report
+    report['ratio'] = report['bytes_wav'] / max(report['bytes_compressed'], 1)
+    for key, lat in (('wav', lat_wav), (file_format, lat_comp)):
+        report[f'read_ms_{key}'] = {f'p{p}': float(np.percentile(lat, p))*1e3 for p in (50, 90, 99)}
+
+    print(f'{report["files"]} outputs: {report["bytes_wav"]/1e6:.1f} MB wav, {report["bytes_compressed"]/1e6:.1f} MB {file_format} '
+          f'(ratio {report["ratio"]:.2f}), max error {report["max_error"]:.2e}')
+    for key in ('wav', file_format):
+        lat = report[f'read_ms_{key}']
+        print(f'{key:>5} read of {window_s}s windows: ' + ', '.join(f'{p} {v:.2f} ms' for p, v in lat.items()))
+    return report
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compressed containers of the SPEAR array and reference outputs.')
+    parser.add_argument('command', choices=['convert', 'report'])
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[1, 2, 3, 4])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--format', default='flac', choices=formats)
+    parser.add_argument('--remove', action='store_true', help='remove the .wav files once converted')
+    parser.add_argument('--accept_24bit', action='store_true', help='allow --remove with flac, whose 24 bit samples drop 8 bits of the .wav files')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--json', default=None, help='also write the report in this file')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        SPEAR_convertOutputs(args.datasets, args.sessions, args.path_spear, file_format=args.format,
+                             remove=args.remove, n_workers=args.workers, accept_24bit=args.accept_24bit)
+    else:
+        report = SPEAR_outputFormatReport(args.datasets, args.sessions, args.path_spear, file_format=args.format)
+        if args.json is not None:
+            with open(args.json, 'w') as fout:
+                json.dump(report, fout, indent=1)
@@ -0,0 +1,168 @@
+"""
+SPEAR Challenge
+
+Sweep of the room and loudspeaker parameters of datasets 3 and 4 (session_modif.csv).
+Input: datasets, sessions, spear path (pos_ID*.csv of the TASCAR minutes), a seed and the parameter ranges.
+Output: session_modif.csv of each session, one row per minute, in the format read by fct_sceneParams.
+
+The configurations are drawn with numpy in batches and rejected on the constraints:
+    room:        room_x/y/z, absorption, damping and t_scattering uniform in their ranges, center_z = room_z/2
+                 (as in Dataset 2), center_x/y uniform among the centers keeping every point of the
+                 talker trajectories at least wall_margin from the walls
+    loudspeakers: ls_num uniform in its range, positions uniform at least wall_margin from the walls
+                 (z in the ls_z range) and at least talker_distance from every point of the pos_ID*.csv
+                 trajectories of the minute (wearer ID2 included), levels uniform in their range
+Each room of a batch gets n_candidates loudspeaker positions, the first ls_num valid ones are kept, and
+the room is rejected when less are valid.
+
+Every minute has its own generator seeded from (seed, dataset, session, minute): the parameters of a
+minute do not depend on the other minutes nor on the order of the sweep.
+The loudspeaker positions are absolute (cf param_lookup) and, like the room, rounded to the cm.
+
+- sweep_talkerPoints: Points of the talker trajectories of a minute.
+- sweep_sample: Draw n configurations satisfying the constraints (vectorised batches).
+- sweep_writeCsv: Write the configurations of a session in session_modif.csv.
+- SPEAR_paramSweep: One configuration per minute of datasets/sessions.
+
+Command line:
+    python fct_paramSweep.py --path_spear /SPEAR-dir --datasets 3 4 --seed 42
+
+"""
+
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from pathlib import PurePath
+from fct_PathFinder import PathFinder
+from fct_sceneParams import ls_max, name_csv, cols_scalar, cols_ls
+from fct_tascarScene import tascar_minutes, tascar_IDs, source_lvl, option
+from fct_trajectory import traj_read
+
+
+###### Global Parameters
+ranges = {'room_x':       (4.0, 10.0),
+          'room_y':       (4.0, 10.0),
+          'room_z':       (2.5, 4.0),
+          'absorption':   (0.3, 0.9),
+          'damping':      (0.1, 0.5),
+          't_scattering': (0.0, 0.5),
+          'ls_num':       (6, ls_max),
+          'ls_z':         (0.3, 2.0),
+          'ls_levels':    (source_lvl-18, source_lvl-8),
+          }
+wall_margin = 0.5     # m, talkers and loudspeakers to the walls
+talker_distance = 1.0 # m, loudspeakers to the talker trajectories
+n_candidates = 4*ls_max # loudspeaker positions drawn per room
+grid_points = 0.05    # m, the trajectory points are merged on this grid for the distances
+batch = 64            # rooms drawn at once
+max_batches = 200
+
+
+### Points of the talker trajectories of a minute (pos_ID*.csv, merged on grid_points)
+def sweep_talkerPoints(dataset_n, session_n, minute, path_spear, catalog=False):
+    path_minute = PurePath(PathFinder(dataset_n, session_n, option, path_spear=path_spear), minute)
+    points = np.concatenate([traj_read(PurePath(path_minute, f'pos_ID{idd}.csv'))[1]
+                             for idd in tascar_IDs(dataset_n, session_n, minute, path_spear, catalog=catalog)])
+    return np.unique(np.round(points/grid_points), axis=0)*grid_points
+
+
+### Draw n configurations satisfying the constraints, as the columns of param_readCsv (without minute)
+def sweep_sample(rng, n, points, ranges=ranges, wall_margin=wall_margin, talker_distance=talker_distance):
+    uniform = lambda name, shape: rng.uniform(*ranges[name], shape)
+    p_min, p_max = points.min(axis=0), points.max(axis=0)
+    rows = {col: [] for col in cols_scalar + cols_ls + ['ls_num']}
+    n_rows = 0
+
+    for _ in range(max_batches):
+        ### Rooms, centered so that the talkers are inside with the margin
+        room = np.stack([uniform('room_x', batch), uniform('room_y', batch), uniform('room_z', batch)], axis=1)
+        c_min = p_max[0:2] + wall_margin - room[:, 0:2]/2
+        c_max = p_min[0:2] - wall_margin + room[:, 0:2]/2
+        valid = np.all(c_max >= c_min, axis=1) & (p_min[2] >= wall_margin) & (p_max[2] <= room[:, 2]-wall_margin)
+        center = np.concatenate([c_min + rng.random((batch, 2))*(c_max-c_min), room[:, 2:3]/2], axis=1)
+
+        ### Loudspeaker candidates inside each room, far enough from the talkers
+        u = rng.random((batch, n_candidates, 2)) - 0.5
+        ls_xy = center[:, None, 0:2] + u*(room[:, None, 0:2] - 2*wall_margin)
+        ls_z = np.minimum(uniform('ls_z', (batch, n_candidates)), room[:, 2:3]-wall_margin)
+        ls = np.concatenate([ls_xy, ls_z[..., None]], axis=2)
+        d2 = (np.sum(ls**2, axis=2)[..., None] + np.sum(points**2, axis=1) - 2*ls @ points.T).min(axis=2)
+        ls_ok = d2 >= talker_distance**2
+
+        ls_num = rng.integers(ranges['ls_num'][0], ranges['ls_num'][1]+1, batch)
+        valid &= ls_ok.sum(axis=1) >= ls_num
+        first = np.argsort(~ls_ok, axis=1, kind='stable')[:, 0:ls_max] # valid candidates first, in drawing order
+        levels = uniform('ls_levels', (batch, ls_max))
+
+        for k in np.flatnonzero(valid)[0:n-n_rows]:
+            ls_k = np.full((ls_max, 3), np.nan)
+            ls_k[0:ls_num[k]] = ls[k, first[k, 0:ls_num[k]]]
+            scalars = {'t_scattering': uniform('t_scattering', None), 'absorption': uniform('absorption', None),
+                       'damping': uniform('damping', None), 'room_x': room[k, 0], 'room_y': room[k, 1], 'room_z': room[k, 2],
+                       'center_x': center[k, 0], 'center_y': center[k, 1], 'center_z': center[k, 2]}
+            for col in cols_scalar:
+                rows[col].append(round(float(scalars[col]), 2))
+            rows['ls_levels'].append(np.where(np.arange(ls_max) < ls_num[k], np.round(levels[k]), np.nan))
+            for n_col, col in enumerate(['ls_x_all', 'ls_y_all', 'ls_z_all']):
+                rows[col].append(np.round(ls_k[:, n_col], 2))
+            rows['ls_num'].append(int(ls_num[k]))
+            n_rows += 1
+        if n_rows == n:
+            return {col: np.array(values) for col, values in rows.items()}
+
+    raise RuntimeError(f'Only {n_rows} of {n} configurations satisfy the constraints after {max_batches} batches, relax the ranges')
+
+
+### Write the configurations of a session in session_modif.csv (lists as "[a, b, c]", cf param_readCsv)
+def sweep_writeCsv(path_csv, minutes, columns):
+    df = pd.DataFrame({'minute': [int(minute) for minute in minutes]})
+    for col in cols_scalar:
+        df[col] = columns[col]
+    for col in cols_ls:
+        df[col] = [str([float(v) for v in row[0:n]]) for row, n in zip(columns[col], columns['ls_num'])]
+    path_tmp = f'{path_csv}.tmp'
+    df.to_csv(path_tmp, index=False)
+    os.replace(path_tmp, path_csv)
+
+
+### One configuration per minute of datasets/sessions (existing session_modif.csv kept unless force)
+def SPEAR_paramSweep(datasets, sessions, path_spear, seed=42, ranges=ranges, catalog=False, force=False):
+    written = []
+    for dataset_n in datasets:
+        if dataset_n < 3:
+            continue
+        for session_n in sessions:
+            path_session = PathFinder(dataset_n, session_n, option, path_spear=path_spear)
+            path_csv = PurePath(path_session, name_csv)
+            minutes = tascar_minutes(dataset_n, session_n, path_spear, catalog=catalog)
+            if not minutes:
+                continue
+            if os.path.exists(path_csv) and not force:
+                print(f'{path_csv} exists, kept (force=True to replace it)')
+                continue
+
+            samples = []
+            for minute in minutes:
+                rng = np.random.default_rng([seed, dataset_n, session_n, int(minute)])
+                samples.append(sweep_sample(rng, 1, sweep_talkerPoints(dataset_n, session_n, minute, path_spear, catalog=catalog), ranges=ranges))
+            columns = {col: np.concatenate([sample[col] for sample in samples]) for col in samples[0]}
+            sweep_writeCsv(path_csv, minutes, columns)
+            written.append(path_csv)
+            print(f'Written {path_csv} ({len(minutes)} minutes)')
+    return written
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Sample the room and loudspeaker parameters of datasets 3/4 into session_modif.csv.')
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[3, 4])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--catalog', action='store_true', help='list the minutes and talkers from the catalog (cf fct_catalog)')
+    parser.add_argument('--force', action='store_true', help='replace the existing session_modif.csv')
+    args = parser.parse_args()
+
+    SPEAR_paramSweep(args.datasets, args.sessions, args.path_spear, seed=args.seed, catalog=args.catalog, force=args.force)
@@ -0,0 +1,140 @@
+"""
+SPEAR Challenge
+
+Single-pass post-processing of the array files.
+Input: an array .wav file and a list of sinks.
+Output: each sink file, written block by block during a single read of the input.
+
+Replaces the whole-file sf.read of tascar_60s_check and of the reference extraction: the input
+is read once in blocks, cut to fs_out*60 samples, and each block is dispatched to every sink.
+The memory used is one block whatever the number of channels.
+
+A sink is a dict with:
+    'file':     output file (can be the input file, it is then replaced at the end)
+    'channels': list of channels (0-based) or slice to keep, None for all (default)
+    'gain':     linear gain applied to the samples (default 1)
+    'subtype':  soundfile subtype of the output (default PCM_32 for wav, PCM_24 for flac)
+The container of an output is given by its extension (cf output_formats): .wav or .flac (compressed,
+time-chunked in FLAC frames, seekable; 24 bit is the highest resolution of FLAC).
+
+- tmp_name: Temporary file next to an output, renamed onto it once written.
+- sink_array: Sink of the full array file.
+- sink_ref: Sink of the binaural reference (channels 5 and 6 of the array).
+- SPEAR_postProcess: Read the input once and write all the sinks.
+- SPEAR_sumArrays: Sum several array files block by block into a new file (linear superposition).
+
+"""
+
+import os
+import socket
+import soundfile as sf
+from pathlib import PurePath
+
+
+###### Global Parameters
+fs_out = 48000
+block_size = 2**16
+ref_channels = slice(4, None) # channels 5 and 6 of the array are the binaural reference
+output_formats = {'wav': ('WAV', 'PCM_32'), 'flac': ('FLAC', 'PCM_24')} # extension: (soundfile format, default subtype)
+
+
+### Soundfile format and default subtype of an output file, from its extension
+def output_format(file_out):
+    ext = os.path.splitext(str(file_out))[1][1:].lower()
+    if ext not in output_formats:
+        raise ValueError(f'Unknown output format {ext} of {file_out}, valid formats are {list(output_formats)}')
+    return output_formats[ext]
+
+
+### Temporary file next to an output (same filesystem for os.replace), unique per host and process.
+### Created by its writer, so that it gets the permissions of the umask like the direct outputs.
+def tmp_name(file_out, ext=None):
+    file_out = os.path.abspath(str(file_out))
+    ext = os.path.splitext(file_out)[1] if ext is None else ext
+    return str(PurePath(os.path.dirname(file_out), f'.tmp_{os.path.basename(file_out)}.{socket.gethostname()}.{os.getpid()}{ext}'))
+
+
+### Sink of the full array file
+def sink_array(array_file, gain=1):
+    return {'file': array_file, 'channels': None, 'gain': gain}
+
+
+### Sink of the binaural reference (channels 5 and 6 of the array)
+def sink_ref(path_out, dataset_n, session_n, minute, idd, gain=1, file_format='wav'):
+    ref_file = PurePath(path_out, f'ref_D{dataset_n}_S{session_n}_M{minute}_ID{idd}.{file_format}')
+    return {'file': ref_file, 'channels': ref_channels, 'gain': gain}
+
+
+### Read the input once and write all the sinks
+def SPEAR_postProcess(file_in, sinks, n_frames=fs_out*60, blocksize=block_size):
+
+    file_in = str(file_in)
+    outputs = []
+    try:
+        with sf.SoundFile(file_in) as fin:
+            n_out = fin.frames if n_frames is None else min(fin.frames, n_frames)
+
+            ### Open the sinks (temporary file next to the target so that the input can be replaced)
+            for sink in sinks:
+                channels = sink.get('channels')
+                if channels is None:
+                    channels = slice(None)
+                n_ch = len(range(fin.channels)[channels]) if isinstance(channels, slice) else len(channels)
+                fmt, subtype = output_format(sink['file'])
+                file_tmp = tmp_name(sink['file'])
+                fout = sf.SoundFile(file_tmp, 'w', samplerate=fin.samplerate, channels=n_ch,
+                                    subtype=sink.get('subtype', subtype), format=fmt)
+                outputs.append((fout, channels, sink.get('gain', 1), file_tmp, str(sink['file'])))
+
+            for block in fin.blocks(blocksize=blocksize, dtype='float64', always_2d=True, frames=n_out):
+                for fout, channels, gain, _, _ in outputs:
+                    out = block[:, channels]
+                    fout.write(out*gain if gain != 1 else out)
+
+        for fout, _, _, file_tmp, file_out in outputs:
+            fout.close()
+            os.replace(file_tmp, file_out)
+
+    except BaseException:
+        for fout, _, _, file_tmp, _ in outputs:
+            fout.close()
+            if os.path.exists(file_tmp):
+                os.remove(file_tmp)
+        raise
+
+    return [sink['file'] for sink in sinks]
+
+
+### Sum several array files block by block into a new file (linear superposition)
+def SPEAR_sumArrays(files_in, file_out, n_frames=fs_out*60, blocksize=block_size, subtype=None):
+
+    fins = [sf.SoundFile(str(f)) for f in files_in]
+    file_tmp = None
+    try:
+        fs, n_ch = fins[0].samplerate, fins[0].channels
+        for fin in fins[1:]:
+            if fin.samplerate != fs or fin.channels != n_ch:
+                raise ValueError(f'{fin.name} does not have the format of {fins[0].name}')
+        n_out = max(fin.frames for fin in fins)
+        if n_frames is not None:
+            n_out = min(n_out, n_frames)
+
+        fmt, subtype_default = output_format(file_out)
+        file_tmp = tmp_name(file_out)
+        with sf.SoundFile(file_tmp, 'w', samplerate=fs, channels=n_ch, subtype=subtype or subtype_default, format=fmt) as fout:
+            for start in range(0, n_out, blocksize):
+                n = min(blocksize, n_out-start)
+                acc = fins[0].read(n, dtype='float64', always_2d=True, fill_value=0)
+                for fin in fins[1:]:
+                    acc += fin.read(n, dtype='float64', always_2d=True, fill_value=0)
+                fout.write(acc)
+        os.replace(file_tmp, str(file_out))
+        file_tmp = None
+
+    finally:
+        for fin in fins:
+            fin.close()
+        if file_tmp is not None and os.path.exists(file_tmp):
+            os.remove(file_tmp)
+
+    return file_out
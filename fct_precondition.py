@@ -0,0 +1,190 @@
+"""
+SPEAR Challenge
+
+Preconditioning of the audio assets of the scenes (talker audio and ambient noise) at fs_out.
+Input: datasets, sessions and spear path.
+Output: resampled copies in Miscellaneous/Preconditioned and their index (precondition_index.json).
+
+Every sndfile of the scenes is loaded by tascar with resample="true", so each render resampled the
+talker audio and up to 10 looped noise files again, for every scene of every minute. Here the
+audio_ID*.wav of the TASCAR minutes and the AmbientNoise/{Train,Dev,Eval} files are converted to
+fs_out once, by a pool of workers. The copies are named after the sha256 of the source content,
+so a file is converted again only when its content changes, and identical sources share a copy.
+Files already at fs_out are not copied, the scenes keep pointing at them.
+
+The scene generation (precondition=True, cf fct_tascarScene) then references the copies with
+resample="false". levelmode="calib" is kept: it is a fixed gain applied by tascar when loading.
+
+The resampling is a polyphase windowed-sinc (Kaiser) filter in numpy, computed block by block.
+
+- precond_resample: Resample a (frames, channels) signal from fs_in to fs_out.
+- precond_sources: Talker audio and noise files of datasets/sessions.
+- SPEAR_precondition: Convert the sources to fs_out (process pool) and update the index.
+- precond_load: Index of the preconditioned copies, loaded once per process.
+- precond_lookup: File to reference in a scene for a source (copy or original) and whether tascar must resample it.
+
+"""
+
+import os
+import json
+import argparse
+from math import gcd
+from functools import lru_cache
+import numpy as np
+import soundfile as sf
+from pathlib import Path
+from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor
+from fct_PathFinder import PathFinder
+from fct_renderCache import cache_fileHash
+
+
+###### Global Parameters
+fs_out = 48000
+n_zeros = 32 # zero crossings of the sinc on each side (at the lowest of the two rates)
+kaiser_beta = 8.6
+block_size = 2**15 # output frames computed at once
+name_index = 'precondition_index.json'
+
+
+### Resample a (frames, channels) signal from fs_in to fs_out (polyphase windowed sinc)
+def precond_resample(x, fs_in, fs_out=fs_out):
+    x = np.asarray(x, dtype=np.float64)
+    if fs_in == fs_out:
+        return x
+    g = gcd(int(fs_in), int(fs_out))
+    up, down = int(fs_out)//g, int(fs_in)//g
+
+    ### Low pass at the lowest Nyquist frequency, designed at the upsampled rate fs_in*up
+    half_len = n_zeros*max(up, down)
+    t = np.arange(-half_len, half_len+1)
+    h = np.sinc(t/max(up, down)) * np.kaiser(2*half_len+1, kaiser_beta) * up/max(up, down)
+
+    ### y[n] = sum_k h[n*down - k*up] x[k], with |n*down - k*up| <= half_len
+    n_taps = 2*half_len//up + 1
+    n_in, n_out = x.shape[0], -(-x.shape[0]*up//down)
+    pad = n_taps
+    x_pad = np.concatenate([np.zeros((pad, x.shape[1])), x, np.zeros((pad, x.shape[1]))])
+    y = np.empty((n_out, x.shape[1]))
+    for start in range(0, n_out, block_size):
+        j = np.arange(start, min(start+block_size, n_out)) * down
+        k = -(-(j-half_len)//up)[:, None] + np.arange(n_taps)[None, :]
+        idx_h = j[:, None] - k*up + half_len
+        valid = (idx_h >= 0) & (idx_h <= 2*half_len) & (k >= -pad) & (k < n_in+pad)
+        weights = np.where(valid, h[np.clip(idx_h, 0, 2*half_len)], 0)
+        samples = x_pad[np.clip(k+pad, 0, n_in+2*pad-1)]
+        y[start:start+len(j)] = np.einsum('bk,bkc->bc', weights, samples)
+    return y
+
+
+### Folder and index of the preconditioned copies
+def precond_dir(path_spear):
+    return PathFinder(0, 0, 'precondition', path_spear=path_spear)
+
+
+### Talker audio of the TASCAR minutes and noise files of all the sets
+def precond_sources(datasets, sessions, path_spear):
+    sources = []
+    for dataset_n in datasets:
+        if dataset_n == 1:
+            continue
+        for session_n in sessions:
+            path_session = Path(PathFinder(dataset_n, session_n, 'Tascar', path_spear=path_spear))
+            sources += sorted(f for f in path_session.glob('*/audio*.wav') if f.name[0]!='.' and f.parent.name[0]!='.')
+    path_noise = Path(PathFinder(0, 0, 'noise', path_spear=path_spear))
+    sources += sorted(f for f in path_noise.glob('*/*.wav') if f.name[0]!='.' and f.parent.name[0]!='.')
+    return [str(f) for f in sources]
+
+
+### Worker: convert a source (if there is no copy of the same content yet)
+def _preconditionFile(path_src, path_dir):
+    info = sf.info(path_src)
+    key = cache_fileHash(path_src)
+    if info.samplerate == fs_out:
+        return {'hash': key, 'file': None, 'samplerate': info.samplerate}
+
+    file_out = f'{key[:24]}_{fs_out}.wav'
+    path_out = PurePath(path_dir, file_out)
+    if not os.path.exists(path_out):
+        x, fs_in = sf.read(path_src, dtype='float64', always_2d=True)
+        y = precond_resample(x, fs_in)
+        path_tmp = PurePath(path_dir, f'.{file_out}.{os.getpid()}.tmp')
+        sf.write(str(path_tmp), y.astype(np.float32), fs_out, subtype='FLOAT', format='WAV')
+        os.replace(path_tmp, path_out)
+    return {'hash': key, 'file': file_out, 'samplerate': info.samplerate}
+
+
+### Convert the sources of datasets/sessions to fs_out and update the index
+def SPEAR_precondition(datasets, sessions, path_spear, n_workers=None):
+    path_dir = precond_dir(path_spear)
+    os.makedirs(path_dir, exist_ok=True)
+    index = _readIndex(path_spear)
+
+    ### Sources not changed since the last run (same size and modification time) and whose copy exists are skipped
+    todo = []
+    for path_src in precond_sources(datasets, sessions, path_spear):
+        stat = os.stat(path_src)
+        entry = index.get(path_src)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns \
+                and (entry['file'] is None or os.path.exists(PurePath(path_dir, entry['file']))):
+            continue
+        todo.append((path_src, stat))
+    print(f'{len(todo)} audio files to precondition at {fs_out} Hz')
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(_preconditionFile, path_src, str(path_dir)) for path_src, stat in todo]
+        for (path_src, stat), future in zip(todo, futures):
+            entry = future.result()
+            entry.update({'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+            index[path_src] = entry
+
+    path_tmp = PurePath(path_dir, f'.{name_index}.{os.getpid()}.tmp')
+    with open(path_tmp, 'w') as fout:
+        json.dump(index, fout, indent=1, sort_keys=True)
+    os.replace(path_tmp, PurePath(path_dir, name_index))
+    precond_load.cache_clear()
+    return index
+
+
+def _readIndex(path_spear):
+    path_index = PurePath(precond_dir(path_spear), name_index)
+    if not os.path.exists(path_index):
+        return {}
+    with open(path_index) as fin:
+        return json.load(fin)
+
+
+### Index of the preconditioned copies, loaded once per process
+@lru_cache(maxsize=None)
+def precond_load(path_spear):
+    return _readIndex(path_spear)
+
+
+### Name of the copy to reference in a scene for a source (None: keep the original), and whether tascar must resample it
+### A source changed since SPEAR_precondition (size or modification time) or whose copy is missing is not preconditioned
+def precond_lookup(path_src, path_spear):
+    entry = precond_load(str(path_spear)).get(str(path_src))
+    if entry is None:
+        return None, True # not preconditioned, tascar resamples the original
+    try:
+        stat = os.stat(path_src)
+    except FileNotFoundError:
+        return None, True
+    if entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns \
+            or (entry['file'] is not None and not os.path.exists(PurePath(precond_dir(path_spear), entry['file']))):
+        print(f'{path_src} changed since its preconditioning, resampled by tascar (run SPEAR_precondition again)')
+        return None, True
+    return entry['file'], False # entry['file'] is None when the source is already at fs_out
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert the talker audio and the ambient noise of the SPEAR scenes to fs_out once.')
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    SPEAR_precondition(args.datasets, args.sessions, args.path_spear, n_workers=args.workers)
@@ -0,0 +1,258 @@
+"""
+SPEAR Challenge
+
+Preflight validation of the generated Tascar_scenes.tsc files, before the runs.
+Input: datasets, sessions and spear path (minutes from the TASCAR tree, or from the catalog).
+Output: a report (dict, JSON) with one entry per issue found, the runs can refuse to start on errors.
+
+A broken scene is otherwise only found when tascar_renderfile fails on it, possibly hours into a batch.
+Every minute is checked on a process pool, without rendering anything:
+    xml:        the file exists, has no template placeholder left ({name}) and is well-formed XML
+    scenes:     the Scene_{sound}_source{source}{idd} scenes of the jobs of the minute exist (cf tascar_jobList),
+                with their talker and a hoa3d_enc receiver (cf tascar_sceneOrder)
+    files:      the sndfile (talker audio, noise) and importcsv files exist, relative to the minute folder
+    audio:      the sound files can be opened, talker audio (loop="0") shorter than the session is a warning
+    csv:        the trajectories have 4 finite columns (time + 3 values), increasing times,
+                start at 0 and end less than csv_end_s before the session duration (warnings)
+    geometry:   the loudspeakers and every point of the position trajectories are inside the shoebox
+                of the room (facegroup shoebox centered on its position)
+
+Each issue is {dataset, session, minute, level ('error' or 'warning'), check, file, scene, message}.
+The sound files shared by the minutes (noise) are opened once per worker.
+
+- preflight_minute: Issues of the scene file of a minute.
+- SPEAR_preflight: Check all the minutes of datasets/sessions on a process pool, with the report.
+
+Command line:
+    python fct_preflight.py --path_spear /SPEAR-dir --datasets 2 3 4 --json preflight.json
+
+"""
+
+import os
+import re
+import sys
+import json
+import argparse
+import numpy as np
+import soundfile as sf
+import xml.etree.ElementTree as ET
+from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor
+from fct_PathFinder import PathFinder
+from fct_tascarScene import tascar_minutes, tascar_IDs, option
+from fct_trajectory import traj_read
+
+
+###### Global Parameters
+csv_start_s = 0.1  # first time of a trajectory after which it is held from its first point (warning)
+csv_end_s = 1.0    # last time of a trajectory at most this before the end of the session (warning)
+geometry_tol = 1e-3
+_audio = {} # sf.info of the sound files already opened by the worker (path: info or error)
+
+
+### Issue of a minute
+def preflight_issue(level, check, message, file=None, scene=None):
+    return {'level': level, 'check': check, 'file': file, 'scene': scene, 'message': message}
+
+
+### sf.info of a sound file, once per worker
+def _audioInfo(path_file):
+    if path_file not in _audio:
+        try:
+            info = sf.info(path_file)
+            _audio[path_file] = {'frames': info.frames, 'samplerate': info.samplerate, 'channels': info.channels}
+        except Exception as e:
+            _audio[path_file] = {'error': str(e)}
+    return _audio[path_file]
+
+
+### Issues of a trajectory file and its points
+def _csvCheck(path_file, name, duration):
+    try:
+        t, values, _ = traj_read(path_file)
+    except OSError as e:
+        return [preflight_issue('error', 'csv', f'Cannot read the trajectory: {e}', file=name)], None
+    except ValueError:
+        return [preflight_issue('error', 'csv', 'Malformed trajectory: non-numeric values or rows of different lengths', file=name)], None
+    if len(t) == 0:
+        return [preflight_issue('error', 'csv', 'Empty trajectory', file=name)], None
+    if values.shape[1] != 3:
+        return [preflight_issue('error', 'csv', f'{values.shape[1]+1} columns instead of 4 (time, 3 values)', file=name)], None
+    if not (np.all(np.isfinite(t)) and np.all(np.isfinite(values))):
+        return [preflight_issue('error', 'csv', 'Non-finite values', file=name)], None
+
+    issues = []
+    if np.any(np.diff(t) <= 0):
+        issues.append(preflight_issue('error', 'csv', f'Times not increasing at row {int(np.argmax(np.diff(t) <= 0))+2}', file=name))
+    if t[0] > csv_start_s:
+        issues.append(preflight_issue('warning', 'csv', f'Starts at {t[0]:g}s', file=name))
+    if duration is not None and t[-1] < duration - csv_end_s:
+        issues.append(preflight_issue('warning', 'csv', f'Ends at {t[-1]:g}s, session of {duration:g}s', file=name))
+    return issues, values
+
+
+### Shoebox of a scene: (center, size) of its facegroup, None without room (reference scenes)
+def _shoebox(scene):
+    for facegroup in scene.iter('facegroup'):
+        if facegroup.get('shoebox') is not None:
+            position = facegroup.find('position')
+            center = [float(v) for v in position.text.split()[1:4]] if position is not None and position.text else [0, 0, 0]
+            return np.array(center), np.array([float(v) for v in facegroup.get('shoebox').split()])
+    return None
+
+
+### Issues of the scene file of a minute
+def preflight_minute(dataset_n, session_n, minute, path_spear, catalog=False):
+    path_minute = PurePath(PathFinder(dataset_n, session_n, option, path_spear=path_spear), minute)
+    file_scene = PurePath(path_minute, 'Tascar_scenes.tsc')
+    issues = []
+
+    ### XML
+    try:
+        with open(file_scene) as fin:
+            text = fin.read()
+    except OSError as e:
+        return [preflight_issue('error', 'xml', f'Cannot read the scene file: {e}', file=file_scene.name)]
+    for placeholder in sorted(set(re.findall(r'\{\w*\}', text))):
+        issues.append(preflight_issue('error', 'xml', f'Template placeholder left: {placeholder}', file=file_scene.name))
+    try:
+        session = ET.fromstring(text)
+    except ET.ParseError as e:
+        return issues + [preflight_issue('error', 'xml', f'Malformed XML: {e}', file=file_scene.name)]
+    duration = float(session.get('duration')) if session.get('duration') is not None else None
+
+    ### Scenes of the jobs of the minute (cf tascar_jobList)
+    scenes = {scene.get('name'): scene for scene in session.iter('scene')}
+    ID_talk = [idd for idd in tascar_IDs(dataset_n, session_n, minute, path_spear, catalog=catalog) if idd != 2]
+    expected = {'Scene_full_sourceAll': ID_talk, 'Scene_full_sourceLs': []}
+    for idd in ID_talk:
+        expected[f'Scene_full_sourceID{idd}'] = [idd]
+        expected[f'Scene_ref_sourceID{idd}'] = [idd]
+    for name, talkers in expected.items():
+        if name not in scenes:
+            issues.append(preflight_issue('error', 'scenes', 'Scene of a job missing', scene=name))
+            continue
+        if not any(receiver.get('type') == 'hoa3d_enc' for receiver in scenes[name].iter('receiver')):
+            issues.append(preflight_issue('error', 'scenes', 'No hoa3d_enc receiver', scene=name))
+        sources = {source.get('name') for source in scenes[name].iter('source')}
+        for idd in talkers:
+            if f'ID{idd}' not in sources:
+                issues.append(preflight_issue('error', 'scenes', f'Talker ID{idd} missing', scene=name))
+
+    ### Referenced files, trajectories and geometry
+    checked = {}
+    for name, scene in scenes.items():
+        room = _shoebox(scene)
+        points = []
+        for sndfile in scene.iter('sndfile'):
+            ref = sndfile.get('name')
+            if ref in checked:
+                continue
+            checked[ref] = None
+            path_file = os.path.normpath(os.path.join(path_minute, ref))
+            if not os.path.exists(path_file):
+                issues.append(preflight_issue('error', 'files', 'Sound file missing', file=ref, scene=name))
+                continue
+            info = _audioInfo(path_file)
+            if 'error' in info:
+                issues.append(preflight_issue('error', 'audio', f'Cannot open the sound file: {info["error"]}', file=ref, scene=name))
+            elif sndfile.get('loop') == '0' and duration is not None and info['frames']/info['samplerate'] < duration:
+                issues.append(preflight_issue('warning', 'audio', f'{info["frames"]/info["samplerate"]:.2f}s of audio, session of {duration:g}s',
+                                              file=ref, scene=name))
+
+        for element in scene.iter():
+            ref = element.get('importcsv')
+            if ref is None:
+                continue
+            if ref not in checked:
+                if not os.path.exists(PurePath(path_minute, ref)):
+                    issues.append(preflight_issue('error', 'files', 'Trajectory file missing', file=ref, scene=name))
+                    checked[ref] = None
+                else:
+                    issues_csv, checked[ref] = _csvCheck(PurePath(path_minute, ref), ref, duration)
+                    issues += [dict(issue, scene=name) for issue in issues_csv]
+            if element.tag == 'position' and checked[ref] is not None:
+                points.append((ref, checked[ref]))
+        for sound in scene.iter('sound'):
+            if sound.get('x') is not None:
+                points.append((sound.get('name'), np.array([[float(sound.get(c, 0)) for c in 'xyz']])))
+
+        ### Geometry: the points of the scene inside its room
+        if room is not None:
+            center, size = room
+            for ref, xyz in points:
+                outside = np.any(np.abs(xyz - center) > size/2 + geometry_tol, axis=1)
+                if np.any(outside):
+                    n = int(np.argmax(outside))
+                    issues.append(preflight_issue('error', 'geometry', f'{int(outside.sum())} points outside the room '
+                                                  f'(first {np.round(xyz[n], 3).tolist()}, room {size.tolist()} centered on {center.tolist()})',
+                                                  file=ref, scene=name))
+
+    ### The same trajectory or loudspeaker is in several scenes: one issue per file
+    unique = {}
+    for issue in issues:
+        unique.setdefault((issue['level'], issue['check'], issue['file'], issue['message']), issue)
+    return list(unique.values())
+
+
+### Worker: issues of a minute, with its location
+def _preflightMinute(dataset_n, session_n, minute, path_spear, catalog):
+    try:
+        issues = preflight_minute(dataset_n, session_n, minute, path_spear, catalog=catalog)
+    except Exception as e:
+        issues = [preflight_issue('error', 'xml', f'Validation failed: {e!r}', file='Tascar_scenes.tsc')]
+    return [dict(issue, dataset=dataset_n, session=session_n, minute=minute) for issue in issues]
+
+
+### Check all the minutes of datasets/sessions on a process pool
+def SPEAR_preflight(datasets, sessions, path_spear, n_workers=None, catalog=False, file_report=None):
+
+    tasks = []
+    for dataset_n in datasets:
+        if dataset_n==1:
+            continue
+        for session_n in sessions:
+            tasks += [(dataset_n, session_n, minute) for minute in tascar_minutes(dataset_n, session_n, path_spear, catalog=catalog)]
+
+    issues = []
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(_preflightMinute, *task, path_spear, catalog) for task in tasks]
+        for future in futures:
+            issues += future.result()
+
+    errors = [issue for issue in issues if issue['level'] == 'error']
+    report = {'minutes': len(tasks),
+              'minutes_failed': len({(i['dataset'], i['session'], i['minute']) for i in errors}),
+              'errors': len(errors),
+              'warnings': len(issues) - len(errors),
+              'checks': {check: sum(i['check'] == check for i in issues) for check in sorted({i['check'] for i in issues})},
+              'issues': issues,
+              }
+    print(f'{len(tasks)} minutes checked: {report["errors"]} errors in {report["minutes_failed"]} minutes, {report["warnings"]} warnings')
+    for issue in errors[0:10]:
+        print(f'    D{issue["dataset"]} S{issue["session"]} M{issue["minute"]} {issue["check"]}: {issue["message"]}'
+              + (f' ({issue["file"]})' if issue['file'] else '') + (f' [{issue["scene"]}]' if issue['scene'] else ''))
+
+    if file_report is not None:
+        file_tmp = f'{file_report}.tmp'
+        with open(file_tmp, 'w') as fout:
+            json.dump(report, fout, indent=1)
+        os.replace(file_tmp, file_report)
+    return report
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check the generated Tascar_scenes.tsc files before the runs.')
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--catalog', action='store_true', help='list the minutes and talkers from the catalog (cf fct_catalog)')
+    parser.add_argument('--json', default='preflight.json', help='report file')
+    args = parser.parse_args()
+
+    report = SPEAR_preflight(args.datasets, args.sessions, args.path_spear, n_workers=args.workers, catalog=args.catalog,
+                             file_report=args.json)
+    sys.exit(1 if report['errors'] else 0)
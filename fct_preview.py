@@ -0,0 +1,231 @@
+"""
+SPEAR Challenge
+
+Fast preview of the array signals: the scenes are rendered with the micarray receiver of Block_a.tsc.
+Input: datasets, sessions and spear path (TASCAR minutes with their Tascar_scenes.tsc).
+Output: array_full_*.wav of the 4 microphones in the Preview_Audio tree (PathFinder option 'preview'),
+        and a report comparing them with the array outputs of the HOA + ATF path.
+
+The full path renders a (hoa_order+1)^2 channels HOA file (256 channels at order 15) and convolves it
+with the ATFs of the array (fmatconvol or numpy). The preview replaces the HOA receiver of the scene by
+the micarray receiver (cf tascar_scenePreview, Tascar_scenes_preview.tsc next to the scene) so that
+tascar_renderfile writes the 4 microphone signals directly: no HOA temp file and no convolution.
+Use it for QA and when iterating on the scene parameters, not as the dataset.
+
+Fidelity limits: the micarray mics are in free field (delays and distance gains only), without the
+head, the glasses frame and the mic responses measured in the ATFs. There are no binaural channels
+(5 and 6 of the array), so the ref jobs are not previewed. Mic n of Block_a.tsc is compared with
+channel n of the array.
+
+The report (per scene type All/Ls/ID, mean and worst over the minutes and mics) gives:
+    error_db:     energy of the difference relative to the HOA + ATF signal
+    level_db:     level of the preview relative to the HOA + ATF signal
+    correlation:  peak of the normalised cross-correlation, and its lag (ms)
+    job_s:        mean wall time of a job of each path, when their event folders are given (cf fct_instrumentation)
+
+- preview_jobs: Full-scene jobs of datasets/sessions, with their outputs in the preview tree.
+- preview_runJob: Render a job with the micarray receiver.
+- SPEAR_tascarPreview: Render the preview of all the jobs on a process pool.
+- preview_compareFiles: Error, level and correlation per mic between a preview and an array file.
+- SPEAR_previewCompare: Compare the previews with the HOA + ATF outputs.
+
+Command line:
+    python fct_preview.py run --path_spear /SPEAR-dir --datasets 2 --sessions 1 --workers 4 --events
+    python fct_preview.py compare --path_spear /SPEAR-dir --datasets 2 --sessions 1 --json preview.json
+
+"""
+
+import os
+import json
+import argparse
+import tempfile
+import numpy as np
+import soundfile as sf
+from pathlib import Path
+from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor
+from fct_PathFinder import PathFinder
+from fct_tascarScene import tascar_scenePreview, tascar_renderCmd, tascar_blocksLoad, fs_out
+from fct_scheduler import SPEAR_jobExpand
+from fct_postProcessing import SPEAR_postProcess, sink_array
+from fct_instrumentation import instr_stage, instr_system, instr_load
+
+
+###### Global Parameters
+n_mics = 4 # mics of the micarray receiver (Block_a.tsc)
+compare_s = 20 # seconds of each minute compared
+scene_types = ['All', 'Ls', 'ID']
+
+
+### Full-scene jobs of datasets/sessions, with their outputs in the preview tree
+def preview_jobs(datasets, sessions, path_spear, minute_random=False, catalog=False):
+    jobs = []
+    for job in SPEAR_jobExpand(datasets, sessions, path_spear, minute_random=minute_random, catalog=catalog):
+        if job['sound'] != 'full':
+            continue
+        path_preview = PathFinder(job['dataset_n'], job['session_n'], 'preview', path_spear=path_spear)
+        jobs.append(dict(job, path_out=str(PurePath(path_preview, job['minute']))))
+    return jobs
+
+
+### Render a job with the micarray receiver (the array file is written at the end, cut to 60s)
+def preview_runJob(job, events=None, output_format='wav'):
+    dataset_n, session_n, minute = job['dataset_n'], job['session_n'], job['minute']
+    sound, source, idd = job['sound'], job['source'], job['idd']
+    path_out = job['path_out']
+    array_name = f'array_{sound}_{source}{idd}'
+    array_file = PurePath(path_out, f'{array_name}.{output_format}')
+
+    with instr_stage(events, job, 'job') as event_job:
+        if os.path.exists(array_file):
+            print(f'Preview {array_name} for D{dataset_n} S{session_n} M{minute} already exists, skipped.')
+            event_job['status'] = 'skipped'
+            return array_file
+
+        os.makedirs(path_out, exist_ok=True)
+        file_preview = tascar_scenePreview(PurePath(job['path_tascar'], 'Tascar_scenes.tsc'))
+        scene_name = f'Scene_{sound}_source{source}{idd}'
+        array_tmp = tempfile.NamedTemporaryFile(prefix=f'.tmp_{array_name}_', suffix='.wav', dir=path_out, delete=False)
+        array_tmp.close()
+        try:
+            print(f'Running preview of {scene_name} for D{dataset_n} S{session_n} M{minute}')
+            with instr_stage(events, job, 'render') as event:
+                status = instr_system(tascar_renderCmd(scene_name, array_tmp.name, file_preview), event)
+                if status!=0:
+                    raise RuntimeError(f'tascar_renderfile failed ({status}) for {scene_name} D{dataset_n} S{session_n} M{minute}')
+            with instr_stage(events, job, 'postprocess'):
+                SPEAR_postProcess(array_tmp.name, [sink_array(array_file)], n_frames=fs_out*60)
+        except BaseException:
+            event_job['status'] = 'failed'
+            raise
+        finally:
+            if os.path.exists(array_tmp.name):
+                os.remove(array_tmp.name)
+        event_job['status'] = 'done'
+    return array_file
+
+
+### Worker: a failed job returns the exception instead of killing the whole pool
+def _previewJob(job, events, output_format):
+    try:
+        preview_runJob(job, events=events, output_format=output_format)
+        return None
+    except Exception as e:
+        return repr(e)
+
+
+### Render the preview of all the jobs of datasets/sessions on a process pool
+def SPEAR_tascarPreview(datasets, sessions, path_spear, n_workers=None, minute_random=False, catalog=False, events=None, output_format='wav'):
+    jobs = preview_jobs(datasets, sessions, path_spear, minute_random=minute_random, catalog=catalog)
+    print(f'{len(jobs)} preview jobs to run')
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=tascar_blocksLoad) as pool:
+        futures = [pool.submit(_previewJob, job, events, output_format) for job in jobs]
+        for job, future in zip(jobs, futures):
+            error = future.result()
+            if error is not None:
+                print(f'Failed preview D{job["dataset_n"]} S{job["session_n"]} M{job["minute"]} {job["source"]}{job["idd"]}: {error}')
+                failed.append((job, error))
+
+    print(f'Done: {len(jobs)-len(failed)} previews succeeded, {len(failed)} failed')
+    return failed
+
+
+### Error, level and correlation per mic between a preview and an array file (first n_frames)
+def preview_compareFiles(file_preview, file_array, n_frames=fs_out*compare_s):
+    p = sf.read(str(file_preview), frames=n_frames, dtype='float64', always_2d=True)[0]
+    r = sf.read(str(file_array), frames=n_frames, dtype='float64', always_2d=True)[0]
+    n = min(len(p), len(r))
+    n_fft = 1 << int(np.ceil(np.log2(2*n)))
+
+    mics = []
+    for mic in range(min(n_mics, p.shape[1], r.shape[1])):
+        x, y = p[:n, mic], r[:n, mic]
+        e_x, e_y = np.sum(x**2), np.sum(y**2)
+        xcorr = np.fft.irfft(np.fft.rfft(x, n_fft) * np.conj(np.fft.rfft(y, n_fft)), n_fft)
+        lag = int(np.argmax(np.abs(xcorr)))
+        mics.append({'error_db':    float(10*np.log10(max(np.sum((x-y)**2), 1e-30)/max(e_y, 1e-30))),
+                     'level_db':    float(10*np.log10(max(e_x, 1e-30)/max(e_y, 1e-30))),
+                     'correlation': float(np.abs(xcorr[lag])/max(np.sqrt(e_x*e_y), 1e-30)),
+                     'lag_ms':      float((lag if lag < n_fft//2 else lag-n_fft)/fs_out*1e3),
+                     })
+    return mics
+
+
+### Mean wall time of the jobs of an event folder (skipped jobs excluded)
+def _jobWall(dir_events):
+    walls = [e['wall_s'] for e in instr_load(dir_events) if e['stage'] == 'job' and e.get('status') == 'done']
+    return float(np.mean(walls)) if walls else None
+
+
+### Compare the previews with the HOA + ATF outputs of the same scenes
+def SPEAR_previewCompare(datasets, sessions, path_spear, file_format='wav', events_preview=None, events_full=None):
+    results = {scene_type: [] for scene_type in scene_types}
+    for dataset_n in datasets:
+        for session_n in sessions:
+            path_ref = PathFinder(dataset_n, session_n, 'reference', path_spear=path_spear)
+            path_preview = Path(PathFinder(dataset_n, session_n, 'preview', path_spear=path_spear))
+            for file_preview in sorted(path_preview.glob(f'*/array_full_*.{file_format}')):
+                if file_preview.name[0] == '.' or file_preview.parent.name[0] == '.':
+                    continue
+                file_array = PurePath(path_ref, file_preview.parent.name, file_preview.name)
+                if not os.path.exists(file_array):
+                    continue
+                scene_type = 'ID' if file_preview.stem.split('_')[-1].startswith('ID') else file_preview.stem.split('_')[-1]
+                results[scene_type] += preview_compareFiles(file_preview, file_array)
+
+    report = {'compare_s': compare_s, 'scenes': {}}
+    print(f'{"scene":>6} {"mics":>5} {"error dB":>9} {"worst dB":>9} {"level dB":>9} {"corr":>6} {"min corr":>9} {"lag ms":>7}')
+    for scene_type, mics in results.items():
+        if not mics:
+            continue
+        entry = {'mics':            len(mics),
+                 'error_db':        float(np.mean([m['error_db'] for m in mics])),
+                 'error_worst_db':  float(np.max([m['error_db'] for m in mics])),
+                 'level_db':        float(np.mean([m['level_db'] for m in mics])),
+                 'correlation':     float(np.mean([m['correlation'] for m in mics])),
+                 'correlation_min': float(np.min([m['correlation'] for m in mics])),
+                 'lag_ms':          float(np.mean([m['lag_ms'] for m in mics])),
+                 }
+        report['scenes'][scene_type] = entry
+        print(f'{scene_type:>6} {entry["mics"]:>5} {entry["error_db"]:9.1f} {entry["error_worst_db"]:9.1f} {entry["level_db"]:9.1f} '
+              f'{entry["correlation"]:6.2f} {entry["correlation_min"]:9.2f} {entry["lag_ms"]:7.2f}')
+
+    ### Throughput of the two paths, from their events
+    if events_preview is not None and events_full is not None:
+        report['job_s'] = {'preview': _jobWall(events_preview), 'full': _jobWall(events_full)}
+        if None not in report['job_s'].values():
+            report['speedup'] = report['job_s']['full'] / report['job_s']['preview']
+            print(f'Mean job: {report["job_s"]["preview"]:.2f} s preview, {report["job_s"]["full"]:.2f} s HOA + ATF '
+                  f'(x{report["speedup"]:.1f})')
+    return report
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Fast preview of the SPEAR array signals with the micarray receiver.')
+    parser.add_argument('command', choices=['run', 'compare'])
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--minute_random', action='store_true', help='a single random minute per session')
+    parser.add_argument('--catalog', action='store_true', help='list the jobs from the catalog (cf fct_catalog)')
+    parser.add_argument('--format', default='wav', choices=['wav', 'flac'])
+    parser.add_argument('--events', action='store_true', help='write the events of the previews in Miscellaneous/RunEvents/preview')
+    parser.add_argument('--events_full', default=None, help='events of the HOA + ATF runs, to compare the job times')
+    parser.add_argument('--json', default=None, help='also write the comparison in this file')
+    args = parser.parse_args()
+
+    events = PurePath(PathFinder(0, 0, 'events', path_spear=args.path_spear), 'preview')
+    if args.command == 'run':
+        SPEAR_tascarPreview(args.datasets, args.sessions, args.path_spear, n_workers=args.workers, minute_random=args.minute_random,
+                            catalog=args.catalog, events=events if args.events else None, output_format=args.format)
+    else:
+        report = SPEAR_previewCompare(args.datasets, args.sessions, args.path_spear, file_format=args.format,
+                                      events_preview=events if os.path.isdir(events) else None, events_full=args.events_full)
+        if args.json is not None:
+            with open(args.json, 'w') as fout:
+                json.dump(report, fout, indent=1)
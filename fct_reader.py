@@ -0,0 +1,278 @@
+"""
+SPEAR Challenge
+
+Random-access reader of the array and reference outputs, for the training loaders.
+Input: a dataset, its sessions and the spear path (outputs located with PathFinder, or with the catalog).
+Output: a reader (dict) serving (session, minute, scene, channels, time window) requests as float32 arrays.
+
+Reading whole minutes with sf.read to keep a window of a few seconds decodes 60s of every channel.
+Here the outputs of all the minutes are indexed once, and a request reads only the blocks of
+block_s seconds covering its window:
+    .wav PCM_16/PCM_32/FLOAT: the samples are memory-mapped (np.memmap from the data chunk offset),
+                              a block is a slice of the mapping, no decoding of the rest of the file.
+                              Each mapping holds a file descriptor: the mappings are opened when a block
+                              is read and kept in an LRU of mmap_max files, an evicted one is closed
+                              once the reads using it are done.
+    other (.flac, PCM_24):    seek in the file and read the frames of the block (sf.read start/frames).
+The blocks are kept (all channels, float32) in an LRU cache bounded by cache_mb, shared by the
+threads of the reader, so that overlapping windows and several channel subsets of a scene are read once.
+
+Scenes of a minute are named after the output files: array_full_All, array_full_ID3, array_full_Ls,
+array_ref_ID3, and ref_ID3 for ref_D*_S*_M*_ID3 (mix_* names are kept as is).
+
+- SPEAR_reader: Index the outputs of the sessions of a dataset.
+- reader_scenes: Scenes of a minute.
+- reader_read: Read a time window and a subset of channels of a scene.
+- reader_windows: Requests of windows over the indexed minutes (sequential or random).
+- reader_prefetch: Iterator of batches of windows read ahead by a thread pool.
+
+Command line (latency of random windows against whole-minute reads):
+    python fct_reader.py --path_spear /SPEAR-dir --dataset 2 --sessions 1 2 --window 4 --n 200
+
+"""
+
+import os
+import re
+import time
+import struct
+import argparse
+import threading
+import numpy as np
+import soundfile as sf
+from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from fct_PathFinder import PathFinder
+from fct_catalog import catalog_minutes, catalog_outputs
+
+
+###### Global Parameters
+block_s = 1 # seconds per cached block
+cache_mb = 512
+mmap_max = 64 # memory-mapped files kept open
+audio_outputs = ('.wav', '.flac')
+wav_dtypes = {(1, 16): ('<i2', 2**15), (1, 32): ('<i4', 2**31), (3, 32): ('<f4', 1)} # (format tag, bits): (dtype, scale)
+
+
+### Scene name of an output file
+def reader_sceneName(name):
+    stem = os.path.splitext(name)[0]
+    return re.sub(r'^ref_D\d+_S\d+_M\d+_', 'ref_', stem)
+
+
+### Data offset, dtype and scale of a .wav file that can be memory-mapped (None otherwise)
+def _wavLayout(path_file):
+    with open(path_file, 'rb') as fin:
+        riff = fin.read(12)
+        if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+            return None
+        layout = None
+        while True:
+            header = fin.read(8)
+            if len(header) < 8:
+                return None
+            chunk_id, size = header[0:4], struct.unpack('<I', header[4:8])[0]
+            if chunk_id == b'fmt ':
+                fmt = fin.read(size)
+                tag, channels, _, _, _, bits = struct.unpack('<HHIIHH', fmt[0:16])
+                if tag == 0xFFFE and size >= 26: # WAVE_FORMAT_EXTENSIBLE: tag of the sub format
+                    tag = struct.unpack('<H', fmt[24:26])[0]
+                layout = wav_dtypes.get((tag, bits))
+                if layout is None:
+                    return None
+                fin.seek(size % 2, 1)
+            elif chunk_id == b'data':
+                if layout is None:
+                    return None
+                return fin.tell(), layout[0], layout[1], channels
+            else:
+                fin.seek(size + size % 2, 1)
+
+
+### Soundfile info of a scene, and the layout of a .wav file that can be memory-mapped (no file left open)
+def _source(reader, entry):
+    with reader['lock']:
+        if 'layout' in entry:
+            return entry
+    info = sf.info(entry['file'])
+    source = {'frames': info.frames, 'samplerate': info.samplerate, 'channels': info.channels, 'layout': None}
+    if entry['file'].endswith('.wav') and info.frames > 0:
+        source['layout'] = _wavLayout(entry['file'])
+    with reader['lock']:
+        entry.update(source)
+    return entry
+
+
+### Memory mapping of a scene (None: seek-based reads), from the LRU of the open mappings
+### An evicted mapping is only dropped from the LRU: it is closed when the reads still using it are done
+def _mmap(reader, entry):
+    if entry['layout'] is None:
+        return None
+    with reader['lock']:
+        mmap = reader['mmaps'].get(entry['file'])
+        if mmap is not None:
+            reader['mmaps'].move_to_end(entry['file'])
+            return mmap
+    offset, dtype, _, channels = entry['layout']
+    mmap = np.memmap(entry['file'], dtype=dtype, mode='r', offset=offset, shape=(entry['frames'], channels))
+    with reader['lock']:
+        mmap = reader['mmaps'].setdefault(entry['file'], mmap)
+        while len(reader['mmaps']) > reader['mmap_max']:
+            reader['mmaps'].popitem(last=False)
+    return mmap
+
+
+### Index the outputs of the sessions of a dataset
+def SPEAR_reader(dataset_n, sessions, path_spear, catalog=False, cache_mb=cache_mb, block_s=block_s, mmap_max=mmap_max):
+    index = {}
+    for session_n in sessions:
+        path_ref = Path(PathFinder(dataset_n, session_n, 'reference', path_spear=path_spear))
+        if catalog:
+            for minute in catalog_minutes(dataset_n, session_n, path_spear, tree='reference'):
+                for name in catalog_outputs(dataset_n, session_n, minute, path_spear):
+                    index[(session_n, minute, reader_sceneName(name))] = {'file': str(path_ref / minute / name)}
+        else:
+            for path_file in sorted(path_ref.glob('*/*')):
+                if path_file.name[0] == '.' or path_file.parent.name[0] == '.' or path_file.suffix not in audio_outputs:
+                    continue
+                index[(session_n, path_file.parent.name, reader_sceneName(path_file.name))] = {'file': str(path_file)}
+
+    return {'dataset_n': dataset_n,
+            'index': index,
+            'block_s': block_s,
+            'cache': OrderedDict(), # (file, block): float32 (frames, channels)
+            'cache_bytes': 0,
+            'cache_max': int(cache_mb*2**20),
+            'mmaps': OrderedDict(), # file: np.memmap, at most mmap_max
+            'mmap_max': mmap_max,
+            'lock': threading.Lock(),
+            'stats': {'hits': 0, 'misses': 0},
+            }
+
+
+### Scenes of a minute
+def reader_scenes(reader, session_n, minute):
+    return sorted(scene for (s, m, scene) in reader['index'] if (s, m) == (session_n, minute))
+
+
+### Block of a scene (all channels, float32), from the cache or read
+def _block(reader, entry, n_block, block_frames):
+    key = (entry['file'], n_block)
+    with reader['lock']:
+        block = reader['cache'].get(key)
+        if block is not None:
+            reader['cache'].move_to_end(key)
+            reader['stats']['hits'] += 1
+            return block
+        reader['stats']['misses'] += 1
+
+    start = n_block*block_frames
+    stop = min(start+block_frames, entry['frames'])
+    mmap = _mmap(reader, entry)
+    if mmap is not None:
+        block = np.array(mmap[start:stop], dtype=np.float32) # copy: the cached blocks do not hold the mapping
+        if entry['layout'][2] != 1:
+            block /= entry['layout'][2]
+        del mmap
+    else:
+        block = sf.read(entry['file'], frames=stop-start, start=start, dtype='float32', always_2d=True)[0]
+
+    with reader['lock']:
+        if key not in reader['cache']:
+            reader['cache'][key] = block
+            reader['cache_bytes'] += block.nbytes
+        while reader['cache_bytes'] > reader['cache_max'] and len(reader['cache']) > 1:
+            _, old = reader['cache'].popitem(last=False)
+            reader['cache_bytes'] -= old.nbytes
+    return block
+
+
+### Read a time window (seconds, whole scene by default) and a subset of channels (0-based, all by default) of a scene
+def reader_read(reader, session_n, minute, scene, start_s=0, duration_s=None, channels=None):
+    entry = reader['index'].get((session_n, minute, scene))
+    if entry is None:
+        raise KeyError(f'No scene {scene} in D{reader["dataset_n"]} S{session_n} M{minute}')
+    entry = _source(reader, entry)
+
+    fs = entry['samplerate']
+    start = min(int(round(start_s*fs)), entry['frames'])
+    stop = entry['frames'] if duration_s is None else min(start + int(round(duration_s*fs)), entry['frames'])
+    channels = slice(None) if channels is None else channels
+    block_frames = int(reader['block_s']*fs)
+
+    out = np.empty((stop-start, len(range(entry['channels'])[channels]) if isinstance(channels, slice) else len(channels)),
+                   dtype=np.float32)
+    for n_block in range(start//block_frames, -(-stop//block_frames)):
+        block = _block(reader, entry, n_block, block_frames)
+        b_start = n_block*block_frames
+        lo, hi = max(start, b_start), min(stop, b_start+len(block))
+        out[lo-start:hi-start] = block[lo-b_start:hi-b_start][:, channels]
+    return out
+
+
+### Requests (session, minute, scene, start_s, duration_s) of windows over the indexed minutes
+### seed=None: every window of every scene in order, otherwise n random windows (one per scene by default)
+def reader_windows(reader, window_s, scenes=None, hop_s=None, n=None, seed=None):
+    keys = sorted(key for key in reader['index'] if scenes is None or key[2] in scenes)
+    durations = []
+    for key in keys:
+        entry = _source(reader, reader['index'][key])
+        durations.append(entry['frames']/entry['samplerate'])
+    keys = [key for key, duration in zip(keys, durations) if duration >= window_s]
+    durations = [duration for duration in durations if duration >= window_s]
+
+    if seed is None:
+        hop_s = window_s if hop_s is None else hop_s
+        return [(*key, float(t), window_s) for key, duration in zip(keys, durations)
+                for t in np.arange(0, duration-window_s+1e-9, hop_s)]
+    if not keys:
+        return []
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(keys), len(keys) if n is None else n)
+    return [(*keys[k], float(rng.uniform(0, durations[k]-window_s)), window_s) for k in picks]
+
+
+### Iterator of batches of windows, read ahead by a thread pool (depth batches in flight)
+def reader_prefetch(reader, requests, batch_size=8, n_threads=4, depth=2, channels=None):
+    batches = [requests[i:i+batch_size] for i in range(0, len(requests), batch_size)]
+    read = lambda request: reader_read(reader, *request, channels=channels)
+    with ThreadPoolExecutor(max_workers=n_threads) as pool:
+        pending = [[pool.submit(read, r) for r in batch] for batch in batches[0:depth]]
+        for n_batch in range(len(batches)):
+            futures = pending.pop(0)
+            if n_batch+depth < len(batches):
+                pending.append([pool.submit(read, r) for r in batches[n_batch+depth]])
+            yield [future.result() for future in futures]
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Latency of random windows of the SPEAR outputs, against whole-minute reads.')
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--dataset', type=int, default=2)
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--window', type=float, default=4, help='seconds per window')
+    parser.add_argument('--n', type=int, default=200, help='number of random windows')
+    parser.add_argument('--batch', type=int, default=8)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--catalog', action='store_true', help='index the outputs from the catalog (cf fct_catalog)')
+    args = parser.parse_args()
+
+    reader = SPEAR_reader(args.dataset, args.sessions, args.path_spear, catalog=args.catalog)
+    print(f'{len(reader["index"])} scenes indexed')
+    requests = reader_windows(reader, args.window, n=args.n, seed=0)
+
+    t0 = time.perf_counter()
+    for request in requests:
+        x = sf.read(reader['index'][request[0:3]]['file'], dtype='float32', always_2d=True)[0]
+        fs = sf.info(reader['index'][request[0:3]]['file']).samplerate
+        x = x[int(request[3]*fs):int((request[3]+args.window)*fs)]
+    t_full = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    n_windows = sum(len(batch) for batch in reader_prefetch(reader, requests, batch_size=args.batch, n_threads=args.threads))
+    t_reader = time.perf_counter() - t0
+
+    print(f'whole-minute reads: {t_full/len(requests)*1e3:.2f} ms/window')
+    print(f'reader:             {t_reader/n_windows*1e3:.2f} ms/window (cache hits {reader["stats"]["hits"]}, misses {reader["stats"]["misses"]})')
@@ -0,0 +1,150 @@
+"""
+SPEAR Challenge
+
+Content-addressed cache of the Tascar renders.
+Input: a job of tascar_jobList, the fmatconvol configuration and the render settings.
+Output: a key per job, stored in a per-minute manifest (render_manifest.json in the output folder).
+
+The key is a sha256 of everything the array output depends on:
+    - the XML of the scene of the job in Tascar_scenes.tsc,
+    - the content of the files it references (pos_ID*.csv, ori_ID*.csv, audio_ID*.wav, noise files),
+    - the fmatconvol configuration and the HOA weight files it loads,
+    - the render settings (HOA order, sampling rate, convolver, ...).
+A job is skipped only if the manifest has the same key and all its outputs exist with the recorded size,
+so a file left by a crash, or a change of room, weights, audio or settings makes the job run again.
+The outputs themselves are written atomically (temporary file + rename) by tascar_runJob.
+
+- cache_fileHash: Hash of the content of a file (memoised on path, size and modification time).
+- cache_sceneXml: XML of a scene of a tascar file and the files it references.
+- cache_key: Key of a job.
+- cache_isValid: Check the manifest entry of an output against a key.
+- cache_record: Record the key and outputs of a job in the manifest.
+
+"""
+
+import os
+import json
+import fcntl
+import hashlib
+import xml.etree.ElementTree as ET
+from pathlib import PurePath
+from contextlib import contextmanager
+from fct_convolution import conv_confFiles
+
+
+###### Global Parameters
+name_manifest = 'render_manifest.json'
+_hash_memo = {}
+_xml_memo = {}
+
+
+### Hash of the content of a file (memoised on path, size and modification time)
+def cache_fileHash(path_file):
+    path_file = os.path.realpath(str(path_file))
+    if not os.path.exists(path_file):
+        return 'missing'
+    stat = os.stat(path_file)
+    memo = (path_file, stat.st_size, stat.st_mtime_ns)
+    if memo not in _hash_memo:
+        h = hashlib.sha256()
+        with open(path_file, 'rb') as fin:
+            for chunk in iter(lambda: fin.read(2**20), b''):
+                h.update(chunk)
+        _hash_memo[memo] = h.hexdigest()
+    return _hash_memo[memo]
+
+
+### XML of a scene of a tascar file and the files it references (relative to the tascar file)
+def cache_sceneXml(file_tsc, scene_name):
+    file_tsc = str(file_tsc)
+    stat = os.stat(file_tsc)
+    memo = (file_tsc, stat.st_size, stat.st_mtime_ns)
+    if memo not in _xml_memo:
+        _xml_memo.clear()
+        _xml_memo[memo] = ET.parse(file_tsc).getroot()
+    root = _xml_memo[memo]
+
+    scene = next((s for s in root.iter('scene') if s.get('name') == scene_name), None)
+    if scene is None:
+        raise KeyError(f'No scene {scene_name} in {file_tsc}')
+
+    dir_tsc = os.path.dirname(file_tsc)
+    files = set()
+    for element in scene.iter():
+        if element.get('importcsv'):
+            files.add(os.path.join(dir_tsc, element.get('importcsv')))
+        if element.tag == 'sndfile' and element.get('name'):
+            files.add(os.path.join(dir_tsc, element.get('name')))
+
+    return ET.tostring(scene), sorted(files)
+
+
+### Key of a job (settings: dict of the render settings, json serialisable)
+def cache_key(job, path_fmatconv, settings):
+    h = hashlib.sha256()
+    h.update(json.dumps(settings, sort_keys=True).encode())
+
+    if job.get('sum_of'):
+        ### Sum of other outputs: key of the summed outputs
+        manifest = cache_load(job['path_out'])
+        for name in job['sum_of']:
+            h.update(manifest.get(name, {}).get('key', 'missing').encode())
+        return h.hexdigest()
+
+    scene_name = f'Scene_{job["sound"]}_source{job["source"]}{job["idd"]}'
+    xml, files = cache_sceneXml(PurePath(job['path_tascar'], 'Tascar_scenes.tsc'), scene_name)
+    h.update(xml)
+    for path_file in files:
+        h.update(os.path.basename(path_file).encode())
+        h.update(cache_fileHash(path_file).encode())
+
+    if path_fmatconv is not None:
+        for path_file in [path_fmatconv] + conv_confFiles(path_fmatconv):
+            h.update(cache_fileHash(path_file).encode())
+
+    return h.hexdigest()
+
+
+### Manifest of a minute (output folder)
+def cache_load(path_out):
+    path_manifest = PurePath(path_out, name_manifest)
+    if not os.path.exists(path_manifest):
+        return {}
+    with open(path_manifest) as fin:
+        return json.load(fin)
+
+
+### Lock on the manifest of a minute (several jobs of the same minute can run at the same time)
+@contextmanager
+def _lockManifest(path_out):
+    with open(PurePath(path_out, name_manifest + '.lock'), 'w') as flock:
+        fcntl.flock(flock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(flock, fcntl.LOCK_UN)
+
+
+### Check the manifest entry of an output against a key (same key, all outputs present with the recorded size)
+def cache_isValid(path_out, array_name, key):
+    entry = cache_load(path_out).get(array_name)
+    if entry is None or entry['key'] != key:
+        return False
+    for name, size in entry['outputs'].items():
+        path_file = PurePath(path_out, name)
+        if not os.path.exists(path_file) or os.path.getsize(path_file) != size:
+            return False
+    return True
+
+
+### Record the key and outputs of a job in the manifest (written atomically)
+def cache_record(path_out, array_name, key, outputs):
+    with _lockManifest(path_out):
+        manifest = cache_load(path_out)
+        manifest[array_name] = {'key': key,
+                                'outputs': {os.path.basename(str(f)): os.path.getsize(f) for f in outputs},
+                                }
+        path_tmp = PurePath(path_out, f'.{name_manifest}.{os.getpid()}.tmp')
+        with open(path_tmp, 'w') as fout:
+            json.dump(manifest, fout, indent=1, sort_keys=True)
+        os.replace(path_tmp, PurePath(path_out, name_manifest))
@@ -0,0 +1,119 @@
+"""
+SPEAR Challenge
+
+Typed and indexed store of the scene parameters of datasets 3 and 4 (session_modif.csv).
+Input: datasets, sessions and spear path.
+Output: a store (dict of columns) with O(1) lookup by (dataset, session, minute).
+
+The session_modif.csv of each session is parsed once into typed columns: arrays for the room, with
+the dtype pandas gives them (int64 for a column of integers, such as t_scattering=0, float64 otherwise,
+so that the generated scenes keep the formatting of the csv values), and fixed width (n, ls_max) arrays
+for the loudspeaker vectors (NaN padded, ls_num gives the count, more than ls_max is an error).
+The parsed table is cached next to the csv in session_modif.npz, rebuilt only when the csv changes
+(size and modification time stored in the cache, with the version of the cache format).
+
+- param_readCsv: Parse a session_modif.csv into typed columns.
+- param_loadSession: Columns of a session, from the .npz cache when it is up to date.
+- SPEAR_paramStore: Load all the sessions of datasets into a single indexed store.
+- param_sessionStore: Store of a single session.
+- param_lookup: Parameters of a minute, in the form used by the scene generation.
+
+"""
+
+import os
+import socket
+import numpy as np
+import pandas as pd
+from pathlib import PurePath
+from fct_PathFinder import PathFinder
+
+
+###### Global Parameters
+ls_max = 10 # maximum number of loudspeakers
+name_csv = 'session_modif.csv'
+name_cache = 'session_modif.npz'
+cols_scalar = ['t_scattering', 'room_x', 'room_y', 'room_z', 'center_x', 'center_y', 'center_z', 'absorption', 'damping']
+cols_ls = ['ls_levels', 'ls_x_all', 'ls_y_all', 'ls_z_all']
+cache_version = 2 # part of the cache key, caches of an older format are rebuilt
+
+
+### Parse a column of lists saved as strings "[a, b, c]" into a fixed width array (NaN padded)
+def _parseList(df, col, path_csv, width=ls_max):
+    out = np.full((len(df), width), np.nan)
+    for n, (minute, text) in enumerate(zip(df['minute'], df[col])):
+        values = np.array([float(v) for v in str(text).strip()[1:-1].split(',') if v.strip()])
+        if len(values) > width:
+            raise ValueError(f'{path_csv}, minute {minute}: {len(values)} values in {col}, at most {width} loudspeakers are supported')
+        out[n, :len(values)] = values
+    return out
+
+
+### Parse a session_modif.csv into typed columns
+def param_readCsv(path_csv):
+    df = pd.read_csv(path_csv)
+    columns = {'minute': df['minute'].to_numpy(dtype=np.int64)}
+    for col in cols_scalar:
+        columns[col] = df[col].to_numpy(dtype=np.int64 if pd.api.types.is_integer_dtype(df[col]) else np.float64)
+    for col in cols_ls:
+        columns[col] = _parseList(df, col, path_csv)
+    columns['ls_num'] = np.sum(~np.isnan(columns['ls_x_all']), axis=1).astype(np.int64)
+    return columns
+
+
+### Columns of a session, from the .npz cache when it is up to date
+def param_loadSession(path_tascar_session):
+    path_csv = PurePath(path_tascar_session, name_csv)
+    path_npz = PurePath(path_tascar_session, name_cache)
+    stat = os.stat(path_csv)
+    key = np.array([stat.st_size, stat.st_mtime_ns, cache_version], dtype=np.int64)
+
+    if os.path.exists(path_npz):
+        with np.load(path_npz) as cache:
+            if np.array_equal(cache['csv_key'], key):
+                return {col: cache[col] for col in cache.files if col != 'csv_key'}
+
+    columns = param_readCsv(path_csv)
+    path_tmp = f'{path_npz}.{socket.gethostname()}.{os.getpid()}.tmp.npz' # several processes/nodes may rebuild it at once
+    np.savez(path_tmp, csv_key=key, **columns)
+    os.replace(path_tmp, path_npz)
+    return columns
+
+
+### Load all the sessions of datasets into a single indexed store
+def SPEAR_paramStore(datasets, sessions, path_spear):
+    parts = []
+    for dataset_n in datasets:
+        for session_n in sessions:
+            path_session = PathFinder(dataset_n, session_n, 'Tascar', path_spear=path_spear)
+            if not os.path.exists(PurePath(path_session, name_csv)):
+                continue
+            columns = param_loadSession(path_session)
+            n = len(columns['minute'])
+            columns['dataset'] = np.full(n, dataset_n, dtype=np.int64)
+            columns['session'] = np.full(n, session_n, dtype=np.int64)
+            parts.append(columns)
+
+    if not parts:
+        return {'index': {}}
+
+    store = {col: np.concatenate([part[col] for part in parts]) for col in parts[0]} # int64 and float64 sessions give float64
+    store['index'] = {(int(d), int(s), int(m)): row for row, (d, s, m)
+                      in enumerate(zip(store['dataset'], store['session'], store['minute']))}
+    return store
+
+
+### Store of a single session (what the scene generation of one session needs)
+def param_sessionStore(dataset_n, session_n, path_spear):
+    return SPEAR_paramStore([dataset_n], [session_n], path_spear)
+
+
+### Parameters of a minute, in the form used by the scene generation (loudspeakers relative to the room center)
+def param_lookup(store, dataset_n, session_n, minute):
+    row = store['index'][(int(dataset_n), int(session_n), int(minute))]
+    params = {col: store[col][row].item() for col in cols_scalar} # int or float, as in the csv
+    ls_num = int(store['ls_num'][row])
+    params['ls_levels'] = store['ls_levels'][row, :ls_num].tolist()
+    params['ls_x_all']  = [round(-params['center_x']+ls, 2) for ls in store['ls_x_all'][row, :ls_num].tolist()]
+    params['ls_y_all']  = [round(-params['center_y']+ls, 2) for ls in store['ls_y_all'][row, :ls_num].tolist()]
+    params['ls_z_all']  = store['ls_z_all'][row, :ls_num].tolist()
+    return params
@@ -0,0 +1,252 @@
+"""
+SPEAR Challenge
+
+Parallel scheduler for the Tascar scene generation and runs.
+Input: datasets, sessions and spear path
+Output: same .tsc/.wav files as SPEAR_tascarSceneGen/SPEAR_tascarSceneRun, computed by a pool of worker processes.
+
+Scene generation: the block templates are loaded once per worker and every minute gets its own
+random generator seeded from (seed, dataset, session, minute), so the noise files chosen by
+block_noise do not depend on the order in which the minutes are processed.
+With catalog=True the minutes, talkers and noise files come from the catalog (cf fct_catalog)
+instead of walking the (NFS) tree from every worker, and with precondition=True the scenes use the
+audio converted to fs_out by SPEAR_precondition (cf fct_precondition), and with compact=True the
+compact trajectories of SPEAR_trajectoryCompact (cf fct_trajectory).
+With dry_run=True the runs and generation only report the jobs left and their predicted resources (cf fct_capacity).
+
+All the (minute, sound, source, ID) jobs of the requested datasets/sessions are independent,
+so they are dispatched on a process pool. Each job needs a HOA temp file ((hoa_order+1)^2 channels
+x 60s, 256 channels at order 15), the scheduler therefore keeps track of the /dev/shm space reserved by the
+running jobs and stages the HOA file on disk (in the TASCAR minute folder) when tmpfs is full.
+
+- hoa_tmpSize: Size in bytes of one HOA temp file.
+- SPEAR_jobExpand: List all the jobs of a range of datasets/sessions.
+- SPEAR_tascarSceneRunParallel: Run all the jobs on a process pool with a /dev/shm budget.
+- minute_rng: Independent deterministic random generator of a minute.
+- SPEAR_tascarSceneGenBatch: Generate the scenes of all minutes of datasets/sessions on a process pool.
+
+"""
+
+import os
+import random
+import shutil
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from fct_tascarScene import tascar_jobList, tascar_jobKey, tascar_runJob, tascar_cleanTmp, tascar_fmatconvConf, tascar_arrayConfs, hoa_order, fs_out
+from fct_tascarScene import tascar_minutes, tascar_sceneGenMinute, tascar_blocksLoad
+from fct_sceneParams import SPEAR_paramStore, param_lookup
+
+
+###### Global Parameters
+dir_shm = '/dev/shm'
+shm_margin = 0.1 # part of the tmpfs left free for the rest of the system
+
+
+### Size of one HOA temp file (float32 samples, 60s, (order+1)^2 channels) with a small header margin
+def hoa_tmpSize(order=hoa_order, duration=60):
+    return (order+1)**2 * fs_out * (duration+1) * 4
+
+
+### List all the jobs of a range of datasets/sessions
+def SPEAR_jobExpand(datasets, sessions, path_spear, minute_random=False, superposition=False, catalog=False):
+    jobs = []
+    for dataset_n in datasets:
+        if dataset_n==1:
+            continue
+        for session_n in sessions:
+            jobs += tascar_jobList(dataset_n, session_n, path_spear, minute_random=minute_random, superposition=superposition, catalog=catalog)
+    return jobs
+
+
+### Worker: a failed job returns the exception instead of killing the whole pool
+def _runJob(job, path_fmatconv, dir_tmp, options):
+    try:
+        tascar_runJob(job, path_fmatconv, dir_tmp=dir_tmp, **options)
+        return None
+    except Exception as e:
+        return repr(e)
+
+
+### Run all the jobs of the datasets/sessions on a process pool
+def SPEAR_tascarSceneRunParallel(datasets,
+                                 sessions,
+                                 path_spear,
+                                 n_workers=None,
+                                 shm_budget=None,
+                                 minute_random=False,
+                                 fmatconv=True,
+                                 convolver='fmatconvol',
+                                 superposition=False,
+                                 render_cache=False,
+                                 catalog=False,
+                                 events=None,
+                                 output_format='wav',
+                                 hoa_order=hoa_order,
+                                 dry_run=False,
+                                 preflight=False,
+                                 noise_pool=False,
+                                 arrays=None,
+                                 ):
+    """
+    shm_budget: bytes of /dev/shm the jobs are allowed to use at the same time.
+                None uses the free space of /dev/shm (minus shm_margin), 0 always stages on disk.
+    catalog:    list the minutes and talkers from the catalog instead of the filesystem (cf fct_catalog).
+    events:     folder of the per-stage events of the jobs (cf fct_instrumentation), None to disable them.
+    output_format: 'wav' or 'flac' (cf fct_outputFormat).
+    hoa_order:  order of the HOA renders, with the matching fmatconvol configuration (cf fct_hoaOrder).
+    dry_run:    only predict the jobs left and their resources on n_workers (cf fct_capacity), from the events of previous runs.
+    preflight:  check the scene files first on the pool and do not start on errors (cf fct_preflight).
+    noise_pool: render each distinct loudspeaker scene once and link it into the minutes (cf fct_noisePool).
+    arrays:     names of other arrays (Array_Transfer_Functions/<name>) convolved from the same HOA renders (cf tascar_arrayConfs).
+    Returns the list of (job, error) of the failed jobs (the plan with dry_run).
+    """
+
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    if dry_run:
+        from fct_capacity import SPEAR_runPlan
+        return SPEAR_runPlan(datasets, sessions, path_spear, n_workers=n_workers, convolver=convolver, superposition=superposition,
+                             render_cache=render_cache, catalog=catalog, output_format=output_format, hoa_order=hoa_order,
+                             events=events, fmatconv=fmatconv)
+
+    if preflight:
+        from fct_preflight import SPEAR_preflight
+        if SPEAR_preflight(datasets, sessions, path_spear, n_workers=n_workers, catalog=catalog)['errors']:
+            raise Exception('Preflight errors in the scenes, not running them (cf fct_preflight).')
+
+    path_fmatconv = tascar_fmatconvConf(path_spear, hoa_order)
+    options = {'fmatconv': fmatconv, 'convolver': convolver, 'render_cache': render_cache, 'events': events, 'output_format': output_format,
+               'hoa_order': hoa_order, 'noise_pool': noise_pool,
+               'arrays': tascar_arrayConfs(path_spear, arrays, hoa_order) if arrays else None}
+    jobs = SPEAR_jobExpand(datasets, sessions, path_spear, minute_random=minute_random, superposition=superposition, catalog=catalog)
+    print(f'{len(jobs)} jobs to run on {n_workers} workers')
+
+    ### Temp files from previous runs that crashed, in tmpfs and in the disk staging of the minutes
+    use_shm = os.path.isdir(dir_shm)
+    for dir_tmp in ([dir_shm] if use_shm else []) + sorted({str(job['path_tascar']) for job in jobs}):
+        for f in tascar_cleanTmp(dir_tmp):
+            print(f'Removed leaked HOA file {f}')
+    if use_shm:
+        if shm_budget is None:
+            shm_budget = int(shutil.disk_usage(dir_shm).free * (1-shm_margin))
+    else:
+        shm_budget = 0
+
+    job_size = hoa_tmpSize(hoa_order) if convolver != 'stream' else 0 # streamed jobs only need a fifo
+    shm_used = 0
+    running = {}
+    failed = []
+    pending = {tascar_jobKey(job) for job in jobs} # jobs not finished yet, for the dependencies ('after')
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        jobs_todo = list(jobs)
+        while jobs_todo or running:
+
+            ### Fill the free workers, in tmpfs if there is space left, otherwise on disk
+            while len(running) < n_workers:
+                ready = next((n for n, job in enumerate(jobs_todo) if not pending.intersection(job.get('after', []))), None)
+                if ready is None:
+                    break
+                job = jobs_todo.pop(ready)
+                if job.get('sum_of'):
+                    if not fmatconv:
+                        pending.discard(tascar_jobKey(job))
+                        continue
+                    future = pool.submit(_runJob, job, path_fmatconv, None, options)
+                    running[future] = (job, False)
+                    continue
+                in_shm = use_shm and shm_used + job_size <= shm_budget \
+                                 and shutil.disk_usage(dir_shm).free >= job_size
+                dir_tmp = dir_shm if in_shm else job['path_tascar']
+                if in_shm:
+                    shm_used += job_size
+                future = pool.submit(_runJob, job, path_fmatconv, dir_tmp, options)
+                running[future] = (job, in_shm)
+
+            ### Release the resources of the finished jobs
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, in_shm = running.pop(future)
+                pending.discard(tascar_jobKey(job))
+                if in_shm:
+                    shm_used -= job_size
+                error = future.result()
+                if error is not None:
+                    print(f'Failed D{job["dataset_n"]} S{job["session_n"]} M{job["minute"]} {job["sound"]}_{job["source"]}{job["idd"]}: {error}')
+                    failed.append((job, error))
+
+            ### Jobs depending on a failed job cannot run
+            failed_keys = {tascar_jobKey(job) for job, _ in failed}
+            for job in [job for job in jobs_todo if failed_keys.intersection(job.get('after', []))]:
+                jobs_todo.remove(job)
+                pending.discard(tascar_jobKey(job))
+                failed.append((job, 'a job it depends on failed'))
+                failed_keys.add(tascar_jobKey(job))
+
+    print(f'Done: {len(jobs)-len(failed)} jobs succeeded, {len(failed)} failed')
+    return failed
+
+
+### Independent deterministic random generator of a minute (str seeds are hashed with sha512 by random)
+def minute_rng(seed, dataset_n, session_n, minute):
+    return random.Random(f'{seed}-D{dataset_n}-S{session_n}-M{minute}')
+
+
+### Worker: scene generation of a minute
+def _sceneGenMinute(dataset_n, session_n, minute, path_spear, seed, params, catalog, precondition, hoa_order, compact, noise_pool):
+    try:
+        tascar_sceneGenMinute(dataset_n, session_n, minute, path_spear, rng=minute_rng(seed, dataset_n, session_n, minute), params=params,
+                              catalog=catalog, precondition=precondition, hoa_order=hoa_order, compact=compact, noise_pool=noise_pool)
+        return None
+    except Exception as e:
+        return repr(e)
+
+
+### Generate the scenes of all minutes of datasets/sessions on a process pool
+def SPEAR_tascarSceneGenBatch(datasets, sessions, path_spear, n_workers=None, seed=42, catalog=False, precondition=False, hoa_order=hoa_order,
+                              compact=False, dry_run=False, noise_pool=0):
+
+    ### Only list the minutes to generate (cf fct_capacity)
+    if dry_run:
+        from fct_capacity import SPEAR_genPlan
+        return SPEAR_genPlan(datasets, sessions, path_spear, catalog=catalog)
+
+    tasks = []
+    for dataset_n in datasets:
+        if dataset_n==1:
+            continue
+        for session_n in sessions:
+            tasks += [(dataset_n, session_n, minute) for minute in tascar_minutes(dataset_n, session_n, path_spear, catalog=catalog)]
+    print(f'{len(tasks)} minutes to generate')
+
+    ### Parameters of D3/D4 loaded once for all sessions (cf fct_sceneParams)
+    store = SPEAR_paramStore([d for d in datasets if d > 2], sessions, path_spear)
+    params_all = [param_lookup(store, *task) if task[0] > 2 else None for task in tasks]
+
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=tascar_blocksLoad) as pool:
+        futures = [pool.submit(_sceneGenMinute, *task, path_spear, seed, params, catalog, precondition, hoa_order, compact, noise_pool) for task, params in zip(tasks, params_all)]
+        for task, future in zip(tasks, futures):
+            error = future.result()
+            if error is not None:
+                print(f'Failed scene generation D{task[0]} S{task[1]} M{task[2]}: {error}')
+                failed.append((task, error))
+
+    return failed
+
+
+
+if __name__ == '__main__':
+
+    ### Choose datasets and sessions to run
+    datasets = [2, 3, 4]
+    sessions = range(1, 16)
+
+    ### Provide path to the SPEAR directory
+    path_spear = '/SPEAR-dir'
+
+    ### Generate the tascar files, then run them
+    SPEAR_tascarSceneGenBatch(datasets, sessions, path_spear, n_workers=os.cpu_count(), seed=42)
+    SPEAR_tascarSceneRunParallel(datasets, sessions, path_spear, n_workers=os.cpu_count())
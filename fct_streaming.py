@@ -0,0 +1,241 @@
+"""
+SPEAR Challenge
+
+Streaming render -> convolve pipeline, without a materialised HOA file.
+Input: the tascar_renderfile command of a scene and the convolution stage.
+Output: the array .wav file, written block by block while tascar is still rendering.
+
+tascar_renderfile writes its output in a named pipe (fifo) instead of /dev/shm. libsndfile cannot write
+a wav file in a pipe (the header is rewritten at the end), so the fifo has the .au extension by default,
+wav streams are still understood. The stream is parsed on the fly (the length in the header of a streamed
+file cannot be trusted, so the data is read until the end of the pipe) and each block goes through the convolution stage and is written
+to the array file straight away. The memory used is a few blocks instead of the full 256 channel file,
+and the convolution runs at the same time as the render.
+Other arrays (extra configurations) can be convolved from the same stream, each into its own file.
+
+A stage is a dict with:
+    'nout':    number of output channels
+    'process': function(block (n, ninp) float32) -> (m, nout) output samples
+    'flush':   function() -> last output samples
+New stages can be added to `stages`, the external fmatconvol stays available as the non-streaming
+fallback in tascar_runJob (a materialised HOA file is needed for it).
+
+- stream_readHeader: Parse the header of an au or wav stream (PCM 16/24/32 or float).
+- stream_blocks: Iterate over the blocks of float32 samples of the stream.
+- stage_numpy: Convolution stage using the in-process partitioned convolution (fct_convolution).
+- SPEAR_streamRenderConvolve: Render a scene in a fifo and convolve it on the fly into the array file.
+
+"""
+
+import os
+import time
+import fcntl
+import select
+import struct
+import tempfile
+import subprocess
+import numpy as np
+import soundfile as sf
+from fct_convolution import conv_loadEngine, conv_process
+
+
+###### Global Parameters
+block_size = 2**13 # samples per channel read from the pipe at once
+timeout_open = 60 # seconds to wait for the renderer to start writing
+fifo_suffix = '.au' # format written by the renderer in the fifo
+
+
+### Error raised when nothing comes through the pipe (the caller can fall back to the file based path)
+class StreamError(Exception):
+    pass
+
+
+### Read exactly n bytes (less only at the end of the stream)
+def _readExact(fin, n):
+    data = b''
+    while len(data) < n:
+        chunk = fin.read(n-len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+### Parse the header of an au or wav stream. Returns (fs, channels, dtype) with the stream positioned on the samples
+def stream_readHeader(fin):
+    riff = _readExact(fin, 12)
+    if riff[0:4] == b'.snd':
+        return _readHeaderAu(fin, riff)
+    if len(riff) < 12 or riff[0:4] != b'RIFF' or riff[8:12] != b'WAVE':
+        raise StreamError('The stream is neither a wav nor an au file')
+
+    fmt = None
+    while True:
+        chunk = _readExact(fin, 8)
+        if len(chunk) < 8:
+            raise StreamError('End of stream before the data chunk')
+        name, size = chunk[0:4], struct.unpack('<I', chunk[4:8])[0]
+        if name == b'data':
+            break
+        body = _readExact(fin, size + (size % 2))
+        if name == b'fmt ':
+            fmt = body
+
+    if fmt is None:
+        raise StreamError('No fmt chunk before the data chunk')
+
+    tag, channels, fs = struct.unpack('<HHI', fmt[0:8])
+    bits = struct.unpack('<H', fmt[14:16])[0]
+    if tag == 0xFFFE: # WAVE_FORMAT_EXTENSIBLE, the real format is the start of the sub-format GUID
+        tag = struct.unpack('<H', fmt[24:26])[0]
+
+    if tag == 3:
+        dtype = {32: '<f4', 64: '<f8'}[bits]
+    elif tag == 1:
+        dtype = {16: '<i2', 24: 'i24', 32: '<i4'}[bits]
+    else:
+        raise StreamError(f'Unsupported wav format {tag}')
+
+    return fs, channels, dtype
+
+
+### Header of an au stream (big endian), the first 12 bytes are already read
+def _readHeaderAu(fin, start):
+    header = start + _readExact(fin, 12)
+    if len(header) < 24:
+        raise StreamError('End of stream in the au header')
+    offset, size, encoding, fs, channels = struct.unpack('>IIIII', header[4:24])
+    _readExact(fin, offset-24) # annotation field
+
+    dtype = {3: '>i2', 4: '>i24', 5: '>i4', 6: '>f4', 7: '>f8'}.get(encoding)
+    if dtype is None:
+        raise StreamError(f'Unsupported au encoding {encoding}')
+
+    return fs, channels, dtype
+
+
+### Iterate over the blocks of float32 samples of the stream
+def stream_blocks(fin, channels, dtype, blocksize=block_size):
+    width = 3 if dtype.endswith('i24') else np.dtype(dtype).itemsize
+    frame_bytes = width*channels
+    rest = b''
+    while True:
+        data = rest + _readExact(fin, blocksize*frame_bytes - len(rest))
+        n = len(data) // frame_bytes
+        rest = data[n*frame_bytes:]
+        if n == 0:
+            return
+        raw = data[:n*frame_bytes]
+
+        if dtype.endswith('i24'):
+            b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            if dtype[0] == '>':
+                b = b[:, ::-1]
+            x = b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)
+            x = np.where(x >= 2**23, x - 2**24, x).astype(np.float32) / 2**23
+        elif dtype[1] == 'i':
+            x = np.frombuffer(raw, dtype=dtype).astype(np.float32) / 2**(8*width-1)
+        else:
+            x = np.frombuffer(raw, dtype=dtype).astype(np.float32)
+
+        yield x.reshape(n, channels)
+
+
+### Convolution stage using the in-process partitioned convolution (own delay line, cf conv_loadEngine)
+def stage_numpy(path_conf):
+    engine = conv_loadEngine(str(path_conf))
+    return {'nout':    engine['nout'],
+            'ninp':    engine['ninp'],
+            'fs':      engine['fs'],
+            'process': lambda block: conv_process(engine, block),
+            'flush':   lambda: conv_process(engine, np.zeros((0, engine['ninp']), dtype=np.float32), flush=True),
+            }
+
+
+stages = {'numpy': stage_numpy}
+
+
+### Open the read end of the fifo without blocking forever if the renderer dies before writing
+def _openFifo(path_fifo, proc):
+    fd = os.open(path_fifo, os.O_RDONLY | os.O_NONBLOCK)
+    t0 = time.time()
+    while True:
+        ready, _, _ = select.select([fd], [], [], 0.5)
+        if ready:
+            break
+        if proc.poll() is not None:
+            os.close(fd)
+            raise StreamError(f'Renderer exited ({proc.returncode}) without writing to the pipe')
+        if time.time()-t0 > timeout_open:
+            os.close(fd)
+            raise StreamError('Timeout while waiting for the renderer to write to the pipe')
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    return os.fdopen(fd, 'rb')
+
+
+### Render a scene in a fifo and convolve it on the fly into the array file
+def SPEAR_streamRenderConvolve(cmd_render, path_conf, array_file, n_frames=None, stage='numpy', dir_tmp=None, subtype='PCM_32', extra=None):
+    """
+    cmd_render: shell command of the render, with {output} where the output file goes.
+    stage:      name of a stage in `stages`, or a stage dict.
+    extra:      list of (path_conf, array_file) of other arrays fed from the same stream (numpy stage).
+    """
+
+    if isinstance(stage, str):
+        stage = stages[stage](path_conf)
+    outputs = [(stage, array_file)] + [(stage_numpy(conf), file) for conf, file in (extra or [])]
+
+    dir_fifo = tempfile.mkdtemp(prefix='spear_fifo_', dir=dir_tmp)
+    path_fifo = os.path.join(dir_fifo, 'hoa'+fifo_suffix)
+    os.mkfifo(path_fifo)
+
+    proc = subprocess.Popen(cmd_render.format(output=path_fifo), shell=True)
+    fouts = []
+    try:
+        with _openFifo(path_fifo, proc) as fifo:
+            fs, channels, dtype = stream_readHeader(fifo)
+            for stage, _ in outputs:
+                if 'ninp' in stage and channels != stage['ninp']:
+                    raise ValueError(f'The render has {channels} channels, the stage expects {stage["ninp"]}')
+                if stage.get('fs') is not None and fs != stage['fs']:
+                    raise ValueError(f'The render is at {fs} Hz, the filters at {stage["fs"]} Hz')
+
+            fouts = [sf.SoundFile(str(file), 'w', samplerate=fs, channels=stage['nout'], subtype=subtype) for stage, file in outputs]
+            n_in = 0
+            n_done = [0]*len(outputs)
+            for block in stream_blocks(fifo, channels, dtype):
+                if n_frames is not None and n_in >= n_frames:
+                    continue # keep reading so that the renderer can finish
+                if n_frames is not None:
+                    block = block[:n_frames-n_in]
+                n_in += len(block)
+                for n, ((stage, _), fout) in enumerate(zip(outputs, fouts)):
+                    y = stage['process'](block)
+                    fout.write(y)
+                    n_done[n] += len(y)
+            for n, ((stage, _), fout) in enumerate(zip(outputs, fouts)):
+                y = stage['flush']()
+                fout.write(y[:n_in-n_done[n]])
+                fout.close()
+            fouts = []
+
+        status = proc.wait()
+        if status != 0:
+            raise RuntimeError(f'Renderer failed ({status})')
+
+    except BaseException:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        for fout in fouts:
+            fout.close()
+        for _, file in outputs:
+            if os.path.exists(file):
+                os.remove(file)
+        raise
+
+    finally:
+        os.remove(path_fifo)
+        os.rmdir(dir_fifo)
+
+    return array_file
@@ -0,0 +1,93 @@
+"""
+SPEAR Challenge
+
+Verification of the linear superposition mode of SPEAR_tascarSceneRun.
+Input: dataset, session and spear path (the array_full_ID* and array_full_All files must exist).
+Output: residual between the summed array_full_All and a real render of Scene_full_sourceAll.
+
+With superposition=True, array_full_All.wav is the sum of the array_full_ID*.wav files
+(rendering and convolution are linear, the sources share the room, table, reverb and receiver).
+This tool renders the real Scene_full_sourceAll for a few sampled minutes in a temporary folder
+and reports the energy of the difference relative to the render.
+
+- superposition_residual: Residual (dB) and max abs difference between two array files, block by block.
+- SPEAR_superpositionCheck: Render sampled minutes and compare them with the summed files.
+
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import numpy as np
+import soundfile as sf
+from pathlib import PurePath
+from fct_tascarScene import tascar_jobList, tascar_runJob, tascar_fmatconvConf, fs_out
+
+
+###### Global Parameters
+block_size = 2**16
+residual_max_db = -40 # residual accepted as numerical noise (PCM_32 quantisation of the ID files, FDN)
+
+
+### Residual (dB, relative to the reference) and max abs difference between two array files, block by block
+def superposition_residual(file_test, file_ref, n_frames=fs_out*60):
+    err_energy, ref_energy, err_max = 0, 0, 0
+    with sf.SoundFile(str(file_test)) as ft, sf.SoundFile(str(file_ref)) as fr:
+        n = min(ft.frames, fr.frames, n_frames)
+        for start in range(0, n, block_size):
+            m = min(block_size, n-start)
+            xt = ft.read(m, dtype='float64', always_2d=True)
+            xr = fr.read(m, dtype='float64', always_2d=True)
+            err = xt-xr
+            err_energy += np.sum(err**2)
+            ref_energy += np.sum(xr**2)
+            err_max = max(err_max, float(np.max(np.abs(err))))
+    residual_db = 10*np.log10(max(err_energy, 1e-30)/max(ref_energy, 1e-30))
+    return float(residual_db), err_max
+
+
+### Render sampled minutes and compare them with the summed array_full_All files
+def SPEAR_superpositionCheck(dataset_n, session_n, path_spear, n_minutes=3, seed=0, convolver='fmatconvol'):
+
+    path_fmatconv = tascar_fmatconvConf(path_spear)
+    jobs = [job for job in tascar_jobList(dataset_n, session_n, path_spear)
+            if job['sound']=='full' and job['source']=='All']
+    jobs = [job for job in jobs if os.path.exists(PurePath(job['path_out'], 'array_full_All.wav'))]
+    jobs = random.Random(seed).sample(jobs, min(n_minutes, len(jobs)))
+
+    report = []
+    for job in jobs:
+        dir_check = tempfile.mkdtemp(prefix='superposition_')
+        try:
+            ### Real render of Scene_full_sourceAll in a temporary output folder
+            job_render = dict(job, path_out=dir_check)
+            tascar_runJob(job_render, path_fmatconv, convolver=convolver)
+            residual_db, err_max = superposition_residual(PurePath(job['path_out'], 'array_full_All.wav'),
+                                                          PurePath(dir_check, 'array_full_All.wav'))
+        finally:
+            shutil.rmtree(dir_check)
+
+        report.append({'dataset_n': dataset_n,
+                       'session_n': session_n,
+                       'minute':    job['minute'],
+                       'residual_db': residual_db,
+                       'max_abs_error': err_max,
+                       'ok': residual_db <= residual_max_db,
+                       })
+        print(f'D{dataset_n} S{session_n} M{job["minute"]}: residual {residual_db:.1f} dB, max abs error {err_max:.2e}')
+
+    return report
+
+
+
+if __name__ == '__main__':
+
+    ### Choose dataset and session to check
+    dataset_n = 2
+    session_n = 1
+
+    ### Provide path to the SPEAR directory
+    path_spear = '/SPEAR-dir'
+
+    SPEAR_superpositionCheck(dataset_n, session_n, path_spear, n_minutes=3)
@@ -12,41 +12,107 @@ Scene creation fct:
 - block_reverb: Add reverb, early (walls) and late (FDN).
 - block_sourceID: Add various sources (talkers) to the scene.
 - block_receiver_hoa: Add the ambisonic receiver.
+- block_receiver_hoaStatic: Add the ambisonic receiver at a static pose (pooled noise renders, cf fct_noisePool).
 - block_receiver_hrtf: Add the HRTF receiver.
+- block_receiver_micarray: Add the headworn microphone array receiver (free field, preview renders).
 - block_noise: Add noise (10 distributed loudspeakers).
-- tascar_60s_check: Verify that the output audio file is exactly 60s long.
-
+- tascar_IDs: IDs of the position files of a minute.
+- tascar_60s_check: Verify that the output audio file is exactly 60s long (block-wise, cf fct_postProcessing).
+- tascar_jobList: Expand a dataset/session into independent render (+convolve) jobs.
+- tascar_jobKey: Unique key of a job, used for the dependencies between jobs.
+- tascar_runJob: Run a single job (tascar render, fmatconvol, 60s check, reference extraction).
+- tascar_cleanTmp: Remove HOA temp files leaked by runs that died.
+- tascar_sceneOrder: Tascar file rendering the HOA receiver at a given order (the scene file or a hidden copy).
+- tascar_fmatconvConf: fmatconvol configuration of a HOA order (selected by its number of inputs).
+- tascar_arrayConfs: Configurations of other arrays (Array_Transfer_Functions/<name>), for the same HOA renders.
+- tascar_arrayDir: Output folder of another array (Reference_Audio_<name>).
+- tascar_scenePreview: Tascar file with the micarray receiver instead of the HOA one (cf fct_preview).
+
+- tascar_block: Template of a block, read once per process (tascar_blocksLoad loads them all).
+- tascar_paramsD2: Room and loudspeaker parameters of Dataset 2 (D3/D4 ones come from fct_sceneParams).
+- tascar_sceneGenMinute: Create the tascar files of a single minute, the noise choice uses the given rng.
 - SPEAR_tascarSceneGen: Use the blocks above to create on the fly a tascar file with the desired parameters. 
                         The tascar file contains multiple scenes including an anechoic condition one.
 - SPEAR_tascarSceneRun: Run the above file for the anechoic case, the noise only case and the source only case. 
-                        The audio mixture is made in post processing.
+                        The audio mixture is made in post processing (cf fct_mixture).
                         Include the option to run the convolution to output the audio array using the HOA file. Requires the ATFs.
+                        The convolution is done by fmatconvol (default) or in process (convolver='numpy', cf fct_convolution).
+                        convolver='stream' renders into a fifo convolved on the fly, without HOA file (cf fct_streaming).
+                        superposition=True builds array_full_All as the sum of the array_full_ID* (cf fct_superposition).
+                        render_cache=True reruns only the jobs whose inputs changed (cf fct_renderCache).
+                        events=<folder> writes a JSON event per stage of every job (cf fct_instrumentation).
+                        output_format='flac' writes compressed, seekable array and reference files (cf fct_outputFormat).
+                        hoa_order=<n> renders (n+1)^2 HOA channels with the matching configuration (cf fct_hoaOrder).
+
+catalog=True (generation and runs) lists the minutes, talkers and noise files from the catalog of the
+SPEAR tree instead of the filesystem (cf fct_catalog, SPEAR_catalogScan must have been run).
+precondition=True (generation) points the scenes at the talker audio and noise files converted to fs_out
+by SPEAR_precondition, loaded without resampling (cf fct_precondition).
+compact=True (generation) points the scenes at the compact_pos/ori_ID*.csv trajectories written by
+SPEAR_trajectoryCompact, when they exist (cf fct_trajectory).
+dry_run=True (generation and runs) only lists the minutes to generate / the jobs left with their predicted
+CPU time, wall time, /dev/shm and output bytes, nothing is written (cf fct_capacity).
+preflight=True (runs) checks the scene files first and does not start on errors (cf fct_preflight).
+noise_pool=<n> (generation) renders the loudspeaker scene at a static wearer pose with noise files drawn among
+n entries per acoustic configuration, and noise_pool=True (runs) renders each distinct loudspeaker scene
+once and links it into the minutes, for every array (cf fct_noisePool).
+arrays=[<name>, ...] (runs) also convolves every HOA render with the configuration of each array in
+Array_Transfer_Functions/<name>, into Reference_Audio_<name> (array files only). With the numpy and stream
+convolvers the HOA is read once for all the arrays; with fmatconvol (default) the main array is convolved by
+fmatconvol and the other arrays by the numpy convolution in a second read of the HOA file.
 
 """
 
 import os
+import re
 import time
-import pandas as pd
-import soundfile as sf
 from pathlib import Path
 from pathlib import PurePath
-from fct_PathFinder import PathFinder
+from fct_PathFinder import PathFinder, layout, layout_misc
+from fct_sceneParams import param_sessionStore, param_lookup
+from fct_convolution import SPEAR_hoaToArrays, conv_parseConf, conv_confFiles
+from fct_streaming import SPEAR_streamRenderConvolve, StreamError
+from fct_postProcessing import SPEAR_postProcess, SPEAR_sumArrays, sink_array, sink_ref, tmp_name
+from fct_renderCache import cache_key, cache_isValid, cache_record, cache_fileHash
+from fct_catalog import catalog_minutes, catalog_talkers, catalog_noiseFiles
+from fct_precondition import precond_lookup
+from fct_instrumentation import instr_stage, instr_system
+from fct_noisePool import pool_receiverPose, pool_rng, pool_lock, pool_fetch, pool_store
 import random
+from functools import lru_cache
+import socket
 import tempfile
 import platform
 
 
 ###### Global Parameters
-path_blocks = PurePath(os.path.dirname(os.path.realpath(__file__)), 'Scenes_blocks')
+path_blocks = PurePath(os.path.dirname(os.path.realpath(__file__)), 'scenes-blocks')
 source_lvl = 80
 ls_level_plus = -13 # what we add on top of source_lvl for the loudspeakers in D2
 hoa_order = 15
 option = 'Tascar'
 fs_out = 48000
+path_misc = '../../../../../../Miscellaneous/' # Miscellaneous folder, relative to a TASCAR minute folder
+prefix_compact = 'compact_' # compact trajectories (cf fct_trajectory), not matched by the pos*.csv globs
 
 
 ###### Functions for each blocks of the scene
 
+### Template of a block, read once per process from scenes-blocks
+@lru_cache(maxsize=None)
+def tascar_block(file_block):
+    fin = open(PurePath(path_blocks, file_block))
+    temp_block = fin.read()
+    fin.close()
+    return temp_block
+
+
+### Load all the block templates (e.g. once per worker process)
+def tascar_blocksLoad():
+    for file_block in sorted(os.listdir(path_blocks)):
+        if file_block.endswith('.tsc'):
+            tascar_block(file_block)
+
 ### Small function to add "" in our strings for tascar
 def strToStr(blockname):
     return '"' + blockname + '"'
@@ -55,10 +121,7 @@ def strToStr(blockname):
 ### REFLECTING SURFACE/TABLE
 def block_table(t_scattering):
 
-    file_table = PurePath(path_blocks, 'Block_t.tsc')
-    fin = open(file_table)
-    temp_table = fin.read()
-    fin.close()
+    temp_table = tascar_block('Block_t.tsc')
 
     # Define table scattering (0 by default)
     table = temp_table.format(t_scattering = strToStr(str(t_scattering)),
@@ -79,10 +142,7 @@ def block_reverb(room_x,
                 #  t60,
                  ):
 
-    file_w =  PurePath(path_blocks, 'Block_w.tsc')
-    fin = open(file_w)
-    temp_reverb_w = fin.read()
-    fin.close()
+    temp_reverb_w = tascar_block('Block_w.tsc')
 
     reverb_w = temp_reverb_w.format(room_x = str(room_x),
                                     room_y = str(room_y),
@@ -92,10 +152,7 @@ def block_reverb(room_x,
                                     center_z = str(center_z),
                                     )
 
-    file_r =  PurePath(path_blocks, 'Block_r.tsc')
-    fin = open(file_r)
-    temp_reverb_r = fin.read()
-    fin.close()
+    temp_reverb_r = tascar_block('Block_r.tsc')
 
     reverb_r = temp_reverb_r.format(room_x = str(room_x),
                                     room_y = str(room_y),
@@ -113,29 +170,29 @@ def block_reverb(room_x,
 
 
 ### SOURCES IDX
-def block_sourceID(idd):
+def block_sourceID(idd, source_audio=None, resample=True, source_pos=None, source_ori=None):
 
-    file_source   =  PurePath(path_blocks, f'Block_source.tsc')
-
-    fin = open(file_source)
-    temp_source = fin.read()
-    fin.close()
+    temp_source = tascar_block('Block_source.tsc')
 
     # Name of the source block
     source_name = f'ID{idd}'
     
-    # Path of the csv position and orientation files.
-    source_pos = f'pos_ID{idd}.csv'
-    source_ori = f'ori_ID{idd}.csv'
+    # Path of the csv position and orientation files (or their compact versions, cf fct_trajectory)
+    if source_pos is None:
+        source_pos = f'pos_ID{idd}.csv'
+    if source_ori is None:
+        source_ori = f'ori_ID{idd}.csv'
 
-    # Path of the audio files. depending on whether we use the original ones or the MuteFade ones
-    source_audio = f'audio_ID{idd}.wav'
+    # Path of the audio files. depending on whether we use the original ones or the MuteFade ones (or the preconditioned ones)
+    if source_audio is None:
+        source_audio = f'audio_ID{idd}.wav'
 
     source = temp_source.format(source_name  = strToStr(source_name),
                                 source_level = strToStr(str(source_lvl)),
                                 source_pos   = strToStr(str(source_pos)),
                                 source_ori   = strToStr(str(source_ori)),
-                                source_audio = strToStr(str(source_audio))
+                                source_audio = strToStr(str(source_audio)),
+                                resample     = strToStr(str(resample).lower()),
                                 )
     
     return source
@@ -143,38 +200,69 @@ def block_sourceID(idd):
 
 
 ### RECEIVER
-def block_receiver_hoa():
+def block_receiver_hoa(order=hoa_order, receiver_pos=None, receiver_ori=None):
     idd = 2
-    receiver_pos = f'pos_ID{idd}.csv'
-    receiver_ori = f'ori_ID{idd}.csv'
+    if receiver_pos is None:
+        receiver_pos = f'pos_ID{idd}.csv'
+    if receiver_ori is None:
+        receiver_ori = f'ori_ID{idd}.csv'
 
     receiver_name = 'Ambisonic'
-    file_receiver =  PurePath(path_blocks, 'Block_hoa.tsc')
-        
-    fin = open(file_receiver)
-    temp_receiver = fin.read()
-    fin.close()
+    temp_receiver = tascar_block('Block_hoa.tsc')
 
     receiver = temp_receiver.format(receiver_name = strToStr(receiver_name),
                                     receiver_pos  = strToStr(str(receiver_pos)),
                                     receiver_ori  = strToStr(str(receiver_ori)),
-                                    hoa_order     = str(hoa_order),
+                                    hoa_order     = str(order),
+                                    )
+
+    return receiver
+
+### HOA receiver at a static pose (x, y, z, rz, ry, rx): loudspeaker scene of the pooled noise renders (cf fct_noisePool)
+def block_receiver_hoaStatic(order=hoa_order, pose=(0, 0, 0, 0, 0, 0)):
+    receiver_name = 'Ambisonic'
+    temp_receiver = tascar_block('Block_hoa_static.tsc')
+
+    receiver = temp_receiver.format(receiver_name = strToStr(receiver_name),
+                                    hoa_order     = str(order),
+                                    receiver_x    = str(pose[0]),
+                                    receiver_y    = str(pose[1]),
+                                    receiver_z    = str(pose[2]),
+                                    receiver_rz   = str(pose[3]),
+                                    receiver_ry   = str(pose[4]),
+                                    receiver_rx   = str(pose[5]),
                                     )
 
     return receiver
 
 ### bonus HRTF block to create a separate tascar file that can be investigated with the gui (hoa does not work with the gui)
-def block_receiver_hrtf():
+def block_receiver_hrtf(receiver_pos=None, receiver_ori=None):
     idd = 2
-    receiver_pos = f'pos_ID{idd}.csv'
-    receiver_ori = f'ori_ID{idd}.csv'
+    if receiver_pos is None:
+        receiver_pos = f'pos_ID{idd}.csv'
+    if receiver_ori is None:
+        receiver_ori = f'ori_ID{idd}.csv'
 
     receiver_name = 'HRTF'
-    file_receiver =  PurePath(path_blocks, 'Block_h.tsc')
-        
-    fin = open(file_receiver)
-    temp_receiver = fin.read()
-    fin.close()
+    temp_receiver = tascar_block('Block_h.tsc')
+
+    receiver = temp_receiver.format(receiver_name = strToStr(receiver_name),
+                                    receiver_pos  = strToStr(str(receiver_pos)),
+                                    receiver_ori  = strToStr(str(receiver_ori))
+                                    )
+
+    return receiver
+
+### micarray block: the 4 mics of the headworn array rendered directly, without HOA nor ATF (free field, preview only)
+def block_receiver_micarray(receiver_pos=None, receiver_ori=None):
+    idd = 2
+    if receiver_pos is None:
+        receiver_pos = f'pos_ID{idd}.csv'
+    if receiver_ori is None:
+        receiver_ori = f'ori_ID{idd}.csv'
+
+    receiver_name = 'Micarray'
+    temp_receiver = tascar_block('Block_a.tsc')
 
     receiver = temp_receiver.format(receiver_name = strToStr(receiver_name),
                                     receiver_pos  = strToStr(str(receiver_pos)),
@@ -193,6 +281,9 @@ def block_noise(center_x,
                 noise_lvl,
                 path_spear,
                 session_n,
+                rng=random,
+                catalog=False,
+                precondition=False,
                 ):
 
     if session_n<10:
@@ -204,28 +295,35 @@ def block_noise(center_x,
 
     noise_path_in  = PurePath(PathFinder(0, 0, 'noise', path_spear=path_spear), set_n)
 
-    noise_files_out = list(Path(noise_path_in).glob(f'*.wav'))
-    noise_files_out = [f for f in noise_files_out if f.stem[0]!='.']
+    if catalog:
+        noise_files_out = catalog_noiseFiles(set_n, path_spear)
+    else:
+        noise_files_out = list(Path(noise_path_in).glob('*.wav'))
+        noise_files_out = [f for f in noise_files_out if f.stem[0]!='.']
+        noise_files_out.sort() # glob order depends on the filesystem, sort for reproducible choices
 
     ### Load single loudspeaker and create the 10 ones (maybe less loudspeakers if small room)
-    file_loudspeaker =  PurePath(path_blocks, 'Block_l10_single.tsc')
-
-    fin = open(file_loudspeaker)
-    temp_loudspeaker = fin.read()
-    fin.close()
+    temp_loudspeaker = tascar_block('Block_l10_single.tsc')
     
     ls_num = len(ls_x)
-    noise_file = random.choices(noise_files_out, k=ls_num)
-    path_out = f'../../../../../../Miscellaneous/AmbientNoise/{set_n}/'
+    noise_file = rng.choices(noise_files_out, k=ls_num)
+    path_out = f'{path_misc}{layout_misc["noise"][0]}/{set_n}/'
 
     loudspeakers = ''
     for ls in range(ls_num):
+        ### Preconditioned copy at fs_out (cf fct_precondition), chosen after the draw so the choice does not change
+        noise_ref, resample = path_out+str(noise_file[ls].name), True
+        if precondition:
+            file_pre, resample = precond_lookup(noise_file[ls], path_spear)
+            if file_pre is not None:
+                noise_ref = f'{path_misc}{layout_misc["precondition"][0]}/{file_pre}'
         loudspeaker = temp_loudspeaker.format(ls_num  = ls,
                                               ls_x = strToStr(str(center_x+ls_x[ls])),
                                               ls_y = strToStr(str(center_y+ls_y[ls])),
                                               ls_z = strToStr(str(ls_z[ls])),
                                               noise_level  = strToStr(str(noise_lvl[ls])),
-                                              noise_file = strToStr(path_out+str(noise_file[ls].name)),
+                                              noise_file = strToStr(noise_ref),
+                                              resample = strToStr(str(resample).lower()),
                                               )
         loudspeakers += loudspeaker
 
@@ -248,268 +346,657 @@ def block_noise(center_x,
 
 
 
-###### Main fct for Scene Generation
-def SPEAR_tascarSceneGen(dataset_n, session_n, path_spear):
+### Parameters of Dataset 2 (same room and loudspeakers for all minutes)
+def tascar_paramsD2():
+    ### Define here all the new parameters that can be varied for D3
+    t_scattering = 0
+    room_x = 6.11
+    room_y = 7.74
+    room_z = 3.44
+    center_x = 0.5
+    center_y = -0.91
+    center_z = room_z/2
+    absorption = 0.6
+    damping = 0.3
+    # t60 = 0.6
+    ls_levels= [source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus]
+    ls_x_all = [  room_x/2-1,  room_x/2-3,  room_x/2-5,  room_x/2-5,    room_x/2-5,  room_x/2-5,    room_x/2-4,  room_x/2-1,  room_x/2-1,  room_x/2-1  ]
+    ls_y_all = [ -room_y/2+1, -room_y/2+1, -room_y/2+1, -room_y/2+2.5, -room_y/2+4, -room_y/2+5.5, -room_y/2+6, -room_y/2+6, -room_y/2+5, -room_y/2+2.5]
+    # ls_x_all = [ -1,  -3,  -5,  -5,    -5,  -5,    -4,  -1,  -1,  -1  ]
+    # ls_y_all = [ +1,  +1,  +1,  +2.5,  +4,  +5.5,  +6,  +6,  +5,  +2.5]
+    ls_z_all = [0.5, 1.3, 1.5,1.37,1.16,1.23,0.63,1.79,1.83,0.87]
+
+    return {'t_scattering': t_scattering,
+            'room_x': room_x,
+            'room_y': room_y,
+            'room_z': room_z,
+            'center_x': center_x,
+            'center_y': center_y,
+            'center_z': center_z,
+            'absorption': absorption,
+            'damping': damping,
+            'ls_levels': ls_levels,
+            'ls_x_all': ls_x_all,
+            'ls_y_all': ls_y_all,
+            'ls_z_all': ls_z_all,
+            }
+
+
+###### Scene Generation of a single minute
+def tascar_sceneGenMinute(dataset_n, session_n, minute, path_spear, rng=random, params=None, catalog=False, precondition=False, hoa_order=hoa_order,
+                          compact=False, noise_pool=0):
 
-    if dataset_n==1: raise 'Dataset 1 do not have Tascar simulations.'
-
-    ### List of minute of current dataset
     path_tascar_LINUX = PathFinder(dataset_n, session_n, option, path_spear=path_spear)
-    path_walk = [Path(x[0]) for x in os.walk(str(path_tascar_LINUX))]
-    path_walk.pop(0)
-    path_walk.sort()
-    minutes = [walk.stem for walk in path_walk if walk.stem[0]!='.']
 
-    for minute in minutes:
-        ### Working path for the current output
-        path_tascar_linux = PurePath(path_tascar_LINUX, minute)
+    ### Working path for the current output
+    path_tascar_linux = PurePath(path_tascar_LINUX, minute)
 
+    ### Parameters of the room and loudspeakers (fixed in D2, from session_modif.csv otherwise)
+    if params is None:
         if dataset_n == 2:
-            ### Define here all the new parameters that can be varied for D3
-            t_scattering = 0
-            room_x = 6.11
-            room_y = 7.74
-            room_z = 3.44
-            center_x = 0.5
-            center_y = -0.91
-            center_z = room_z/2
-            absorption = 0.6
-            damping = 0.3
-            # t60 = 0.6
-            ls_levels= [source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus, source_lvl+ls_level_plus]
-            ls_x_all = [  room_x/2-1,  room_x/2-3,  room_x/2-5,  room_x/2-5,    room_x/2-5,  room_x/2-5,    room_x/2-4,  room_x/2-1,  room_x/2-1,  room_x/2-1  ]
-            ls_y_all = [ -room_y/2+1, -room_y/2+1, -room_y/2+1, -room_y/2+2.5, -room_y/2+4, -room_y/2+5.5, -room_y/2+6, -room_y/2+6, -room_y/2+5, -room_y/2+2.5]
-            # ls_x_all = [ -1,  -3,  -5,  -5,    -5,  -5,    -4,  -1,  -1,  -1  ]
-            # ls_y_all = [ +1,  +1,  +1,  +2.5,  +4,  +5.5,  +6,  +6,  +5,  +2.5]
-            ls_z_all = [0.5, 1.3, 1.5,1.37,1.16,1.23,0.63,1.79,1.83,0.87]
-
+            params = tascar_paramsD2()
+        else:
+            params = param_lookup(param_sessionStore(dataset_n, session_n, path_spear), dataset_n, session_n, minute)
+
+    t_scattering = params['t_scattering']
+    room_x = params['room_x']
+    room_y = params['room_y']
+    room_z = params['room_z']
+    center_x = params['center_x']
+    center_y = params['center_y']
+    center_z = params['center_z']
+    absorption = params['absorption']
+    damping = params['damping']
+    ls_levels = params['ls_levels']
+    ls_x_all  = params['ls_x_all']
+    ls_y_all  = params['ls_y_all']
+    ls_z_all  = params['ls_z_all']
+
+
+    ### Determine how many people are talking based on the number of position files
+    ID_all = tascar_IDs(dataset_n, session_n, minute, path_spear, catalog=catalog)
+    ID_talk = ID_all.copy()
+    ID_talk.remove(2)
+    ID_interf = [3,4,5,6,7]
+
+    ### Load the blocks 
+    table = block_table(t_scattering)
+
+    reverb_w, reverb_r = block_reverb(room_x, 
+                                      room_y,
+                                      room_z, 
+                                      center_x, 
+                                      center_y, 
+                                      center_z,
+                                      absorption,
+                                      damping,
+                                      # t60,
+                                      )
+
+    source_id = []
+    for idd in ID_interf:
+        if idd in ID_talk:
+            source_audio, resample = None, True
+            if precondition:
+                file_pre, resample = precond_lookup(PurePath(path_tascar_linux, f'audio_ID{idd}.wav'), path_spear)
+                if file_pre is not None:
+                    source_audio = f'{path_misc}{layout_misc["precondition"][0]}/{file_pre}'
+            source_pos, source_ori = tascar_trajectoryFiles(path_tascar_linux, idd, compact)
+            source_id.append(block_sourceID(idd, source_audio=source_audio, resample=resample, source_pos=source_pos, source_ori=source_ori))
         else:
-            ### Get modif file
-            modif_csv = PurePath(path_tascar_LINUX, 'session_modif.csv')
-            df_modif = pd.read_csv(modif_csv)
-
-            ### Get all modified parameter of the current minute from the df
-            df_temp = df_modif[df_modif['minute']==int(minute)]
-
-            t_scattering = df_temp['t_scattering'].iloc[0]
-            room_x = df_temp['room_x'].iloc[0]
-            room_y = df_temp['room_y'].iloc[0]
-            room_z = df_temp['room_z'].iloc[0]
-            center_x = df_temp['center_x'].iloc[0]
-            center_y = df_temp['center_y'].iloc[0]
-            center_z = df_temp['center_z'].iloc[0]
-            absorption = df_temp['absorption'].iloc[0]
-            damping = df_temp['damping'].iloc[0]
-            # t60 = df_temp['t60'].iloc[0]
-            ### The csv saves the list as a string so do a work around to get back to a list of floats.
-            ### Also position speakers relative to the center of the room
-            ls_levels = [float(ls) for ls in (df_temp['ls_levels'].iloc[0][1:-1]).split(",")]
-            ls_x_all  = [round(-center_x+float(ls) ,2) for ls in (df_temp['ls_x_all'].iloc[0][1:-1]).split(",")]
-            ls_y_all  = [round(-center_y+float(ls) ,2) for ls in (df_temp['ls_y_all'].iloc[0][1:-1]).split(",")]
-            ls_z_all  = [float(ls) for ls in (df_temp['ls_z_all'].iloc[0][1:-1]).split(",")]
+            source_id.append('')
+    source_all = ''.join(source_id)
+
+    ### Pooled noise: static receiver and noise files drawn among noise_pool entries of the acoustics (cf fct_noisePool)
+    rng_noise = rng
+    if noise_pool:
+        pose = pool_receiverPose(path_tascar_linux)
+        rng_noise = pool_rng(params, session_n, pose, rng.randrange(noise_pool), precondition=precondition)
+
+    noise = block_noise(center_x,
+                        center_y,
+                        ls_x_all,
+                        ls_y_all,
+                        ls_z_all,
+                        ls_levels,
+                        path_spear,
+                        session_n,
+                        rng=rng_noise,
+                        catalog=catalog,
+                        precondition=precondition,
+                        )
+
+
+    receiver_pos, receiver_ori = tascar_trajectoryFiles(path_tascar_linux, 2, compact)
+    receiver_hoa = block_receiver_hoa(hoa_order, receiver_pos, receiver_ori)
+    receiver_ls = block_receiver_hoaStatic(hoa_order, pose) if noise_pool else receiver_hoa
+    receiver_hrtf = block_receiver_hrtf(receiver_pos, receiver_ori)
+
+
+    ### Create the scene
+    temp_scene = tascar_block('SPEAR_template.tsc')
+    temp_scene_gui = tascar_block('SPEAR_template_gui.tsc')
+
+    scene = temp_scene.format(source_all = source_all,
+                              source_id3 = source_id[0],
+                              source_id4 = source_id[1],
+                              source_id5 = source_id[2],
+                              source_id6 = source_id[3],
+                              source_id7 = source_id[4],
+                              noise    = noise,
+                              table    = table,
+                              room     = reverb_w,
+                              reverb   = reverb_r,
+                              receiver = receiver_hoa,
+                              receiver_ls = receiver_ls,
+                              )
+
+    scene_gui = temp_scene_gui.format(source_all = source_all,
+                              source_idX = source_all, # change here for other IDX
+                              noise    = noise,
+                              table    = table,
+                              room     = reverb_w,
+                              reverb   = reverb_r,
+                              receiver = receiver_hrtf,
+                              center_x = str(center_x),
+                              center_y = str(center_y),
+                              center_z = str(center_z),
+                              )    
+
+    ### CREATE TASCAR SCENE FILE
+    file_output = PurePath(path_tascar_linux, 'Tascar_scenes.tsc')
+    file_output_hrtf = PurePath(path_tascar_linux, 'Tascar_scenes_gui.tsc')
+
+    if os.path.exists(file_output):
+        output = open(file_output, 'w')
+    else:
+        output = open(file_output, 'x')
+    output.write(scene)
+    output.close()
 
+    if os.path.exists(file_output_hrtf):
+        output = open(file_output_hrtf, 'w')
+    else:
+        output = open(file_output_hrtf, 'x')
+    output.write(scene_gui)
+    output.close()
 
-        ### Determine how many people are talking based on the number of position files
-        files_pos_all = list(Path(path_tascar_linux).glob(f'pos*.csv'))
-        files_pos_all = [f for f in files_pos_all if f.stem[0]!='.']
-        ID_all = [int(files_pos.stem[-1]) for files_pos in files_pos_all]
-        ID_talk = ID_all.copy()
-        ID_talk.remove(2)
-        ID_interf = [3,4,5,6,7]
-
-        ### Load the blocks 
-        table = block_table(t_scattering)
-
-        reverb_w, reverb_r = block_reverb(room_x, 
-                                          room_y,
-                                          room_z, 
-                                          center_x, 
-                                          center_y, 
-                                          center_z,
-                                          absorption,
-                                          damping,
-                                          # t60,
-                                          )
-
-        source_id = []
-        for idd in ID_interf:
-            if idd in ID_talk:
-                source_id.append(block_sourceID(idd))
-            else:
-                source_id.append('')
-        source_all = ''.join(source_id)
-
-        noise = block_noise(center_x,
-                            center_y,
-                            ls_x_all,
-                            ls_y_all,
-                            ls_z_all,
-                            ls_levels,
-                            path_spear,
-                            session_n,
-                            )
-
-
-        receiver_hoa = block_receiver_hoa()
-        receiver_hrtf = block_receiver_hrtf()
-
-
-        ### Create the scene
-        file_scene = PurePath(path_blocks, f'SPEAR_template.tsc')
-        file_scene_gui = PurePath(path_blocks, f'SPEAR_template_gui.tsc')
-
-        fin = open(file_scene)
-        temp_scene = fin.read()
-        fin.close()
-        fin = open(file_scene_gui)
-        temp_scene_gui = fin.read()
-        fin.close()
-
-        scene = temp_scene.format(source_all = source_all,
-                                  source_id3 = source_id[0],
-                                  source_id4 = source_id[1],
-                                  source_id5 = source_id[2],
-                                  source_id6 = source_id[3],
-                                  source_id7 = source_id[4],
-                                  noise    = noise,
-                                  table    = table,
-                                  room     = reverb_w,
-                                  reverb   = reverb_r,
-                                  receiver = receiver_hoa,
-                                  )
-    
-        scene_gui = temp_scene_gui.format(source_all = source_all,
-                                  source_idX = source_all, # change here for other IDX
-                                  noise    = noise,
-                                  table    = table,
-                                  room     = reverb_w,
-                                  reverb   = reverb_r,
-                                  receiver = receiver_hrtf,
-                                  center_x = str(center_x),
-                                  center_y = str(center_y),
-                                  center_z = str(center_z),
-                                  )    
-    
-        ### CREATE TASCAR SCENE FILE
-        file_output = PurePath(path_tascar_linux, 'Tascar_scenes.tsc')
-        file_output_hrtf = PurePath(path_tascar_linux, 'Tascar_scenes_gui.tsc')
 
-        if os.path.exists(file_output):
-            output = open(file_output, 'w')
-        else:
-            output = open(file_output, 'x')
-        output.write(scene)
-        output.close()
+### Position and orientation files of an ID in a scene: the compact ones when asked and written (cf fct_trajectory)
+def tascar_trajectoryFiles(path_tascar_minute, idd, compact=False):
+    files = [f'pos_ID{idd}.csv', f'ori_ID{idd}.csv']
+    if compact:
+        files = [prefix_compact+f if os.path.exists(PurePath(path_tascar_minute, prefix_compact+f)) else f for f in files]
+    return files
+
+
+###### Main fct for Scene Generation
+def SPEAR_tascarSceneGen(dataset_n, session_n, path_spear, rng=random, catalog=False, precondition=False, hoa_order=hoa_order, compact=False, dry_run=False,
+                         noise_pool=0):
+
+    if dataset_n==1: raise Exception('Dataset 1 do not have Tascar simulations.')
+
+    ### Only list the minutes to generate (cf fct_capacity)
+    if dry_run:
+        from fct_capacity import SPEAR_genPlan
+        return SPEAR_genPlan([dataset_n], [session_n], path_spear, catalog=catalog)
+
+    ### Parameters of all the minutes loaded once (cf fct_sceneParams)
+    store = param_sessionStore(dataset_n, session_n, path_spear) if dataset_n != 2 else None
+
+    for minute in tascar_minutes(dataset_n, session_n, path_spear, catalog=catalog):
+        params = param_lookup(store, dataset_n, session_n, minute) if store is not None else None
+        tascar_sceneGenMinute(dataset_n, session_n, minute, path_spear, rng=rng, params=params, catalog=catalog, precondition=precondition,
+                              hoa_order=hoa_order, compact=compact, noise_pool=noise_pool)
 
-        if os.path.exists(file_output_hrtf):
-            output = open(file_output_hrtf, 'w')
-        else:
-            output = open(file_output_hrtf, 'x')
-        output.write(scene_gui)
-        output.close()
+
+### List of minute of current dataset
+def tascar_minutes(dataset_n, session_n, path_spear, catalog=False):
+    if catalog:
+        return catalog_minutes(dataset_n, session_n, path_spear)
+    path_tascar_LINUX = PathFinder(dataset_n, session_n, option, path_spear=path_spear)
+    path_walk = [Path(x[0]) for x in os.walk(str(path_tascar_LINUX))]
+    path_walk.pop(0)
+    path_walk.sort()
+    return [walk.stem for walk in path_walk if walk.stem[0]!='.']
 
 
+### IDs of the position files of a minute (talkers, 2 is the wearer of the array)
+def tascar_IDs(dataset_n, session_n, minute, path_spear, catalog=False):
+    if catalog:
+        return catalog_talkers(dataset_n, session_n, minute, path_spear)
+    path_tascar_linux = PurePath(PathFinder(dataset_n, session_n, option, path_spear=path_spear), minute)
+    files_pos_all = list(Path(path_tascar_linux).glob('pos*.csv'))
+    files_pos_all = [f for f in files_pos_all if f.stem[0]!='.']
+    return [int(files_pos.stem[-1]) for files_pos in files_pos_all]
+
 
 
 
 ### Verification that the output files are exactly 60s long
 def tascar_60s_check(file_path):
-    sig, fs = sf.read(file_path)
-    sf.write(file_path, sig[:fs_out*60,:], fs, subtype='PCM_32')
+    SPEAR_postProcess(file_path, [sink_array(file_path)], n_frames=fs_out*60)
 
 
 
-###### Main fct to run all the scenes of the created tascar file. Separated because it will be run on Linux
-def SPEAR_tascarSceneRun(dataset_n, session_n, path_spear, minute_random=False, fmatconv=True):
+### Expand the minutes of a dataset/session into independent render (+convolve) jobs
+def tascar_jobList(dataset_n, session_n, path_spear, minute_random=False, superposition=False, catalog=False):
 
     if dataset_n==1: raise Exception('Dataset 1 do not have Tascar simulations.')
 
-    path_fmatconv = PathFinder(0, 0, 'hoa', path_spear=path_spear)
-    path_fmatconv = list(Path(path_fmatconv).glob(f'fmat*.conf'))
-    if len(path_fmatconv)!=1:
-        path_fmatconv = [f for f in path_fmatconv if f.stem[0]!='.']
-    path_fmatconv = path_fmatconv[0]
-
     ### List of minute of current dataset
     path_tascar_LINUX = PathFinder(dataset_n, session_n, option, path_spear=path_spear)
-    path_walk = [Path(x[0]) for x in os.walk(str(path_tascar_LINUX))]
-    path_walk.pop(0)
-    path_walk.sort()
-    minutes = [walk.stem for walk in path_walk]
+    minutes = tascar_minutes(dataset_n, session_n, path_spear, catalog=catalog)
 
     ### Path for the output array signals
-    path_array_LINUX = PathFinder(dataset_n, session_n, 'array', path_spear=path_spear)
     path_ref_LINUX   = PathFinder(dataset_n, session_n, 'reference', path_spear=path_spear)
 
     if minute_random:
         minute_n = random.randrange(len(minutes))
         minutes = minutes[minute_n:minute_n+1]
 
+    jobs = []
     for minute in minutes:
         ### Working path for the current minute and the current scene in tascar, ref and array
         path_ref_linux    = PurePath(path_ref_LINUX,    minute)
         path_tascar_linux = PurePath(path_tascar_LINUX, minute)
-        file_output = PurePath(path_tascar_linux, 'Tascar_scenes.tsc')
 
         ### Determine how many people are talking based on the number of position files
-        files_pos_all = list(Path(path_tascar_linux).glob(f'pos*.csv'))
-        files_pos_all = [f for f in files_pos_all if f.stem[0]!='.']
-        ID_all = [int(files_pos.stem[-1]) for files_pos in files_pos_all]
+        ID_all = tascar_IDs(dataset_n, session_n, minute, path_spear, catalog=catalog)
         ID_talk = ID_all.copy()
         ID_talk.remove(2)
-
+        ID_talk.sort()
 
         ### Scenes parameters
         sounds_all    = ['full',                 'ref'  ]
         sources_all   = [['All', 'Ls', 'ID'],    ['ID'] ]
         ID_scenes_all = [[[''],  [''], ID_talk], [ID_talk]]
 
-        ### Choose output folder. Now all in ref
-        path_out =  path_ref_linux
-
-        ### Run Tascar for all scenes
-        # jackd -d coreaudio -r 48000 -p 64 -m 
-        # jackd -d alsa -r 48000 -p 256 -m 
+        jobs_minute = []
         for sound, sources, ID_scenes in zip(sounds_all, sources_all, ID_scenes_all):
             for source, ID_scene in zip(sources, ID_scenes):
                 for idd in ID_scene:
+                    ### Choose output folder. Now all in ref
+                    jobs_minute.append({'dataset_n':   dataset_n,
+                                 'session_n':   session_n,
+                                 'minute':      minute,
+                                 'sound':       sound,
+                                 'source':      source,
+                                 'idd':         idd,
+                                 'path_tascar': str(path_tascar_linux),
+                                 'path_out':    str(path_ref_linux),
+                                 })
+
+        ### Linear superposition: the All mixture is the sum of the ID renders, done once they are finished
+        if superposition and ID_talk:
+            job_all = jobs_minute.pop(0)
+            job_all['sum_of'] = [f'array_full_ID{idd}' for idd in ID_talk]
+            job_all['after'] = [tascar_jobKey(job) for job in jobs_minute if job['sound']=='full' and job['source']=='ID']
+            jobs_minute.append(job_all)
+
+        jobs += jobs_minute
+
+    return jobs
+
+
+### Unique key of a job (used for the dependencies between jobs)
+def tascar_jobKey(job):
+    return (job['dataset_n'], job['session_n'], job['minute'], job['sound'], job['source'], job['idd'])
+
+
+### Default staging directory of the HOA intermediate file (tmpfs on Linux, next to the scene otherwise)
+def tascar_tmpDir(job):
+    if platform.system()=='Linux':
+        return '/dev/shm'
+    return job['path_tascar']
+
+
+### Remove HOA temp files left behind by dead runs (the pid and host of the owner are part of the file name,
+### the files of other hosts, in the disk staging of a shared tree, are left to them)
+def tascar_cleanTmp(dir_tmp='/dev/shm'):
+    removed = []
+    for f in Path(dir_tmp).glob('HOA*_p*_*.wav'):
+        owner = re.search(r'_p(\d+)(?:@([^_]+))?_', f.stem)
+        if owner is None or owner.group(2) not in (None, socket.gethostname()):
+            continue
+        pid = int(owner.group(1))
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            f.unlink(missing_ok=True)
+            removed.append(f)
+        except PermissionError:
+            pass
+    return removed
+
+
+### Tascar file with the micarray receiver instead of the HOA one (Tascar_scenes_preview.tsc next to the scene,
+### written again when the scene changed), the array signals are rendered directly (cf fct_preview)
+def tascar_scenePreview(file_output):
+    file_preview = PurePath(os.path.dirname(file_output), f'{PurePath(file_output).stem}_preview.tsc')
+    if os.path.exists(file_preview) and os.stat(file_preview).st_mtime_ns >= os.stat(file_output).st_mtime_ns:
+        return file_preview
+    with open(file_output) as fin:
+        text = fin.read()
+    ### Same trajectory files as the HOA receiver (dense or compact)
+    receiver = lambda m: block_receiver_micarray(*re.findall(r'importcsv="([^"]+)"', m.group(0))[0:2])
+    text, n = re.subn(r'<receiver [^>]*type="hoa3d_enc"[^>]*>.*?</receiver>', receiver, text, flags=re.DOTALL)
+    if n == 0:
+        raise ValueError(f'No HOA receiver in {file_output}')
+    file_tmp = f'{file_preview}.{os.getpid()}.tmp'
+    with open(file_tmp, 'w') as fout:
+        fout.write(text)
+    os.replace(file_tmp, file_preview)
+    return file_preview
+
+
+### Tascar file rendering the HOA receiver at the given order: the scene file itself when its receiver has
+### this order, otherwise a hidden copy with the order changed (next to it, so that the relative paths still hold)
+def tascar_sceneOrder(file_output, order=hoa_order):
+    with open(file_output) as fin:
+        text = fin.read()
+    if set(re.findall(r'order="(\d+)" type="hoa3d_enc"', text)) <= {str(order)}:
+        return file_output
+
+    file_order = PurePath(os.path.dirname(file_output), f'.{PurePath(file_output).stem}_hoa{order}.tsc')
+    if os.path.exists(file_order) and os.stat(file_order).st_mtime_ns >= os.stat(file_output).st_mtime_ns:
+        return file_order
+    file_tmp = f'{file_order}.{os.getpid()}.tmp'
+    with open(file_tmp, 'w') as fout:
+        fout.write(re.sub(r'order="\d+"( type="hoa3d_enc")', f'order="{order}"\\1', text))
+    os.replace(file_tmp, file_order)
+    return file_order
+
+
+### Shell command rendering a scene of the tascar file into output_file
+def tascar_renderCmd(scene_name, output_file, file_output):
+    return f"export LD_LIBRARY_PATH=/usr/local/lib:$LD_LIBRARY_PATH\ntascar_renderfile   --fragsize 256 --scene {scene_name} -o {output_file} -r {fs_out} {file_output}"
+
+
+### Run a single job: render the scene to HOA, convolve to the array and extract the reference
+### events: folder where the per-stage events are written (cf fct_instrumentation), None to disable them
+### output_format: 'wav' or 'flac' (compressed, cf fct_postProcessing and fct_outputFormat)
+### hoa_order: order of the HOA render, path_fmatconv must be the configuration of this order (cf tascar_fmatconvConf)
+def tascar_runJob(job, path_fmatconv, fmatconv=True, dir_tmp=None, convolver='fmatconvol', render_cache=False, events=None, output_format='wav', hoa_order=hoa_order,
+                  noise_pool=False, arrays=None):
+    with instr_stage(events, job, 'job') as event:
+        try:
+            array_file = _tascarJob(job, path_fmatconv, fmatconv, dir_tmp, convolver, render_cache, events, event, output_format, hoa_order, noise_pool,
+                                    arrays)
+        except BaseException:
+            event['status'] = 'failed'
+            raise
+        event.setdefault('status', 'done')
+        return array_file
+
+
+### Stages of a job (cf tascar_runJob), event_job is the event of the whole job
+### arrays: {name: configuration} of the other arrays convolved from the same HOA render, in their own output trees
+###         (single read of the HOA with the numpy and stream convolvers, second read after fmatconvol)
+def _tascarJob(job, path_fmatconv, fmatconv, dir_tmp, convolver, render_cache, events, event_job, output_format, hoa_order, noise_pool=False, arrays=None):
+
+    dataset_n, session_n, minute = job['dataset_n'], job['session_n'], job['minute']
+    sound, source, idd = job['sound'], job['source'], job['idd']
+    path_out = job['path_out']
+    file_output = PurePath(job['path_tascar'], 'Tascar_scenes.tsc')
+    if dir_tmp is None:
+        dir_tmp = tascar_tmpDir(job)
+
+    ### Get the array signal from the HOA (get the name and check if it exists)
+    array_name = f'array_{sound}_{source}{idd}'
+    array_file = PurePath(path_out, f'{array_name}.{output_format}')
+    ref_file = PurePath(path_out, f'ref_D{dataset_n}_S{session_n}_M{minute}_ID{idd}.{output_format}')
+    outputs = [array_file, ref_file] if sound == 'ref' else [array_file]
+
+    ### Other arrays: (configuration, output file) in their output trees, array signal only (no binaural reference)
+    extras = {}
+    if fmatconv and arrays:
+        for name, path_conf in arrays.items():
+            os.makedirs(tascar_arrayDir(path_out, name), exist_ok=True)
+            extras[name] = (path_conf, PurePath(tascar_arrayDir(path_out, name), f'{array_name}.{output_format}'))
+
+    if render_cache:
+        ### Skip only if the inputs did not change since the outputs were written (cf fct_renderCache)
+        key = cache_key(job, path_fmatconv if fmatconv else None, tascar_renderSettings(convolver, output_format, hoa_order, arrays if fmatconv else None))
+        if cache_isValid(path_out, array_name, key) and all(cache_isValid(os.path.dirname(f), array_name, key) for _, f in extras.values()):
+            print(f'Array file {array_name} for D{dataset_n} S{session_n} M{minute} is up to date, skipped.')
+            event_job['status'] = 'skipped'
+            return array_file
+    elif os.path.exists(array_file) and all(os.path.exists(f) for _, f in extras.values()):
+        print(f'Array file {array_name} for D{dataset_n} S{session_n} M{minute} already exists, skipped.')
+        event_job['status'] = 'skipped'
+        return array_file
+
+    ### Noise scene: link of the render of the same scene in the pool, rendered and stored by the first minute (cf fct_noisePool)
+    ### Each array has its own pool entry (key of its configuration), the scene is rendered again if one of them is missing
+    if noise_pool and fmatconv and sound == 'full' and source == 'Ls':
+        dir_pool = os.path.normpath(os.path.join(job['path_tascar'], path_misc, layout_misc['noisepool'][0]))
+        settings = tascar_renderSettings(convolver, output_format, hoa_order)
+        entries = [(cache_key(job, path_fmatconv, settings), array_file)] \
+                + [(cache_key(job, path_conf, settings), file_extra) for path_conf, file_extra in extras.values()]
+        with pool_lock(dir_pool, entries[0][0]):
+            if all(os.path.exists(PurePath(dir_pool, f'{key_pool}{PurePath(file).suffix}')) for key_pool, file in entries):
+                for key_pool, file in entries[::-1]: # the main array file last, it marks the job as done
+                    pool_fetch(dir_pool, key_pool, file)
+                print(f'Array file {array_name} for D{dataset_n} S{session_n} M{minute} linked from the noise pool.')
+                event_job['status'] = 'skipped'
+                if render_cache:
+                    for _, file_extra in extras.values():
+                        cache_record(os.path.dirname(file_extra), array_name, key, [file_extra])
+                    cache_record(path_out, array_name, key, outputs)
+            else:
+                _tascarJob(job, path_fmatconv, fmatconv, dir_tmp, convolver, render_cache, events, event_job, output_format, hoa_order, arrays=arrays)
+                for key_pool, file in entries:
+                    pool_store(dir_pool, key_pool, file)
+        return array_file
+
+    ### Linear superposition: sum of the ID array files instead of a new render + convolution
+    if job.get('sum_of'):
+        print(f'Summing {", ".join(job["sum_of"])} into {array_name} for D{dataset_n} S{session_n} M{minute}')
+        with instr_stage(events, job, 'sum'):
+            for _, file_sum in list(extras.values()) + [(None, array_file)]:
+                SPEAR_sumArrays([PurePath(os.path.dirname(file_sum), f'{name}.{output_format}') for name in job['sum_of']], file_sum, n_frames=fs_out*60)
+        if render_cache:
+            for _, file_extra in extras.values():
+                cache_record(os.path.dirname(file_extra), array_name, key, [file_extra])
+            cache_record(path_out, array_name, key, outputs)
+        return array_file
+
+    ### Run the scene and get the HOA
+    file_output = tascar_sceneOrder(file_output, hoa_order)
+    scene_name =        f'Scene_{sound}_source{source}{idd}'
+    HOA_name = f'HOA{hoa_order}_{sound}_source{source}{idd}'
+
+    ### The convolution writes a temporary file, renamed once everything is written (no half-written outputs)
+    ### (created by the convolution under the umask, cf tmp_name: the outputs and the pool links are readable by all)
+    array_tmp = tmp_name(array_file, '.wav')
+    extras_tmp = {name: tmp_name(file_extra, '.wav') for name, (_, file_extra) in extras.items()}
+
+    try:
+        ### Post-processing of the array file, done in a single read (cf fct_postProcessing)
+        ### The reference is written before the array, whose presence marks the job as done
+        sinks = []
+        if sound == 'ref':
+            sinks.append(sink_ref(path_out, dataset_n, session_n, minute, idd, file_format=output_format))
+
+        ### Streaming: the HOA goes through a fifo straight into the convolution, no HOA file
+        streamed = False
+        if fmatconv and convolver == 'stream':
+            print(f'Running {HOA_name} streamed into the numpy convolution for D{dataset_n} S{session_n} M{minute}')
+            try:
+                with instr_stage(events, job, 'stream'):
+                    SPEAR_streamRenderConvolve(tascar_renderCmd(scene_name, '{output}', file_output), path_fmatconv, array_tmp,
+                                               n_frames=fs_out*60, dir_tmp=dir_tmp,
+                                               extra=[(extras[name][0], extras_tmp[name]) for name in extras])
+                streamed = True
+            except StreamError as e:
+                print(f'Streaming failed ({e}), falling back to fmatconvol for D{dataset_n} S{session_n} M{minute}')
+                convolver = 'fmatconvol'
+
+        if not streamed:
+            HOA_file = tempfile.NamedTemporaryFile(prefix=f'{HOA_name}_p{os.getpid()}@{socket.gethostname()}_', suffix='.wav', dir=dir_tmp, delete=False)
+            HOA_file.close()
+
+            try:
+                print(f'Running {HOA_name} for D{dataset_n} S{session_n} M{minute}')
+                with instr_stage(events, job, 'render') as event:
+                    status = instr_system(tascar_renderCmd(scene_name, HOA_file.name, file_output), event)
+                    if status!=0:
+                        raise RuntimeError(f'tascar_renderfile failed ({status}) for {scene_name} D{dataset_n} S{session_n} M{minute}')
+
+                # small delay as sometimes the output file cannot be opened
+                time.sleep(0.1)
+
+                ### Get the array signal from the HOA (run the convolution)
+                if not fmatconv:
+                    print('fmatconvolve currently disabled ')
+                    return None
+
+                if convolver == 'numpy':
+                    ### In-process convolution, already cut to 60s and written in PCM_32
+                    print(f'Running numpy convolution for D{dataset_n} S{session_n} M{minute}')
+                    with instr_stage(events, job, 'convolve'):
+                        SPEAR_hoaToArrays([path_fmatconv] + [extras[name][0] for name in extras], HOA_file.name,
+                                          [array_tmp] + [extras_tmp[name] for name in extras], n_frames=fs_out*60)
+                else:
+                    print(f'Running fmatconvol for D{dataset_n} S{session_n} M{minute}')
+                    with instr_stage(events, job, 'convolve') as event:
+                        status = instr_system(f"fmatconvol {path_fmatconv} {HOA_file.name} {array_tmp}", event)
+                        if status!=0:
+                            raise RuntimeError(f'fmatconvol failed ({status}) for {scene_name} D{dataset_n} S{session_n} M{minute}')
+                        ### Other arrays: numpy convolution of all of them in a second read of the HOA file
+                        if extras:
+                            SPEAR_hoaToArrays([extras[name][0] for name in extras], HOA_file.name, [extras_tmp[name] for name in extras],
+                                              n_frames=fs_out*60)
+                print(f'Success, now deleting HOA file D{dataset_n} S{session_n} M{minute}')
+
+            finally:
+                ### Never leave the HOA file behind, in particular when something failed
+                if fmatconv and os.path.exists(HOA_file.name):
+                    os.remove(HOA_file.name)
+
+        ### With the create array signal, just extract channel 5 and 6 for binaural ref (same read as the 60s check)
+        with instr_stage(events, job, 'postprocess'):
+            ### Other arrays first (already cut to 60s by the numpy convolution), the main array file marks the job as done
+            for name, (_, file_extra) in extras.items():
+                if output_format == 'wav':
+                    os.replace(extras_tmp[name], file_extra)
+                else:
+                    SPEAR_postProcess(extras_tmp[name], [sink_array(file_extra)], n_frames=fs_out*60)
+            if convolver in ['numpy', 'stream'] and output_format == 'wav':
+                if sinks:
+                    SPEAR_postProcess(array_tmp, sinks, n_frames=fs_out*60)
+                os.replace(array_tmp, array_file)
+            else:
+                SPEAR_postProcess(array_tmp, sinks + [sink_array(array_file)], n_frames=fs_out*60)
+
+    finally:
+        for file_tmp in [array_tmp] + list(extras_tmp.values()):
+            if os.path.exists(file_tmp):
+                os.remove(file_tmp)
+
+    if render_cache:
+        for _, file_extra in extras.values():
+            cache_record(os.path.dirname(file_extra), array_name, key, [file_extra])
+        cache_record(path_out, array_name, key, outputs)
+
+    return array_file
+
+
+### Settings of the render that change the outputs (part of the render cache key)
+def tascar_renderSettings(convolver, output_format='wav', hoa_order=hoa_order, arrays=None):
+    settings = {'hoa_order': hoa_order,
+                'fs_out':    fs_out,
+                'fragsize':  256,
+                'duration':  60,
+                'convolver': 'numpy' if convolver == 'stream' else convolver, # same engine, same output
+                }
+    if output_format != 'wav':
+        settings['output_format'] = output_format # wav keys are unchanged
+    if arrays:
+        ### Other arrays: their configurations and weight files (keys without them are unchanged)
+        settings['arrays'] = {name: [cache_fileHash(f) for f in [path_conf] + conv_confFiles(str(path_conf))] for name, path_conf in arrays.items()}
+    return settings
+
+
+### Find the fmatconvol configuration (HOA -> array) of a HOA order in the SPEAR Miscellaneous folder
+### (the one with (order+1)^2 inputs, lower orders are derived from the full one by SPEAR_hoaConfs of fct_hoaOrder)
+def tascar_fmatconvConf(path_spear, order=hoa_order, path_hoa=None):
+    if path_hoa is None:
+        path_hoa = PathFinder(0, 0, 'hoa', path_spear=path_spear)
+    path_fmatconv = sorted(f for f in Path(path_hoa).glob('fmat*.conf') if f.stem[0]!='.')
+    for f in path_fmatconv:
+        if conv_parseConf(str(f))['ninp'] == (order+1)**2:
+            return f
+    raise FileNotFoundError(f'No fmatconvol configuration with {(order+1)**2} inputs (HOA order {order}) in {path_hoa}')
+
+
+### Configurations of other arrays: {name: configuration of HOA order in the folder of the array in Array_Transfer_Functions}
+def tascar_arrayConfs(path_spear, arrays, order=hoa_order):
+    path_atf = PathFinder(0, 0, 'ATF', path_spear=path_spear)
+    return {name: tascar_fmatconvConf(path_spear, order, path_hoa=PurePath(path_atf, name)) for name in arrays}
+
+
+### Output folder of another array: same tree as the reference one, in Reference_Audio_<name>
+def tascar_arrayDir(path_out, name):
+    parts = list(PurePath(path_out).parts)
+    n = len(parts) - 1 - parts[::-1].index(layout['reference'][1])
+    parts[n] = f'{parts[n]}_{name}'
+    return PurePath(*parts)
+
+
+###### Main fct to run all the scenes of the created tascar file. Separated because it will be run on Linux
+###### Returns the list of (job, error) of the failed jobs
+###### noise_pool=True links the loudspeaker renders shared by several minutes (scenes generated with noise_pool=<n>,
+###### cf fct_noisePool), for the main array and the other arrays. The noise of these scenes is rendered at a static
+###### receiver (median pose of the wearer), while the talker scenes keep the moving receiver: the head movements
+###### are not applied to the noise, and the noise does not match a moving-receiver render of the same minute.
+def SPEAR_tascarSceneRun(dataset_n, session_n, path_spear, minute_random=False, fmatconv=True, convolver='fmatconvol', superposition=False, render_cache=False, catalog=False, events=None, output_format='wav', hoa_order=hoa_order, dry_run=False, preflight=False,
+                         noise_pool=False, arrays=None):
+
+    if dataset_n==1: raise Exception('Dataset 1 do not have Tascar simulations.')
 
-                    ### Get the array signal from the HOA (get the name and check if it exists)
-                    array_name = f'array_{sound}_{source}{idd}'
-                    array_file = PurePath(path_out, f'{array_name}.wav')
-                    if os.path.exists(array_file):
-                        print(f'Array file {array_name} for D{dataset_n} S{session_n} M{minute} already exists, skipped.')
-                        continue
-
-                    ### Run the scene and get the HOA
-                    scene_name =        f'Scene_{sound}_source{source}{idd}'
-                    HOA_name = f'HOA{hoa_order}_{sound}_source{source}{idd}'
-                    if platform.system()=='Linux':
-                        HOA_file = tempfile.NamedTemporaryFile(prefix=f'{HOA_name}_', suffix='.wav',dir='/dev/shm',delete=False)
-                    elif platform.system()=='Darwin':
-                        HOA_file = PurePath(path_tascar_linux, f'{HOA_name}.wav')
-                    print(f'Running {HOA_name} for D{dataset_n} S{session_n} M{minute}')
-                    os.system(f"export LD_LIBRARY_PATH=/usr/local/lib:$LD_LIBRARY_PATH\ntascar_renderfile   --fragsize 256 --scene {scene_name} -o {HOA_file.name} -r {fs_out} {file_output}")
-
-                    # small delay as sometimes the output file cannot be opened
-                    time.sleep(0.1)
-                    
-                    ### Get the array signal from the HOA (run the convolution)
-                    if fmatconv:
-                        print(f'Running fmatconvol for D{dataset_n} S{session_n} M{minute}')
-                        os.system(f"fmatconvol {path_fmatconv} {HOA_file.name} {array_file}")                            
-                        tascar_60s_check(array_file)
-                        print(f'Success, now deleting HOA file D{dataset_n} S{session_n} M{minute}')
-                        os.system(f'rm {HOA_file.name}')
-                    else:
-                        print('fmatconvolve currently disabled ')
-                        continue                               
-
-                    ### With the create array signal, just extract channel 5 and 6 for binaural ref
-                    if sound == 'ref':
-                        ref_file = PurePath(path_out, f'ref_D{dataset_n}_S{session_n}_M{minute}_ID{idd}.wav')
-                        s_arr, fs_arr = sf.read(array_file)
-                        sf.write(ref_file, s_arr[:fs_out*60,4:], fs_arr, subtype='PCM_32')
+    ### Only predict the jobs left and their resources (cf fct_capacity), events are the ones of previous runs
+    if dry_run:
+        from fct_capacity import SPEAR_runPlan
+        return SPEAR_runPlan([dataset_n], [session_n], path_spear, n_workers=1, convolver=convolver, superposition=superposition,
+                             render_cache=render_cache, catalog=catalog, output_format=output_format, hoa_order=hoa_order,
+                             events=events, fmatconv=fmatconv)
+
+    ### Refuse to start on broken scene files (cf fct_preflight)
+    if preflight:
+        from fct_preflight import SPEAR_preflight
+        if SPEAR_preflight([dataset_n], [session_n], path_spear, catalog=catalog)['errors']:
+            raise Exception(f'Preflight errors in the scenes of D{dataset_n} S{session_n}, not running them.')
+
+    path_fmatconv = tascar_fmatconvConf(path_spear, hoa_order)
+    arrays = tascar_arrayConfs(path_spear, arrays, hoa_order) if arrays else None
+
+    ### Run Tascar for all scenes
+    # jackd -d coreaudio -r 48000 -p 64 -m 
+    # jackd -d alsa -r 48000 -p 256 -m 
+    ### A failed job (tascar_renderfile or fmatconvol error) is reported and the session goes on, as in the scheduler
+    failed = []
+    for job in tascar_jobList(dataset_n, session_n, path_spear, minute_random=minute_random, superposition=superposition, catalog=catalog):
+        if job.get('sum_of') and not fmatconv:
+            continue
+        job_name = f'D{dataset_n} S{session_n} M{job["minute"]} {job["sound"]}_{job["source"]}{job["idd"]}'
+        if {tascar_jobKey(j) for j, _ in failed}.intersection(job.get('after', [])):
+            failed.append((job, 'a job it depends on failed'))
+            print(f'Failed {job_name}: a job it depends on failed')
+            continue
+        try:
+            tascar_runJob(job, path_fmatconv, fmatconv=fmatconv, convolver=convolver, render_cache=render_cache, events=events, output_format=output_format, hoa_order=hoa_order,
+                          noise_pool=noise_pool, arrays=arrays)
+        except Exception as e:
+            print(f'Failed {job_name}: {e!r}')
+            failed.append((job, repr(e)))
+
+    if failed:
+        print(f'{len(failed)} jobs failed in D{dataset_n} S{session_n}:')
+        for job, error in failed:
+            print(f'    M{job["minute"]} {job["sound"]}_{job["source"]}{job["idd"]}: {error}')
+    return failed
 
 
 
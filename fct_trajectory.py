@@ -0,0 +1,281 @@
+"""
+SPEAR Challenge
+
+Compaction of the trajectories (pos_ID*.csv, ori_ID*.csv) of the TASCAR minutes, with a bounded error.
+Input: datasets, sessions, spear path and the position (m) and angle (degree) tolerances.
+Output: compact_pos_ID*.csv and compact_ori_ID*.csv next to the originals, and a report of the keyframes kept.
+
+The sources and the receiver load their trajectory with importcsv (rows time, x, y, z and time, rz, ry, rx
+in degrees), and tascar interpolates the geometry and updates the image sources at every keyframe.
+The EasyCom trajectories are densely sampled: here the keyframes that the interpolation between the
+kept ones reproduces within the tolerances are removed.
+    positions:    linear interpolation, error = distance to the original position
+    orientations: linear interpolation of the Euler angles (as tascar does, interpolation='euler') or slerp,
+                  error = angle of the rotation between the interpolated and the original orientation
+The selection is a Douglas-Peucker split on time: all the segments are refined at once, each pass
+computes the error of every row against its segment with numpy and keeps the worst row of every
+segment above the tolerance, until no segment is. First and last rows are always kept.
+The kept rows are copied verbatim from the original files.
+
+The compact files are named compact_*.csv so that the pos*.csv globs (IDs of a minute, cf tascar_IDs,
+and the catalog) do not see them. The scenes use them when generated with compact=True
+(cf tascar_sceneGenMinute, SPEAR_tascarSceneGenBatch).
+
+- traj_read: Times, values and text rows of a trajectory csv.
+- traj_quaternions: Quaternions of zyx Euler angles (degrees).
+- traj_decimate: Indices of the keyframes to keep for a tolerance.
+- traj_compactFile: Write the compact version of a trajectory csv.
+- SPEAR_trajectoryCompact: Compact all the trajectories of datasets/sessions (process pool over minutes).
+- SPEAR_trajectoryRenderGain: Render sampled minutes with the dense and the compact trajectories (time and HOA difference).
+
+Command line:
+    python fct_trajectory.py compact --path_spear /SPEAR-dir --datasets 2 3 4 --pos_tol 0.005 --ang_tol 1 --json traj.json
+    python fct_trajectory.py render --path_spear /SPEAR-dir --datasets 2 --sessions 1 --minutes 2
+
+"""
+
+import os
+import re
+import json
+import time
+import random
+import argparse
+import tempfile
+import numpy as np
+from pathlib import Path
+from pathlib import PurePath
+from concurrent.futures import ProcessPoolExecutor
+from fct_PathFinder import PathFinder
+from fct_tascarScene import tascar_minutes, tascar_renderCmd, prefix_compact
+from fct_superposition import superposition_residual
+
+
+###### Global Parameters
+pos_tol = 0.005 # m
+ang_tol = 1.0 # degree
+ori_interp = 'euler' # interpolation of the orientations by tascar: 'euler' (linear on the angles) or 'slerp'
+
+
+### Times, values and text rows of a trajectory csv
+def traj_read(path_csv):
+    with open(path_csv) as fin:
+        rows = [line.rstrip('\n') for line in fin if line.strip()]
+    data = np.array([[float(v) for v in row.split(',')] for row in rows]).reshape(len(rows), -1)
+    return data[:, 0], data[:, 1:], rows
+
+
+### Quaternions (w, x, y, z) of zyx Euler angles in degrees (rotation rz about z, then ry about y, then rx about x)
+def traj_quaternions(euler):
+    h = np.radians(euler) / 2
+    cz, sz = np.cos(h[:, 0]), np.sin(h[:, 0])
+    cy, sy = np.cos(h[:, 1]), np.sin(h[:, 1])
+    cx, sx = np.cos(h[:, 2]), np.sin(h[:, 2])
+    return np.stack([cz*cy*cx + sz*sy*sx,
+                     cz*cy*sx - sz*sy*cx,
+                     cz*sy*cx + sz*cy*sx,
+                     sz*cy*cx - cz*sy*sx], axis=1)
+
+
+### Angle (degrees) of the rotations between two sets of quaternions
+def _angle(q1, q2):
+    dot = np.abs(np.sum(q1*q2, axis=1))
+    return np.degrees(2*np.arccos(np.clip(dot, 0, 1)))
+
+
+### Error of every row against the interpolation between the keyframes i0 and i1 of its segment
+def _error(t, values, i0, i1, kind, quats=None, interp=ori_interp):
+    dt = t[i1] - t[i0]
+    alpha = np.where(dt > 0, (t - t[i0]) / np.where(dt > 0, dt, 1), 0)[:, None]
+    if kind == 'pos':
+        return np.linalg.norm(values[i0] + alpha*(values[i1]-values[i0]) - values, axis=1)
+    if interp == 'euler':
+        return _angle(traj_quaternions(values[i0] + alpha*(values[i1]-values[i0])), quats)
+
+    ### slerp between the quaternions of the keyframes (shortest path)
+    q0, q1 = quats[i0], quats[i1]
+    dot = np.sum(q0*q1, axis=1)
+    q1 = np.where(dot[:, None] < 0, -q1, q1)
+    omega = np.arccos(np.clip(np.abs(dot), 0, 1))[:, None]
+    small = omega < 1e-8
+    sin_omega = np.where(small, 1, np.sin(omega))
+    w0 = np.where(small, 1-alpha, np.sin((1-alpha)*omega)/sin_omega)
+    w1 = np.where(small, alpha, np.sin(alpha*omega)/sin_omega)
+    q = w0*q0 + w1*q1
+    return _angle(q / np.linalg.norm(q, axis=1, keepdims=True), quats)
+
+
+### Indices of the keyframes to keep so that every row is interpolated within the tolerance
+def traj_decimate(t, values, tol, kind='pos', interp=ori_interp):
+    n = len(t)
+    if n <= 2:
+        return np.arange(n)
+    quats = traj_quaternions(values) if kind == 'ori' else None
+    rows = np.arange(n)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n-1]] = True
+
+    while True:
+        kept = np.flatnonzero(keep)
+        seg = np.clip(np.searchsorted(kept, rows, side='right') - 1, 0, len(kept)-2)
+        err = _error(t, values, kept[seg], kept[seg+1], kind, quats, interp)
+        err[keep] = 0
+
+        ### Worst row of every segment, kept if above the tolerance
+        order = np.lexsort((-err, seg))
+        first = order[np.r_[True, seg[order][1:] != seg[order][:-1]]]
+        add = first[err[first] > tol]
+        if len(add) == 0:
+            return kept
+        keep[add] = True
+
+
+### Write the compact version of a trajectory csv (kept rows copied verbatim), returns (rows, kept rows, max error)
+def traj_compactFile(path_csv, path_out, tol, kind, interp=ori_interp):
+    t, values, rows = traj_read(path_csv)
+    kept = traj_decimate(t, values, tol, kind, interp)
+    err_max = 0.0
+    if len(kept) >= 2:
+        seg = np.clip(np.searchsorted(kept, np.arange(len(t)), side='right') - 1, 0, len(kept)-2)
+        quats = traj_quaternions(values) if kind == 'ori' else None
+        err_max = float(np.max(_error(t, values, kept[seg], kept[seg+1], kind, quats, interp)))
+    path_tmp = f'{path_out}.{os.getpid()}.tmp'
+    with open(path_tmp, 'w') as fout:
+        fout.write('\n'.join(rows[k] for k in kept) + '\n')
+    os.replace(path_tmp, path_out)
+    return len(rows), len(kept), err_max
+
+
+### Worker: compact the trajectories of a minute
+def _compactMinute(path_minute, tols, interp, force):
+    stats = []
+    for path_csv in sorted(Path(path_minute).glob('*_ID*.csv')):
+        kind = path_csv.name.split('_')[0]
+        if kind not in tols:
+            continue # compact files and other csv
+        path_out = PurePath(path_minute, prefix_compact + path_csv.name)
+        if not force and os.path.exists(path_out) and os.stat(path_out).st_mtime_ns >= os.stat(path_csv).st_mtime_ns:
+            n_rows = sum(1 for line in open(path_csv) if line.strip())
+            n_kept = sum(1 for line in open(path_out) if line.strip())
+            stats.append({'file': path_csv.name, 'kind': kind, 'rows': n_rows, 'kept': n_kept, 'max_error': None})
+            continue
+        n_rows, n_kept, err_max = traj_compactFile(path_csv, path_out, tols[kind], kind, interp)
+        stats.append({'file': path_csv.name, 'kind': kind, 'rows': n_rows, 'kept': n_kept, 'max_error': err_max})
+    return stats
+
+
+### Compact all the trajectories of datasets/sessions, returns the report
+def SPEAR_trajectoryCompact(datasets, sessions, path_spear, pos_tol=pos_tol, ang_tol=ang_tol, interp=ori_interp,
+                            n_workers=None, catalog=False, force=False):
+    ### Compact files newer than their trajectory are kept, unless force is set (new tolerances)
+    tols = {'pos': pos_tol, 'ori': ang_tol}
+    minutes = []
+    for dataset_n in datasets:
+        if dataset_n == 1:
+            continue
+        for session_n in sessions:
+            path_session = PathFinder(dataset_n, session_n, 'Tascar', path_spear=path_spear)
+            minutes += [str(PurePath(path_session, minute)) for minute in tascar_minutes(dataset_n, session_n, path_spear, catalog=catalog)]
+    print(f'{len(minutes)} minutes to compact (position {pos_tol} m, angle {ang_tol} deg, {interp})')
+
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        stats = [s for minute_stats in pool.map(_compactMinute, minutes, [tols]*len(minutes), [interp]*len(minutes), [force]*len(minutes))
+                 for s in minute_stats]
+
+    report = {'pos_tol': pos_tol, 'ang_tol': ang_tol, 'interp': interp, 'minutes': len(minutes), 'kinds': {}}
+    for kind in ('pos', 'ori'):
+        ks = [s for s in stats if s['kind'] == kind]
+        if not ks:
+            continue
+        rows, kept = sum(s['rows'] for s in ks), sum(s['kept'] for s in ks)
+        errors = [s['max_error'] for s in ks if s['max_error'] is not None]
+        report['kinds'][kind] = {'files': len(ks), 'rows': rows, 'kept': kept, 'reduction': 1 - kept/max(rows, 1),
+                                 'max_error': max(errors) if errors else None}
+        print(f'{kind}: {len(ks)} files, {rows} -> {kept} keyframes ({100*(1-kept/max(rows, 1)):.1f}% removed)'
+              + (f', max error {max(errors):.4g} {"m" if kind == "pos" else "deg"}' if errors else ''))
+    return report
+
+
+### Copy of a scene file pointing at the dense or the compact trajectories (hidden, next to it for the relative paths)
+def _sceneTrajectories(file_tsc, compact):
+    dir_tsc = os.path.dirname(file_tsc)
+    with open(file_tsc) as fin:
+        text = fin.read()
+    def swap(m):
+        name = m.group(2) if not compact or not os.path.exists(PurePath(dir_tsc, prefix_compact + m.group(2))) else prefix_compact + m.group(2)
+        return f'importcsv="{name}"'
+    file_copy = PurePath(dir_tsc, f'.{PurePath(file_tsc).stem}_{"compact" if compact else "dense"}.tsc')
+    with open(file_copy, 'w') as fout:
+        fout.write(re.sub(r'importcsv="(%s)?((?:pos|ori)_ID\d+\.csv)"' % prefix_compact, swap, text))
+    return file_copy
+
+
+### Render sampled minutes with the dense and the compact trajectories: render time and difference of the HOA signals
+def SPEAR_trajectoryRenderGain(datasets, sessions, path_spear, n_minutes=2, seed=0, scene_name='Scene_full_sourceAll'):
+    minutes = []
+    for dataset_n in datasets:
+        if dataset_n == 1:
+            continue
+        for session_n in sessions:
+            path_session = PathFinder(dataset_n, session_n, 'Tascar', path_spear=path_spear)
+            minutes += [PurePath(path_session, minute) for minute in tascar_minutes(dataset_n, session_n, path_spear)]
+    minutes = random.Random(seed).sample(minutes, min(n_minutes, len(minutes)))
+
+    results = []
+    for path_minute in minutes:
+        file_tsc = PurePath(path_minute, 'Tascar_scenes.tsc')
+        scenes = {'dense': _sceneTrajectories(file_tsc, False), 'compact': _sceneTrajectories(file_tsc, True)}
+        dir_tmp = tempfile.mkdtemp(prefix='trajectory_')
+        try:
+            walls, files = {}, {}
+            for name, file_scene in scenes.items():
+                files[name] = os.path.join(dir_tmp, f'{name}.wav')
+                t0 = time.perf_counter()
+                status = os.system(tascar_renderCmd(scene_name, files[name], file_scene))
+                walls[name] = time.perf_counter() - t0
+                if status != 0:
+                    raise RuntimeError(f'tascar_renderfile failed ({status}) for {scene_name} in {file_scene}')
+            diff_db, _ = superposition_residual(files['compact'], files['dense'])
+        finally:
+            for f in Path(dir_tmp).glob('*'):
+                f.unlink()
+            os.rmdir(dir_tmp)
+            for file_scene in scenes.values():
+                os.remove(file_scene)
+        results.append({'minute': str(path_minute), 'dense_s': walls['dense'], 'compact_s': walls['compact'],
+                        'speedup': walls['dense']/walls['compact'], 'difference_db': diff_db})
+        print(f'{path_minute}: {walls["dense"]:.2f} s dense, {walls["compact"]:.2f} s compact '
+              f'(x{walls["dense"]/walls["compact"]:.2f}), HOA difference {diff_db:.1f} dB')
+
+    report = {'scene': scene_name, 'minutes': results}
+    if results:
+        report['speedup'] = float(np.mean([r['speedup'] for r in results]))
+        print(f'Mean speed-up x{report["speedup"]:.2f}')
+    return report
+
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Compact the pos/ori trajectories of the TASCAR minutes within tolerances.')
+    parser.add_argument('command', choices=['compact', 'render'])
+    parser.add_argument('--path_spear', required=True, help='folder containing the SPEAR directory')
+    parser.add_argument('--datasets', type=int, nargs='+', default=[2, 3, 4])
+    parser.add_argument('--sessions', type=int, nargs='+', default=list(range(1, 16)))
+    parser.add_argument('--pos_tol', type=float, default=pos_tol, help='position tolerance (m)')
+    parser.add_argument('--ang_tol', type=float, default=ang_tol, help='angle tolerance (degree)')
+    parser.add_argument('--interp', default=ori_interp, choices=['euler', 'slerp'], help='interpolation of the orientations')
+    parser.add_argument('--force', action='store_true', help='compact again the files already compacted')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--catalog', action='store_true', help='list the minutes from the catalog (cf fct_catalog)')
+    parser.add_argument('--minutes', type=int, default=2, help='number of sampled minutes rendered (render)')
+    parser.add_argument('--json', default=None, help='also write the report in this file')
+    args = parser.parse_args()
+
+    if args.command == 'compact':
+        report = SPEAR_trajectoryCompact(args.datasets, args.sessions, args.path_spear, pos_tol=args.pos_tol, ang_tol=args.ang_tol,
+                                         interp=args.interp, n_workers=args.workers, catalog=args.catalog, force=args.force)
+    else:
+        report = SPEAR_trajectoryRenderGain(args.datasets, args.sessions, args.path_spear, n_minutes=args.minutes)
+    if args.json is not None:
+        with open(args.json, 'w') as fout:
+            json.dump(report, fout, indent=1)
@@ -0,0 +1,66 @@
+import numpy as np
+import soundfile as sf
+import pytest
+from fct_convolution import conv_engine, SPEAR_hoaToArrays
+
+
+@pytest.mark.parametrize('partitions', [(1024, 256), (256, 1024), (512, 512, 1000)])
+def test_hoaToArrays_partitions(tmp_path, partitions):
+    fs, n_out, ninp = 48000, 144000, 4
+    rng = np.random.default_rng(0)
+    HOA_file = tmp_path / 'hoa.wav'
+    x = 0.1*rng.standard_normal((n_out, ninp)).astype(np.float32)
+    sf.write(HOA_file, x, fs, subtype='FLOAT')
+
+    filters = [rng.standard_normal((300+100*n, ninp, 2)).astype(np.float32) for n in range(len(partitions))]
+    engines = [conv_engine(h, partition) for h, partition in zip(filters, partitions)]
+    array_files = [tmp_path / f'array{n}.wav' for n in range(len(partitions))]
+    SPEAR_hoaToArrays([None]*len(engines), HOA_file, array_files, n_frames=None, block_size=5000, engines=engines, subtype='FLOAT')
+
+    for h, array_file in zip(filters, array_files):
+        y, _ = sf.read(array_file, dtype='float64', always_2d=True)
+        assert y.shape == (n_out, 2)
+        ref = np.stack([sum(np.convolve(x[:, i], h[:, i, o])[:n_out] for i in range(ninp)) for o in range(2)], axis=1)
+        np.testing.assert_allclose(y, ref, atol=1e-3)
+
+
+def _conf(tmp_path, h, partition, fs=48000):
+    length, ninp, nout = h.shape
+    sf.write(tmp_path / 'weights.wav', h.reshape(length, ninp*nout), fs, subtype='FLOAT')
+    path_conf = tmp_path / 'fmat.conf'
+    path_conf.write_text(f'/cd {tmp_path}\n/convolver/new {ninp} {nout} {length} {partition}\n/convolver/load weights.wav\n')
+    return str(path_conf)
+
+
+def _reference(x, h):
+    n = len(x)
+    return np.stack([sum(np.convolve(x[:, i], h[:, i, o])[:n] for i in range(h.shape[1])) for o in range(h.shape[2])], axis=1)
+
+
+def test_hoaToArrays_same_conf(tmp_path):
+    ### The same configuration twice: the two outputs must not share the delay line of a cached engine
+    rng = np.random.default_rng(1)
+    x = 0.1*rng.standard_normal((20000, 4)).astype(np.float32)
+    h = rng.standard_normal((700, 4, 2)).astype(np.float32)
+    sf.write(tmp_path / 'hoa.wav', x, 48000, subtype='FLOAT')
+    path_conf = _conf(tmp_path, h, 256)
+    array_files = [tmp_path / 'array0.wav', tmp_path / 'array1.wav']
+
+    for _ in range(2): # the second call gets the cached filter spectra
+        SPEAR_hoaToArrays([path_conf, path_conf], tmp_path / 'hoa.wav', array_files, n_frames=None, block_size=3000, subtype='FLOAT')
+        for array_file in array_files:
+            y, _ = sf.read(array_file, dtype='float64', always_2d=True)
+            np.testing.assert_allclose(y, _reference(x, h), atol=1e-3)
+
+    engine = conv_engine(h, 512)
+    SPEAR_hoaToArrays([None, None], tmp_path / 'hoa.wav', array_files, n_frames=None, engines=[engine, engine], subtype='FLOAT')
+    for array_file in array_files:
+        np.testing.assert_allclose(sf.read(array_file, dtype='float64', always_2d=True)[0], _reference(x, h), atol=1e-3)
+
+
+def test_hoaToArrays_samplerate(tmp_path):
+    rng = np.random.default_rng(2)
+    sf.write(tmp_path / 'hoa.wav', np.zeros((1000, 4), dtype=np.float32), 44100, subtype='FLOAT')
+    path_conf = _conf(tmp_path, rng.standard_normal((100, 4, 2)).astype(np.float32), 256, fs=48000)
+    with pytest.raises(ValueError, match='44100'):
+        SPEAR_hoaToArrays([path_conf], tmp_path / 'hoa.wav', [tmp_path / 'array.wav'], n_frames=None)
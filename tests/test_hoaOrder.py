@@ -0,0 +1,34 @@
+import os
+import numpy as np
+import soundfile as sf
+import pytest
+from fct_PathFinder import PathFinder
+from fct_convolution import conv_readConf
+from fct_hoaOrder import SPEAR_hoaConfs
+
+
+@pytest.mark.parametrize('mode', ['load', 'impulse'])
+def test_hoaConfs_truncation(tmp_path, mode):
+    ### Full order 3 (16 inputs) to order 1 and 2: the filters of the first (n+1)^2 inputs
+    path_hoa = PathFinder(0, 0, 'hoa', path_spear=str(tmp_path))
+    os.makedirs(path_hoa)
+    rng = np.random.default_rng(0)
+    ninp, nout, length = 16, 3, 200
+    if mode == 'load':
+        h = rng.standard_normal((length, ninp*nout)).astype(np.float32)
+        sf.write(os.path.join(path_hoa, 'weights.wav'), h, 48000, subtype='FLOAT')
+        lines = [f'/convolver/new {ninp} {nout} {length} 256', '/convolver/load weights.wav']
+    else:
+        lines = [f'/convolver/new {ninp} {nout} {length} 256']
+        for out in range(nout):
+            sf.write(os.path.join(path_hoa, f'weights_mic{out+1}.wav'), rng.standard_normal((length, ninp)).astype(np.float32), 48000, subtype='FLOAT')
+            lines += [f'/impulse/read {inp+1} {out+1} 0.5 3 0 {length} {inp+1} weights_mic{out+1}.wav' for inp in range(ninp)]
+    with open(os.path.join(path_hoa, 'fmat_hoa3.conf'), 'w') as fout:
+        fout.write('\n'.join(lines) + '\n')
+
+    filters_full = conv_readConf(os.path.join(path_hoa, 'fmat_hoa3.conf'))[0]
+    confs = SPEAR_hoaConfs(str(tmp_path), [1, 2, 3], order_full=3)
+    for order, path_conf in confs.items():
+        filters, partition, fs = conv_readConf(str(path_conf))
+        assert filters.shape == (length, (order+1)**2, nout) and partition == 256 and fs == 48000
+        np.testing.assert_array_equal(filters, filters_full[:, :(order+1)**2, :])
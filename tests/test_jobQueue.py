@@ -0,0 +1,62 @@
+import os
+import json
+import time
+import fct_jobQueue
+from fct_jobQueue import queue_claim, queue_release, lease_ttl
+
+
+def _expire(path_lease):
+    t = time.time() - 2*lease_ttl
+    os.utime(path_lease, (t, t))
+
+
+def test_claim_release(tmp_path):
+    os.makedirs(tmp_path / 'leases')
+    path_lease = queue_claim(tmp_path, 'J1')
+    assert path_lease is not None
+    assert queue_claim(tmp_path, 'J1') is None # leased and alive
+    assert queue_release(path_lease)
+    assert not os.path.exists(path_lease)
+    assert not queue_release(path_lease) # already removed: no error
+
+
+def test_release_reclaimed(tmp_path):
+    os.makedirs(tmp_path / 'leases')
+    path_lease = queue_claim(tmp_path, 'J1')
+    with open(path_lease, 'w') as fout:
+        json.dump({'host': 'other', 'pid': 1, 'start': 0}, fout)
+    assert not queue_release(path_lease)
+    assert os.path.exists(path_lease)
+
+
+def test_reclaim_expired(tmp_path):
+    os.makedirs(tmp_path / 'leases')
+    path_lease = queue_claim(tmp_path, 'J1')
+    _expire(path_lease)
+    assert queue_claim(tmp_path, 'J1') == path_lease
+    assert os.stat(path_lease).st_mtime > time.time() - lease_ttl
+
+
+def test_reclaim_interleaved(tmp_path, monkeypatch):
+    ### Node A checks the expired lease, node B reclaims it and writes a fresh lease before the rename of A
+    os.makedirs(tmp_path / 'leases')
+    path_lease = queue_claim(tmp_path, 'J1')
+    _expire(path_lease)
+
+    rename = os.rename
+    fresh = {}
+    def rename_after_B(src, dst):
+        if not fresh:
+            monkeypatch.setattr(fct_jobQueue.os, 'rename', rename)
+            fresh['lease'] = queue_claim(tmp_path, 'J1') # node B
+            with open(fresh['lease']) as fin:
+                fresh['owner'] = fin.read()
+            monkeypatch.setattr(fct_jobQueue.os, 'rename', rename_after_B)
+        rename(src, dst)
+    monkeypatch.setattr(fct_jobQueue.os, 'rename', rename_after_B)
+
+    assert queue_claim(tmp_path, 'J1') is None # node A
+    assert fresh['lease'] == path_lease
+    with open(path_lease) as fin:
+        assert fin.read() == fresh['owner'] # the lease of B is still there
+    assert [f for f in os.listdir(tmp_path / 'leases')] == ['J1.lease']
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import soundfile as sf
+import pytest
+from pathlib import Path
+from fct_PathFinder import PathFinder
+from fct_reader import SPEAR_reader, reader_read, reader_windows, reader_scenes
+
+fs = 8000
+
+
+@pytest.fixture
+def path_spear(tmp_path):
+    rng = np.random.default_rng(0)
+    path_ref = Path(PathFinder(2, 1, 'reference', path_spear=str(tmp_path)))
+    for n_minute, (subtype, ext) in enumerate([('PCM_32', 'wav'), ('FLOAT', 'wav'), ('PCM_24', 'flac'), ('PCM_16', 'wav')]):
+        path_minute = path_ref / f'{n_minute:02d}'
+        os.makedirs(path_minute)
+        x = 0.5*rng.uniform(-1, 1, (int(3.7*fs), 6))
+        sf.write(path_minute / f'array_full_All.{ext}', x, fs, subtype=subtype)
+        sf.write(path_minute / f'ref_D2_S1_M{n_minute:02d}_ID3.{ext}', x[:, 4:], fs, subtype=subtype)
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('block_s', [1, 0.3])
+def test_read_windows(path_spear, block_s):
+    reader = SPEAR_reader(2, [1], path_spear, block_s=block_s, mmap_max=2)
+    assert reader_scenes(reader, 1, '00') == ['array_full_All', 'ref_ID3']
+    for (session_n, minute, scene), entry in sorted(reader['index'].items()):
+        x = sf.read(entry['file'], dtype='float32', always_2d=True)[0]
+        for start_s, duration_s, channels in [(0, None, None), (0.95, 1.1, None), (1.0, 1.0, [1, 0]), (2.5, 5, slice(0, 1)), (3.7, 1, None)]:
+            y = reader_read(reader, session_n, minute, scene, start_s, duration_s, channels)
+            start = int(round(start_s*fs))
+            stop = len(x) if duration_s is None else min(start+int(round(duration_s*fs)), len(x))
+            np.testing.assert_array_equal(y, x[start:stop][:, slice(None) if channels is None else channels])
+        assert len(reader['mmaps']) <= 2 # the mappings (file descriptors) are bounded
+
+
+def test_windows(path_spear):
+    reader = SPEAR_reader(2, [1], path_spear)
+    sequential = reader_windows(reader, 1, hop_s=0.5)
+    assert len(sequential) == 8*6 # windows starting at 0, 0.5, ... 2.5 of the 3.7s scenes
+    assert all(0 <= t <= 3.7-1 for (_, _, _, t, _) in sequential)
+
+    assert len(reader_windows(reader, 1, seed=0)) == 8 # one per scene by default
+    random = reader_windows(reader, 1.5, n=20, seed=0, scenes=['ref_ID3'])
+    assert len(random) == 20 and all(r[2] == 'ref_ID3' and 0 <= r[3] <= 3.7-1.5 for r in random)
+    assert random == reader_windows(reader, 1.5, n=20, seed=0, scenes=['ref_ID3'])
+    assert reader_windows(reader, 10, seed=0) == [] # no scene long enough